@@ -1,52 +1,88 @@
+# Metrics used to evaluate MediBot, see evaluate.py for the evaluation pipeline
+# that replays a dataset of conversations through the chains and scores it.
+import re
+
 import numpy as np
-from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score
+from sklearn.metrics import accuracy_score, f1_score
 from nltk.translate.bleu_score import sentence_bleu, SmoothingFunction
 from rouge_score import rouge_scorer
-import math
-
-# Dummy data (Replace these with your actual values)
-ground_truth_conditions = ['flu', 'migraine', 'asthma']
-predicted_conditions = ['flu', 'migraine', 'cold']
-
-# 1. Accuracy
-accuracy = accuracy_score(ground_truth_conditions, predicted_conditions)
-print(f"Accuracy: {accuracy * 100:.2f}%")
-
-# 2. F1-Score for condition classification
-f1 = f1_score(ground_truth_conditions, predicted_conditions, average='weighted')
-print(f"F1-Score: {f1:.2f}")
-
-# 3. BLEU Score for response quality
-references = [["You should rest and stay hydrated".split()]]
-candidates = ["You need to rest and drink water".split()]
-smooth = SmoothingFunction().method1
-bleu = sentence_bleu(references, candidates[0], smoothing_function=smooth)
-print(f"BLEU Score: {bleu:.2f}")
-
-# 4. ROUGE-L Score
-scorer = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
-scores = scorer.score("You need to rest and drink water", "You should rest and stay hydrated")
-rouge_l = scores['rougeL'].fmeasure
-print(f"ROUGE-L Score: {rouge_l:.2f}")
-
-# 5. Perplexity (Assume loss = 2.91 from test set)
-loss = 2.91
-perplexity = math.exp(loss)
-print(f"Perplexity: {perplexity:.2f}")
-
-# 6. Stage Compliance Rate
-total_conversations = 50
-compliant_conversations = 48
-compliance_rate = (compliant_conversations / total_conversations) * 100
-print(f"Stage Compliance Rate: {compliance_rate:.2f}%")
-
-# 7. User Satisfaction Score
-user_ratings = [5, 4, 4, 5, 3, 5, 4, 4, 4, 5]
-user_satisfaction = sum(user_ratings) / len(user_ratings)
-print(f"User Satisfaction Score: {user_satisfaction:.2f}/5")
-
-# 8. Expert Validation
-expert_validated = 46
-expert_total = 50
-expert_validation = (expert_validated / expert_total) * 100
-print(f"Expert Validation: {expert_validation:.2f}%")
+
+
+WORD_PATTERN = re.compile(r"\w+(?:'\w+)?")
+
+_smoothing = SmoothingFunction().method1
+# Built lazily, once per (pool worker) process
+_rouge_scorer = None
+
+
+# Accuracy and weighted F1-Score of a classification (conditions, conversation stages, ...)
+def classification_metrics(ground_truth, predicted):
+    accuracy = accuracy_score(ground_truth, predicted)
+    f1 = f1_score(ground_truth, predicted, average='weighted')
+    return accuracy, f1
+
+
+def tokenize(text):
+    return WORD_PATTERN.findall(text.lower())
+
+
+# BLEU of a reply against one reference reply
+def bleu_score(reference, candidate):
+    reference_tokens, candidate_tokens = tokenize(reference), tokenize(candidate)
+    if not reference_tokens or not candidate_tokens:
+        return 0.0
+    return sentence_bleu([reference_tokens], candidate_tokens, smoothing_function=_smoothing)
+
+
+def rouge_l_score(reference, candidate):
+    global _rouge_scorer
+    if _rouge_scorer is None:
+        _rouge_scorer = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
+    return _rouge_scorer.score(reference, candidate)['rougeL'].fmeasure
+
+
+# A conversation starts in stage 1 and then either stays in its stage or moves to the
+# next one, stages are never skipped or revisited. Returns one flag per stage output.
+def stage_transitions_compliant(stages):
+    stages = np.asarray(stages, dtype=np.int64)
+    if stages.size == 0:
+        return stages.astype(bool)
+    steps = np.diff(stages, prepend=0)
+    compliant = (steps == 0) | (steps == 1)
+    compliant[0] = stages[0] == 1
+    return compliant
+
+
+# Finds the first known diagnosis mentioned in a reply, longest labels first so
+# "allergic rhinitis" wins over "rhinitis"
+def mentioned_label(text, labels):
+    text = " " + " ".join(tokenize(text)) + " "
+    for label in sorted(labels, key=len, reverse=True):
+        if " " + " ".join(tokenize(label)) + " " in text:
+            return label
+    return None
+
+
+def aggregate_scores(records):
+    # `records` are the per-conversation scores written by evaluate.py, the turn level
+    # values are concatenated into flat arrays so every rate is a single reduction
+    bleu = np.fromiter((value for record in records for value in record["bleu"]), dtype=np.float64)
+    rouge_l = np.fromiter((value for record in records for value in record["rouge_l"]), dtype=np.float64)
+    transitions = np.fromiter((value for record in records for value in record["compliant_turns"]), dtype=bool)
+    conversations = np.fromiter((record["compliant"] for record in records), dtype=bool, count=len(records))
+    report = {
+        "conversations": len(records),
+        "turns": int(transitions.size),
+        "bleu": float(bleu.mean()) if bleu.size else None,
+        "rouge_l": float(rouge_l.mean()) if rouge_l.size else None,
+        "stage_transition_compliance": float(transitions.mean()) if transitions.size else None,
+        "stage_compliance": float(conversations.mean()) if conversations.size else None,
+    }
+    labelled = [(record["diagnosis"], record["predicted_diagnosis"] or "none") for record in records if record.get("diagnosis")]
+    if labelled:
+        report["diagnosis_accuracy"], report["diagnosis_f1"] = classification_metrics(*zip(*labelled))
+    stage_pairs = [(label, stage) for record in records for label, stage in zip(record.get("expected_stages") or [], record["stages"])
+                   if label is not None]
+    if stage_pairs:
+        report["stage_accuracy"], report["stage_f1"] = classification_metrics(*zip(*stage_pairs))
+    return report
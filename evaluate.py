@@ -0,0 +1,288 @@
+# Evaluates MediBot on a dataset of conversations with ground-truth diagnoses and
+# reference replies.
+#
+#   python evaluate.py conversations.jsonl --work-dir eval_run --concurrency 16
+#   python evaluate.py conversations.jsonl --work-dir eval_run --no-replay      # score cached outputs only
+#   python evaluate.py conversations.jsonl --work-dir eval_run --stub-latency 0.05
+#
+# Each JSONL line holds one conversation:
+#   {"id": "c1", "diagnosis": "migraine",
+#    "turns": [{"user_query": "...", "reference_reply": "...", "stage": 1}, ...]}
+# where "diagnosis" and the per-turn "stage" labels are optional.
+#
+# Every turn is replayed with the reference replies of the earlier turns as history,
+# so the turns of a conversation are independent and run concurrently. Replayed
+# outputs are appended to <work-dir>/outputs.jsonl and scores to <work-dir>/scores.jsonl
+# as each conversation finishes: an interrupted run picks up where it stopped, and
+# conversations already replayed or scored are never sent to the model or scored again.
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "medibot-code"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "medibot-code", "benchmarks"))
+
+from accuracy import aggregate_scores, bleu_score, mentioned_label, rouge_l_score, stage_transitions_compliant  # noqa: E402
+
+
+FINAL_DIAGNOSIS_STAGE = 3
+
+
+def iter_conversations(path, limit=None):
+    with open(path) as dataset:
+        count = 0
+        for line in dataset:
+            if not line.strip():
+                continue
+            yield json.loads(line)
+            count += 1
+            if limit is not None and count >= limit:
+                return
+
+
+def read_jsonl_ids(path):
+    # Ids recorded by an earlier run, a partly written last line is ignored
+    ids = set()
+    if os.path.exists(path):
+        with open(path) as records:
+            for line in records:
+                try:
+                    ids.add(json.loads(line)["id"])
+                except (json.JSONDecodeError, KeyError):
+                    continue
+    return ids
+
+
+def index_outputs(path, wanted_ids):
+    # Byte offset of the latest output line of each wanted conversation, the replies
+    # themselves are read back one conversation at a time while scoring
+    offsets = {}
+    if os.path.exists(path):
+        with open(path, "rb") as records:
+            while True:
+                offset = records.tell()
+                line = records.readline()
+                if not line:
+                    break
+                try:
+                    record_id = json.loads(line)["id"]
+                except (json.JSONDecodeError, KeyError):
+                    continue
+                if record_id in wanted_ids:
+                    offsets[record_id] = offset
+    return offsets
+
+
+def read_output(records, offset):
+    records.seek(offset)
+    return json.loads(records.readline())["turns"]
+
+
+def turn_history(turns, index):
+    # Patient messages and the reference replies before turn `index`, then its query
+    history = []
+    for turn in turns[:index]:
+        history.extend([turn["user_query"], turn["reference_reply"]])
+    history.append(turns[index]["user_query"])
+    return history
+
+
+async def replay_turn(registry, model, mode, history, user_query):
+    from utils import conv_stages_summary_dict, create_conv_stage_and_history_pair
+
+    if mode == "combined":
+        stage_and_reply = await registry.combined_chain(model).ainvoke({'conversation_history': history, 'user_query': user_query})
+        return {"stage": stage_and_reply.stage, "reply": stage_and_reply.reply}
+    stage_and_history_dict = await create_conv_stage_and_history_pair(history, registry.stage_analyzer(model))
+    conv_stage = int(list(stage_and_history_dict.keys())[0])
+    reply = await registry.conversation_chain(model).ainvoke({'conversation_stage': conv_stages_summary_dict[conv_stage],
+                                                              'conversation_history': history,
+                                                              'user_query': user_query})
+    return {"stage": conv_stage, "reply": reply.content}
+
+
+async def replay_dataset(args, conversations, replayed_ids, outputs_path):
+    from utils import ChainRegistry
+
+    transport = None
+    if args.stub_latency is not None:
+        from stub_openai import make_async_transport
+        os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+        transport = make_async_transport(args.stub_latency)
+    registry = ChainRegistry(transport=transport, max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    await registry.start()
+
+    # `turns` bounds the model calls in flight, at most as many conversations are
+    # started so the dataset is streamed rather than loaded
+    turns = asyncio.Semaphore(args.concurrency)
+    counts = {"replayed": 0, "failed": 0}
+
+    async def limited_turn(history, user_query):
+        async with turns:
+            return await replay_turn(registry, args.model, args.mode, history, user_query)
+
+    async def replay_conversation(conversation, outputs):
+        dialogue = conversation["turns"]
+        try:
+            results = await asyncio.gather(*(limited_turn(turn_history(dialogue, index), turn["user_query"])
+                                             for index, turn in enumerate(dialogue)))
+        except Exception as ex:
+            # Not recorded, the next run retries it
+            counts["failed"] += 1
+            print(f"conversation {conversation['id']} failed: {ex}", file=sys.stderr)
+            return
+        outputs.write(json.dumps({"id": conversation["id"], "model": args.model, "mode": args.mode, "turns": results},
+                                 ensure_ascii=False) + "\n")
+        outputs.flush()
+        counts["replayed"] += 1
+
+    pending = set()
+    try:
+        with open(outputs_path, "a") as outputs:
+            for conversation in conversations:
+                if conversation["id"] in replayed_ids:
+                    continue
+                if len(pending) >= args.concurrency:
+                    _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.add(asyncio.create_task(replay_conversation(conversation, outputs)))
+            if pending:
+                await asyncio.wait(pending)
+    finally:
+        await registry.close()
+    return counts
+
+
+_labels = ()
+
+
+def init_scoring_worker(labels):
+    global _labels
+    _labels = labels
+
+
+def predicted_diagnosis(outputs):
+    # The diagnosis named in the final diagnosis stage, otherwise the last one mentioned
+    mentioned = [(output["stage"], mentioned_label(output["reply"], _labels)) for output in outputs]
+    for stage, label in mentioned:
+        if stage == FINAL_DIAGNOSIS_STAGE and label is not None:
+            return label
+    labels = [label for _, label in mentioned if label is not None]
+    return labels[-1] if labels else None
+
+
+def score_conversation(conversation, outputs):
+    dialogue = conversation["turns"]
+    stages = [output["stage"] for output in outputs]
+    compliant_turns = stage_transitions_compliant(stages)
+    return {
+        "id": conversation["id"],
+        "diagnosis": conversation.get("diagnosis"),
+        "predicted_diagnosis": predicted_diagnosis(outputs),
+        "stages": stages,
+        "expected_stages": [turn.get("stage") for turn in dialogue],
+        "bleu": [bleu_score(turn["reference_reply"], output["reply"]) for turn, output in zip(dialogue, outputs)],
+        "rouge_l": [rouge_l_score(turn["reference_reply"], output["reply"]) for turn, output in zip(dialogue, outputs)],
+        "compliant_turns": compliant_turns.tolist(),
+        "compliant": bool(compliant_turns.all()),
+    }
+
+
+def score_batch(batch):
+    return [score_conversation(conversation, outputs) for conversation, outputs in batch]
+
+
+def score_dataset(args, conversations, outputs_path, output_offsets, scored_ids, scores_path, labels):
+    # Conversations are scored in batches on a process pool, with a bounded number of
+    # batches in flight so memory stays flat on large datasets
+    if not output_offsets:
+        return 0
+    workers = args.workers or os.cpu_count() or 1
+    scored = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_scoring_worker, initargs=(labels,)) as pool, \
+            open(outputs_path, "rb") as outputs, open(scores_path, "a") as scores:
+        pending = set()
+
+        def drain(return_when):
+            nonlocal pending, scored
+            done, pending = wait(pending, return_when=return_when)
+            for future in done:
+                for record in future.result():
+                    scores.write(json.dumps(record, ensure_ascii=False) + "\n")
+                    scored += 1
+            scores.flush()
+
+        batch = []
+        for conversation in conversations:
+            if conversation["id"] in scored_ids or conversation["id"] not in output_offsets:
+                continue
+            batch.append((conversation, read_output(outputs, output_offsets.pop(conversation["id"]))))
+            if len(batch) >= args.batch_size:
+                pending.add(pool.submit(score_batch, batch))
+                batch = []
+                if len(pending) >= workers * 2:
+                    drain(FIRST_COMPLETED)
+        if batch:
+            pending.add(pool.submit(score_batch, batch))
+        if pending:
+            drain(ALL_COMPLETED)
+    return scored
+
+
+def read_scores(path):
+    with open(path) as records:
+        return [json.loads(line) for line in records if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset")
+    parser.add_argument("--work-dir", default="evaluation", help="checkpointed outputs and scores")
+    parser.add_argument("--model", default=os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini"))
+    parser.add_argument("--mode", choices=("two_call", "combined"), default=os.getenv("CONVERSATION_MODE", "two_call"))
+    parser.add_argument("--concurrency", type=int, default=8, help="model calls in flight")
+    parser.add_argument("--no-replay", action="store_true", help="only score outputs already in the work dir")
+    parser.add_argument("--stub-latency", type=float, default=None, help="replay against the stub OpenAI transport")
+    parser.add_argument("--workers", type=int, default=None, help="scoring processes, defaults to the CPU count")
+    parser.add_argument("--batch-size", type=int, default=64, help="conversations per scoring task")
+    parser.add_argument("--labels", default=None, help="file of known diagnoses, one per line, added to the dataset ones")
+    parser.add_argument("--limit", type=int, default=None, help="only evaluate the first N conversations")
+    parser.add_argument("--output", default=None, help="write the report as JSON")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    outputs_path = os.path.join(args.work_dir, "outputs.jsonl")
+    scores_path = os.path.join(args.work_dir, "scores.jsonl")
+
+    started = time.perf_counter()
+    replayed_ids = read_jsonl_ids(outputs_path)
+    scored_ids = read_jsonl_ids(scores_path)
+    if not args.no_replay:
+        counts = asyncio.run(replay_dataset(args, iter_conversations(args.dataset, args.limit), replayed_ids, outputs_path))
+        print(f"Replayed {counts['replayed']} conversations ({counts['failed']} failed, "
+              f"{len(replayed_ids)} already replayed) in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        replayed_ids = read_jsonl_ids(outputs_path)
+
+    labels = {conversation["diagnosis"] for conversation in iter_conversations(args.dataset, args.limit) if conversation.get("diagnosis")}
+    if args.labels:
+        with open(args.labels) as labels_file:
+            labels.update(line.strip() for line in labels_file if line.strip())
+    output_offsets = index_outputs(outputs_path, replayed_ids - scored_ids)
+    scored = score_dataset(args, iter_conversations(args.dataset, args.limit), outputs_path, output_offsets, scored_ids,
+                           scores_path, tuple(labels))
+    print(f"Scored {scored} conversations ({len(scored_ids)} already scored)", file=sys.stderr)
+
+    dataset_ids = {conversation["id"] for conversation in iter_conversations(args.dataset, args.limit)}
+    report = aggregate_scores([record for record in read_scores(scores_path) if record["id"] in dataset_ids])
+    report["elapsed_s"] = round(time.perf_counter() - started, 2)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+import httpx
+
+from deadlines import remaining
+from metrics import ADMISSION_REJECTIONS, RATE_LIMITED_CLIENTS, UPSTREAM_IN_FLIGHT, UPSTREAM_QUEUE_DEPTH, UPSTREAM_RETRIES
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    # Raised when a request is turned away, answered with `status_code` and a Retry-After header
+    def __init__(self, status_code: int, retry_after: float, reason: str):
+        super().__init__(f"Request rejected ({reason}), retry after {retry_after:.1f}s")
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class UpstreamLimiter:
+    # Global cap on upstream LLM calls in flight. Callers beyond `max_in_flight` wait in
+    # a queue of at most `max_queue` for up to `max_wait` seconds, anything more is rejected
+    # straight away so clients back off instead of piling up behind a rate-limited upstream.
+
+    def __init__(self, max_in_flight: int = 32, max_queue: int = 64, max_wait: float = 10.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejections = {"queue_full": 0, "queue_timeout": 0}
+
+    def saturated(self) -> bool:
+        return self.waiting >= self.max_queue
+
+    def retry_after(self) -> float:
+        # Rough time for the queue ahead to drain, at least a second
+        return max(1.0, self.waiting / max(1, self.max_in_flight))
+
+    def reject(self, reason: str) -> AdmissionRejected:
+        self.rejections[reason] += 1
+        ADMISSION_REJECTIONS.labels(reason).inc()
+        return AdmissionRejected(503, self.retry_after(), reason)
+
+    async def acquire(self) -> None:
+        if self._semaphore.locked():
+            if self.saturated():
+                raise self.reject("queue_full")
+            self.waiting += 1
+            UPSTREAM_QUEUE_DEPTH.inc()
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                raise self.reject("queue_timeout") from None
+            finally:
+                self.waiting -= 1
+                UPSTREAM_QUEUE_DEPTH.dec()
+        else:
+            await self._semaphore.acquire()
+        self.in_flight += 1
+        UPSTREAM_IN_FLIGHT.inc()
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        UPSTREAM_IN_FLIGHT.dec()
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {"max_in_flight": self.max_in_flight, "max_queue": self.max_queue, "in_flight": self.in_flight,
+                "queue_depth": self.waiting, "rejections": dict(self.rejections)}
+
+
+class ClientRateLimiter:
+    # Token bucket per client: `rate` requests per second on average with bursts of
+    # up to `burst`. Only the `max_clients` most recently seen clients are tracked.
+
+    def __init__(self, rate: float = 1.0, burst: int = 5, max_clients: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        # client -> (tokens, updated_at)
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+        self.rejections = 0
+
+    def check(self, client: str) -> None:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.pop(client, (float(self.burst), now))
+        tokens = min(float(self.burst), tokens + (now - updated_at) * self.rate)
+        if tokens < 1.0:
+            self._buckets[client] = (tokens, now)
+            self.rejections += 1
+            ADMISSION_REJECTIONS.labels("client_rate").inc()
+            raise AdmissionRejected(429, (1.0 - tokens) / self.rate, "client_rate")
+        self._buckets[client] = (tokens - 1.0, now)
+        if len(self._buckets) > self.max_clients:
+            self._buckets.popitem(last=False)
+        RATE_LIMITED_CLIENTS.set(len(self._buckets))
+
+    def stats(self) -> dict:
+        return {"rate": self.rate, "burst": self.burst, "clients": len(self._buckets), "rejections": self.rejections}
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+def retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    try:
+        return float(response.headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+
+class SlotReleasingStream(httpx.AsyncByteStream):
+    # Keeps the upstream slot until a (streamed) response body is read or closed
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    def release(self) -> None:
+        release, self._release = self._release, None
+        if release is not None:
+            release()
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            self.release()
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self.release()
+
+
+class AdmissionTransport(httpx.AsyncBaseTransport):
+    # Wraps the transport of the shared OpenAI client: every upstream request takes a
+    # slot from the UpstreamLimiter, and rate limited or overloaded answers are retried
+    # with jittered exponential backoff while `retry_deadline` seconds have not passed
+    # and the request deadline (deadlines.request_deadline) leaves time for another try.
+    # The OpenAI SDK's own retries are turned off so this is the only retry layer.
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: UpstreamLimiter, retry_deadline: float = 20.0,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0):
+        self.transport = transport
+        self.limiter = limiter
+        self.retry_deadline = retry_deadline
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+    def hand_over(self, response: httpx.Response) -> httpx.Response:
+        # Responses built in memory (e.g. by test transports) are already read and closed
+        if response.is_closed:
+            self.limiter.release()
+        else:
+            response.stream = SlotReleasingStream(response.stream, self.limiter.release)
+        return response
+
+    def backoff(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        # Full jitter, but never earlier than the upstream asked for
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = retry_after_seconds(response) if response is not None else None
+        return max(delay, retry_after or 0.0)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        deadline = time.monotonic() + self.retry_deadline
+        request_left = remaining()
+        if request_left is not None:
+            deadline = min(deadline, time.monotonic() + request_left)
+        attempt = 0
+        while True:
+            await self.limiter.acquire()
+            try:
+                response = await self.transport.handle_async_request(request)
+            except (httpx.ConnectError, httpx.RemoteProtocolError) as ex:
+                self.limiter.release()
+                delay = self.backoff(attempt, None)
+                if time.monotonic() + delay > deadline:
+                    raise
+                UPSTREAM_RETRIES.labels(type(ex).__name__).inc()
+            except BaseException:
+                self.limiter.release()
+                raise
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return self.hand_over(response)
+                delay = self.backoff(attempt, response)
+                if time.monotonic() + delay > deadline:
+                    # Out of time, hand the last answer back to the SDK
+                    return self.hand_over(response)
+                await response.aclose()
+                self.limiter.release()
+                UPSTREAM_RETRIES.labels(str(response.status_code)).inc()
+            logger.warning(f"Retrying upstream {request.method} {request.url.path} in {delay:.2f}s (attempt {attempt + 1})")
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+def find_rejection(error: BaseException) -> Optional[AdmissionRejected]:
+    # The SDK and LangChain wrap transport errors, look through the exception chain. An
+    # upstream rate limit that outlived the retries is passed on to the client as a 503.
+    from openai import RateLimitError
+
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, AdmissionRejected):
+            return error
+        if isinstance(error, RateLimitError):
+            ADMISSION_REJECTIONS.labels("upstream_rate_limit").inc()
+            return AdmissionRejected(503, retry_after_seconds(error.response) or 1.0, "upstream_rate_limit")
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def create_upstream_limiter_from_env() -> Optional[UpstreamLimiter]:
+    if os.getenv("UPSTREAM_MAX_IN_FLIGHT", "32") in ("0", ""):
+        return None
+    return UpstreamLimiter(max_in_flight=int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", "32")),
+                           max_queue=int(os.getenv("UPSTREAM_MAX_QUEUE", "64")),
+                           max_wait=float(os.getenv("UPSTREAM_MAX_WAIT", "10")))
+
+
+def create_client_rate_limiter_from_env() -> Optional[ClientRateLimiter]:
+    rate = float(os.getenv("CLIENT_RATE_LIMIT", "0"))
+    if rate <= 0:
+        return None
+    return ClientRateLimiter(rate=rate, burst=int(os.getenv("CLIENT_RATE_BURST", "5")))
@@ -0,0 +1,77 @@
+# Requests/sec of one /qnaConversation turn before and after the ChainRegistry,
+# using a stubbed OpenAI transport.
+#
+#   python benchmarks/bench_chain_registry.py --requests 200 --concurrency 20 --latency 0.05
+import argparse
+import asyncio
+import os
+import sys
+import time
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+
+from utils import (ChainRegistry, ConversationStageAnalyzer, MedicalConversationChain,  # noqa: E402
+                   create_conv_stage_and_history_pair, conv_stages_summary_dict)
+from stub_openai import make_async_transport, make_sync_transport  # noqa: E402
+
+MODEL = "gpt-4o-mini"
+HISTORY = ["I have a headache", "I'm sorry to hear that. How long have you had it?"]
+
+
+async def turn(stage_analyzer_chain, conversation_chain):
+    stage_and_history_dict = await create_conv_stage_and_history_pair(HISTORY, stage_analyzer_chain)
+    conv_stage = int(list(stage_and_history_dict.keys())[0])
+    await conversation_chain.ainvoke({'conversation_stage': conv_stages_summary_dict[conv_stage],
+                                      'conversation_history': HISTORY, 'user_query': "Since yesterday"})
+
+
+async def before_turn(latency):
+    # Per-request chain construction: blocking /v1/models calls and fresh clients
+    http_client = httpx.Client(transport=make_sync_transport(latency))
+    http_async_client = httpx.AsyncClient(transport=make_async_transport(latency))
+    try:
+        stage_analyzer_chain = ConversationStageAnalyzer.from_openai_llm(MODEL, http_client=http_client, http_async_client=http_async_client)
+        conversation_chain = MedicalConversationChain.from_openai_llm(MODEL, http_client=http_client, http_async_client=http_async_client)
+        await turn(stage_analyzer_chain, conversation_chain)
+    finally:
+        http_client.close()
+        await http_async_client.aclose()
+
+
+async def run(label, make_turn, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await make_turn()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(requests)))
+    elapsed = time.perf_counter() - started
+    print(f"{label:<8} {requests} requests in {elapsed:.2f}s -> {requests / elapsed:.1f} req/s")
+    return requests / elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.05, help="stub upstream latency in seconds")
+    args = parser.parse_args()
+
+    before = await run("before", lambda: before_turn(args.latency), args.requests, args.concurrency)
+
+    registry = ChainRegistry(transport=make_async_transport(args.latency))
+    await registry.start()
+    try:
+        after = await run("after", lambda: turn(registry.stage_analyzer(MODEL), registry.conversation_chain(MODEL)),
+                          args.requests, args.concurrency)
+    finally:
+        await registry.close()
+    print(f"speedup  {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
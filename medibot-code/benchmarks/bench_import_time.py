@@ -0,0 +1,70 @@
+# Measures how long importing the app takes with `python -X importtime` and fails when
+# it is over budget or when a module that should only load at startup (in the lifespan
+# warm-up) or on demand is imported eagerly. Meant to run in CI:
+#
+#   python benchmarks/bench_import_time.py --budget-ms 1500
+#   python benchmarks/bench_import_time.py --module utils --budget-ms 600 --top 20
+import argparse
+import os
+import subprocess
+import sys
+
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Loaded by ChainRegistry.start, the local stage classifier and the tokenizer, not at import
+DEFAULT_FORBIDDEN = ("langchain_openai", "openai", "numpy", "tiktoken", "uvicorn")
+
+
+def import_times(module):
+    # Returns {module: (self_us, cumulative_us, depth)} for one fresh interpreter
+    env = dict(os.environ, OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "sk-bench"))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=APP_DIR, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.setdefault(name.strip(), (int(self_us), int(cumulative_us), depth))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=3, help="the fastest run is reported, the first one warms the disk cache")
+    parser.add_argument("--budget-ms", type=float, default=1500.0)
+    parser.add_argument("--forbid", action="append", default=None, help="module that must not be imported, repeatable")
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+    forbidden = args.forbid if args.forbid is not None else DEFAULT_FORBIDDEN
+
+    runs = [import_times(args.module) for _ in range(args.runs)]
+    best = min(runs, key=lambda times: times[args.module][1])
+    total_ms = best[args.module][1] / 1000
+
+    # Direct dependencies of the module and the slowest modules overall
+    children = sorted(((name, cumulative) for name, (_, cumulative, depth) in best.items() if depth == 1),
+                      key=lambda item: item[1], reverse=True)
+    print(f"import {args.module}: {total_ms:.1f} ms (best of {args.runs}), {len(best)} modules")
+    print("slowest top-level imports:")
+    for name, cumulative in children[:args.top]:
+        print(f"  {cumulative / 1000:9.1f} ms  {name}")
+
+    failures = []
+    if total_ms > args.budget_ms:
+        failures.append(f"import took {total_ms:.1f} ms, budget is {args.budget_ms:.0f} ms")
+    eager = sorted(name for name in forbidden if name in best)
+    if eager:
+        failures.append(f"imported eagerly: {', '.join(eager)}")
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
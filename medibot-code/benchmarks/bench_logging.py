@@ -0,0 +1,81 @@
+# p50/p99 latency of /qnaConversation with synchronous file logging in the request
+# path versus the queue-based JSON logging pipeline, against the stub OpenAI transport.
+# Disk writes are slowed down by --disk-latency to emulate a busy or network disk.
+#
+#   python benchmarks/bench_logging.py --mode sync
+#   python benchmarks/bench_logging.py --mode queue
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+from logging.handlers import RotatingFileHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.update({"OPENAI_API_KEY": "sk-stub", "OPENAI_MODEL_NAME": "gpt-4o-mini", "HISTORY_COMPACTION": "false"})
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from stub_openai import make_async_transport  # noqa: E402
+
+
+def slow_disk(disk_latency):
+    emit = RotatingFileHandler.emit
+
+    def slow_emit(self, record):
+        time.sleep(disk_latency)
+        emit(self, record)
+
+    RotatingFileHandler.emit = slow_emit
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+async def run(args):
+    log_path = os.path.join(tempfile.mkdtemp(), "medibot.log")
+    if args.mode == "sync":
+        # Previous setup: a file handler written from inside the request handlers
+        handler = RotatingFileHandler(log_path)
+        handler.setFormatter(logging.Formatter('%(asctime)s:%(name)s:%(levelname)s:%(message)s:%(funcName)s'))
+        logging.getLogger().addHandler(handler)
+        logging.getLogger().setLevel(logging.INFO)
+        main.configure_logging = lambda: None
+    else:
+        os.environ["LOG_FILE"] = log_path
+
+    app = main.create_app(lambda: main.create_services_from_env(transport=make_async_transport(args.latency)))
+    latencies = []
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async with main.lifespan(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://medibot") as client:
+            async def one(index):
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.post("/qnaConversation", json={"user_query": f"I have a headache {index}",
+                                                                            "medical_history": [f"I have a headache {index}"]})
+                    latencies.append(time.perf_counter() - started)
+                    assert response.status_code == 200, response.text
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(index) for index in range(args.requests)))
+            elapsed = time.perf_counter() - started
+    print(f"{args.mode:<6} {args.requests / elapsed:7.1f} req/s  p50 {percentile(latencies, 0.5) * 1000:7.1f} ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=["sync", "queue"], default="queue")
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=30)
+    parser.add_argument("--latency", type=float, default=0.05, help="stub upstream latency in seconds")
+    parser.add_argument("--disk-latency", type=float, default=0.002, help="added time per log write in seconds")
+    args = parser.parse_args()
+    slow_disk(args.disk_latency)
+    asyncio.run(run(args))
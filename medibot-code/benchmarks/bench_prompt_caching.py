@@ -0,0 +1,253 @@
+# Billed prompt tokens and LLM call latency of the conversation chains with the
+# earlier prompt layout (one message with the instructions around the conversation
+# history) and the current one (static system message first, per-conversation content
+# last), replaying the scripted consultations against the stub OpenAI transport with
+# its simulated prompt prefix caching.
+#
+#   python benchmarks/bench_prompt_caching.py --mode two_call --rounds 3 --prefill-delay 0.0002
+#   python benchmarks/bench_prompt_caching.py --mode combined --min-cached-tokens 512
+#
+# Cached prompt tokens are billed at --cached-price times the normal input price
+# (half price for the gpt-4o models at the time of writing).
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+
+from langchain_core.prompts import ChatPromptTemplate  # noqa: E402
+
+from utils import (CombinedConversationChain, ConversationStageAnalyzer, MedicalConversationChain, StageAndReply,  # noqa: E402
+                   conv_stages_summary_dict, conv_stages_summary_str, create_conv_stage_and_history_pair,
+                   create_openai_chat_llm)
+from stub_openai import PromptCache, StubCounters, make_async_transport  # noqa: E402
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+REPLY = "Hello, I'm Dr. Ali. Could you tell me your name, age, gender and occupation?"
+
+
+# The templates as they were before the system prefix layout, kept to compare against
+LEGACY_STAGE_ANALYZER_PROMPT = """
+        Analyze the conversation history enclosed between the markers '===' to determine the next immediate conversation stage for a patient healthcare conversation. Don't move to next stage unless the all the information asked in previous stage is provided, do not ask so many questions in one response 
+
+        ===
+        conversation history : {conversation_history}
+        ===
+
+        Based on the conversation history, choose the next appropriate conversation stage from the following conversation stages:
+        conversation stages: {conv_stages_summary}. 
+
+        Based on your choice of next appropriate conversation stage, provide a SINGLE DIGIT response between 1 to 8.
+        Your Response MUST always start with a SINGLE DIGIT between 1 to 8 , representing your best guess for the next appropriate conversation stage.
+
+        Instructions for Response Generation:
+        - Your response MUST always start with SINGLE DIGIT Integer, without any additional text.
+        - If there is no conversation history provided, respond with 1.
+        - You can provide Explanation or additional text in your response. But it must be after the SINGLE DIGIT Integer.
+
+        Examples of Valid Responses:
+        Example1 : 3
+        Example2 : 4  \n Explanation : ....
+        Example3 : 2  \n\n Explanation
+
+        Examples of Invalid Responses:
+        Example1 : Three
+        Example2 : 4th Stage
+        Example3 : Stage 5
+        Example4 : Next stage is 6
+        Example4 : Response : 4
+        Example5 : This response indicates that the next appropriate conversation stage is 'Complaint History'
+
+        Response : 
+        """
+
+LEGACY_PHYSICIAN_AGENT_PROMPT = (
+    """
+    You are "Dr. Ali," an AI medical assistant designed to support a General Physician.
+    You are an expert in discussing, diagnosing and addressing a wide range of health concerns, tailored to individuals of all ages and genders.
+    You are also enable to accept images with an external help, so you must respond accordingly if query is related to image.
+    Your primary function is to serve as the initial point of contact for individuals seeking medical advice and diagnosis.
+    You have been contacted by a potential patient who is seeking medical advice and diagnosis.
+
+    Follow below mentioned guidelines to ensure a successful interaction.
+
+    1. **Adapt Responses:** Use the provided conversation_history and current conversation_stage to tailor your responses appropriately you must ask name age gender and occupation at first stage of conversation.
+    2. **Be Concise:** Keep responses short and engaging. ((Ask only one question at a time to guide the conversation)).
+    2. **Stay in Character:** Always respond as the confident doctor, not as a patient. Never talk about your limitations.
+    3. **Show Empathy:** Maintain a professional, empathetic tone, demonstrating care and understanding throughout the conversation.
+    5. **Probe Smartly:** Mimic a doctor's probing process by asking relevant questions to identify symptoms and disease.
+    6. **No Physical Referrals:** ((Don't schedule an appointment with General Physician in response. Also, don't recommend for physical checkup. Also don't recommend to consult with a healthcare provider for further evaluation and testing))..
+    7. **Consider Special Histories:** For females, Collect gynecological and obstetrics history, before making a diagnosis.
+    8. **Suggest Safely:** Provide a final diagnosis and treatment strategy that may include lifestyle changes, home remedies, or over-the-counter medications. Always inquire about drug allergies before suggesting or providing medications.
+    9. **Structured Interaction:** Respond with one message at a time.
+
+    conversation_history: {conversation_history}
+    current conversation_stage: {conversation_stage}
+    user_query : {user_query}
+
+    Generate an appropriate and concise response based on the conversation_history, medical history, current conversation_stage and user_query while adhereing to the guidelines mentioned above. 
+    You must give response in the English.
+    If query is related to patient's general information or medical history, you must respond wisely while keeping conversation_history and current conversation_stage in view.
+
+    Example of Valid Responses:
+    Example1 : I'm sorry to hear that you're experiencing back pain, Mahar. Can you please tell me more about this pain? For instance, how long have you been experiencing it, and does it occur in a specific area or radiate to other parts of your body?
+
+
+    Example of Invalid Responses:
+    Example1 : I'm unable to directly view images.
+    Example2 : I'm unable to directly view images in this chat. As, I assess the image with the assistance of an external tool.
+    Example3 : However, I need to clarify that I'll be relying on an external tool to help me interpret it.
+
+    Response : 
+    """                 
+)
+
+
+LEGACY_COMBINED_PROMPT = (
+    """
+    You are "Dr. Ali," an AI medical assistant designed to support a General Physician.
+    You are an expert in discussing, diagnosing and addressing a wide range of health concerns, tailored to individuals of all ages and genders.
+    You are also enable to accept images with an external help, so you must respond accordingly if query is related to image.
+    You have been contacted by a potential patient who is seeking medical advice and diagnosis.
+
+    First, analyze the conversation history enclosed between the markers '===' to determine the next immediate conversation stage. Don't move to next stage unless the all the information asked in previous stage is provided. If there is no conversation history provided, choose stage 1.
+
+    ===
+    conversation history : {conversation_history}
+    ===
+
+    conversation stages: {conv_stages_summary}
+
+    Then, write your response to the user_query for the chosen conversation stage while following below mentioned guidelines.
+
+    1. **Adapt Responses:** Use the provided conversation_history and chosen conversation stage to tailor your responses appropriately you must ask name age gender and occupation at first stage of conversation.
+    2. **Be Concise:** Keep responses short and engaging. ((Ask only one question at a time to guide the conversation)).
+    3. **Stay in Character:** Always respond as the confident doctor, not as a patient. Never talk about your limitations.
+    4. **Show Empathy:** Maintain a professional, empathetic tone, demonstrating care and understanding throughout the conversation.
+    5. **Probe Smartly:** Mimic a doctor's probing process by asking relevant questions to identify symptoms and disease.
+    6. **No Physical Referrals:** ((Don't schedule an appointment with General Physician in response. Also, don't recommend for physical checkup. Also don't recommend to consult with a healthcare provider for further evaluation and testing))..
+    7. **Consider Special Histories:** For females, Collect gynecological and obstetrics history, before making a diagnosis.
+    8. **Suggest Safely:** Provide a final diagnosis and treatment strategy that may include lifestyle changes, home remedies, or over-the-counter medications. Always inquire about drug allergies before suggesting or providing medications.
+    9. **Structured Interaction:** Respond with one message at a time.
+
+    user_query : {user_query}
+
+    You must give response in the English.
+    Return the number of the chosen conversation stage as `stage` and your response to the patient as `reply`.
+    """
+)
+
+
+def legacy_chains(chat_llm):
+    return {
+        "stage_analyzer": (ChatPromptTemplate.from_template(LEGACY_STAGE_ANALYZER_PROMPT).partial(conv_stages_summary=conv_stages_summary_str)
+                           | chat_llm),
+        "conversation": ChatPromptTemplate.from_template(LEGACY_PHYSICIAN_AGENT_PROMPT) | chat_llm,
+        "combined": (ChatPromptTemplate.from_template(LEGACY_COMBINED_PROMPT).partial(conv_stages_summary=conv_stages_summary_str)
+                     | chat_llm.with_structured_output(StageAndReply, method="json_schema")),
+    }
+
+
+def current_chains(chat_llm):
+    return {
+        "stage_analyzer": ConversationStageAnalyzer.from_chat_llm(chat_llm),
+        "conversation": MedicalConversationChain.from_chat_llm(chat_llm),
+        "combined": CombinedConversationChain.from_chat_llm(chat_llm),
+    }
+
+
+async def timed(latencies, awaitable):
+    started = time.perf_counter()
+    result = await awaitable
+    latencies.append(time.perf_counter() - started)
+    return result
+
+
+async def replay_consultation(chains, mode, messages, latencies):
+    # Every turn sees the earlier patient messages and replies plus its own message
+    history = []
+    for user_query in messages:
+        history.append(user_query)
+        if mode == "combined":
+            await timed(latencies, chains["combined"].ainvoke({'conversation_history': history, 'user_query': user_query}))
+        else:
+            stage_and_history_dict = await timed(latencies, create_conv_stage_and_history_pair(history, chains["stage_analyzer"]))
+            conv_stage = int(list(stage_and_history_dict.keys())[0])
+            await timed(latencies, chains["conversation"].ainvoke({'conversation_stage': conv_stages_summary_dict[conv_stage],
+                                                                   'conversation_history': history, 'user_query': user_query}))
+        history.append(REPLY)
+
+
+async def run_layout(make_chains, consultations, args):
+    counters = StubCounters()
+    transport = make_async_transport(args.latency, counters, PromptCache(min_tokens=args.min_cached_tokens), args.prefill_delay)
+    async with httpx.AsyncClient(transport=transport) as http_async_client:
+        chains = make_chains(create_openai_chat_llm(args.model, http_async_client=http_async_client))
+        semaphore = asyncio.Semaphore(args.concurrency)
+        latencies = []
+
+        async def one(messages):
+            async with semaphore:
+                await replay_consultation(chains, args.mode, messages, latencies)
+
+        for _ in range(args.rounds):
+            await asyncio.gather(*(one(messages) for messages in consultations))
+
+    billed = counters.prompt_tokens - counters.cached_tokens * (1 - args.cached_price)
+    latencies.sort()
+    return {
+        "calls": counters.chat_calls,
+        "prompt_tokens": counters.prompt_tokens,
+        "cached_tokens": counters.cached_tokens,
+        "cache_hit_rate": round(counters.cached_tokens / counters.prompt_tokens, 3) if counters.prompt_tokens else 0.0,
+        "billed_input_tokens": round(billed),
+        "latency_mean_ms": round(statistics.mean(latencies) * 1000, 1),
+        "latency_p95_ms": round(latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] * 1000, 1),
+    }
+
+
+def reduction(before, after):
+    return round(1 - after / before, 3) if before else 0.0
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default=os.path.join(DATA_DIR, "consultations.json"))
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--mode", choices=("two_call", "combined"), default="two_call")
+    parser.add_argument("--rounds", type=int, default=3, help="times the consultations are replayed")
+    parser.add_argument("--concurrency", type=int, default=4, help="consultations replayed at once")
+    parser.add_argument("--latency", type=float, default=0.01, help="stub seconds per call")
+    parser.add_argument("--prefill-delay", type=float, default=0.0002, help="stub seconds per prompt token not cached")
+    parser.add_argument("--min-cached-tokens", type=int, default=1024, help="shortest prompt the stub caches")
+    parser.add_argument("--cached-price", type=float, default=0.5, help="price of a cached prompt token relative to an uncached one")
+    parser.add_argument("--output", default=None, help="write the report as JSON")
+    args = parser.parse_args()
+
+    with open(args.dataset) as dataset:
+        consultations = json.load(dataset)
+
+    legacy = await run_layout(legacy_chains, consultations, args)
+    current = await run_layout(current_chains, consultations, args)
+    report = {
+        "mode": args.mode,
+        "legacy_layout": legacy,
+        "system_prefix_layout": current,
+        "billed_input_tokens_reduction": reduction(legacy["billed_input_tokens"], current["billed_input_tokens"]),
+        "latency_mean_reduction": reduction(legacy["latency_mean_ms"], current["latency_mean_ms"]),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,256 @@
+# Offline load test: starts the stub OpenAI server and MediBot (or uses running ones),
+# drives scripted multi-turn consultations through /qnaConversation at a fixed
+# concurrency and reports throughput, latency percentiles and upstream calls per turn.
+#
+#   python benchmarks/load_test.py --consultations 40 --concurrency 8 --stub-latency lognormal:0.3,0.5
+#   python benchmarks/load_test.py --app-env CONVERSATION_MODE=combined --output combined.json
+#   python benchmarks/load_test.py --stream --stub-token-delay 0.01 --compare combined.json
+#   python benchmarks/load_test.py --target http://127.0.0.1:9595 --stub-url http://127.0.0.1:8099
+#
+# Each consultation is a list of patient messages (benchmarks/data/consultations.json),
+# sent one turn at a time with the growing history, as the Streamlit client does.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCHMARKS_DIR, "..")
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_ready(url, process, timeout=60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode} during startup")
+        try:
+            if httpx.get(url, timeout=1.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} not ready after {timeout} seconds")
+
+
+def start_stub(args):
+    port = free_port()
+    command = [sys.executable, os.path.join(BENCHMARKS_DIR, "stub_openai.py"), "--port", str(port),
+               "--latency", args.stub_latency, "--token-delay", str(args.stub_token_delay),
+               "--error-rate", str(args.stub_error_rate), "--error-status", str(args.stub_error_status)]
+    if args.seed is not None:
+        command += ["--seed", str(args.seed)]
+    process = subprocess.Popen(command)
+    url = f"http://127.0.0.1:{port}"
+    wait_until_ready(f"{url}/stub/stats", process)
+    return process, url
+
+
+def start_app(args, stub_url, log_dir):
+    port = free_port()
+    env = dict(os.environ, OPENAI_BASE_URL=f"{stub_url}/v1", OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "sk-stub"),
+               OPENAI_MODEL_NAME=args.model, LOG_FILE=os.path.join(log_dir, "medibot.{pid}.log"))
+    for item in args.app_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+                                "--workers", str(args.workers), "--log-level", "warning"], cwd=APP_DIR, env=env)
+    url = f"http://127.0.0.1:{port}"
+    wait_until_ready(f"{url}/", process)
+    return process, url
+
+
+def stop(process):
+    if process is not None and process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def run_turn(client, target, user_query, history, stream):
+    # Returns (reply or None, status code, latency, time to first token)
+    body = {"user_query": user_query, "medical_history": history}
+    started = time.perf_counter()
+    if not stream:
+        response = await client.post(f"{target}/qnaConversation", json=body)
+        payload = response.json()
+        reply = payload.get("data") if response.status_code == 200 and payload.get("succeeded") else None
+        latency = time.perf_counter() - started
+        return reply, response.status_code, latency, latency
+    first_token, parts, event, succeeded, status_code = None, [], None, False, None
+    async with client.stream("POST", f"{target}/qnaConversation/stream", json=body) as response:
+        status_code = response.status_code
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+                if event == "token":
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    parts.append(data["content"])
+                elif event == "done":
+                    succeeded = True
+                elif event == "error":
+                    # Errors after the headers were sent carry their status in the event
+                    status_code = data.get("httpStatusCode", status_code)
+    return ("".join(parts) if succeeded else None), status_code, time.perf_counter() - started, first_token
+
+
+async def run_consultation(client, target, script, stream, results):
+    history = []
+    for user_query in script:
+        history.append(user_query)
+        try:
+            reply, status_code, latency, first_token = await run_turn(client, target, user_query, list(history), stream)
+        except httpx.HTTPError as ex:
+            results.append({"ok": False, "status": type(ex).__name__, "latency": None, "first_token": None})
+            return
+        results.append({"ok": reply is not None, "status": status_code, "latency": latency, "first_token": first_token})
+        if reply is None:
+            # The patient would retry or give up, either way the scripted history no longer fits
+            return
+        history.append(reply)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return None
+    return {"mean_ms": round(statistics.mean(latencies) * 1000, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+            "max_ms": round(max(latencies) * 1000, 1)}
+
+
+async def stub_stats(client, stub_url):
+    return (await client.get(f"{stub_url}/stub/stats")).json()
+
+
+async def drive(args, target, stub_url, scripts):
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+        # One untimed consultation so worker startup and first-use setup are not measured
+        await run_consultation(client, target, scripts[0], args.stream, [])
+        await client.post(f"{stub_url}/stub/reset")
+
+        semaphore = asyncio.Semaphore(args.concurrency)
+        results = []
+
+        async def consult(index):
+            async with semaphore:
+                await run_consultation(client, target, scripts[index % len(scripts)], args.stream, results)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(consult(index) for index in range(args.consultations)))
+        elapsed = time.perf_counter() - started
+        upstream = await stub_stats(client, stub_url)
+    return results, elapsed, upstream
+
+
+def build_report(args, results, elapsed, upstream):
+    ok = [result for result in results if result["ok"]]
+    report = {
+        "config": {"consultations": args.consultations, "concurrency": args.concurrency, "workers": args.workers,
+                   "stream": args.stream, "model": args.model, "app_env": args.app_env, "stub_latency": args.stub_latency,
+                   "stub_token_delay": args.stub_token_delay, "stub_error_rate": args.stub_error_rate},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "elapsed_s": round(elapsed, 3),
+        "turns": len(results),
+        "failed_turns": len(results) - len(ok),
+        "status_codes": dict(Counter(str(result["status"]) for result in results)),
+        "turns_per_second": round(len(ok) / elapsed, 2) if elapsed else None,
+        "latency": latency_summary([result["latency"] for result in ok]),
+        "upstream": upstream,
+        "upstream_calls_per_turn": round(upstream["chat_calls"] / len(ok), 3) if ok else None,
+    }
+    if args.stream:
+        report["time_to_first_token"] = latency_summary([result["first_token"] for result in ok if result["first_token"] is not None])
+    return report
+
+
+def compare(report, baseline):
+    # Relative change of the headline numbers against an earlier results file
+    rows = [("turns_per_second", report["turns_per_second"], baseline.get("turns_per_second")),
+            ("upstream_calls_per_turn", report["upstream_calls_per_turn"], baseline.get("upstream_calls_per_turn"))]
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        rows.append((f"latency.{key}", (report["latency"] or {}).get(key), (baseline.get("latency") or {}).get(key)))
+    return {name: {"current": current, "baseline": previous,
+                   "change": round((current - previous) / previous, 3) if current is not None and previous else None}
+            for name, current, previous in rows}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--consultations", type=int, default=20, help="number of scripted consultations to run")
+    parser.add_argument("--concurrency", type=int, default=4, help="consultations in flight at once")
+    parser.add_argument("--scripts", default=os.path.join(BENCHMARKS_DIR, "data", "consultations.json"))
+    parser.add_argument("--stream", action="store_true", help="use /qnaConversation/stream and report time to first token")
+    parser.add_argument("--model", default=os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini"))
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--target", default=None, help="URL of a running MediBot, started here when omitted")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--app-env", action="append", default=[], help="KEY=VALUE for the started app, repeatable")
+    parser.add_argument("--stub-url", default=None, help="URL of a running stub server, started here when omitted")
+    parser.add_argument("--stub-latency", default="lognormal:0.3,0.5")
+    parser.add_argument("--stub-token-delay", type=float, default=0.005)
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    parser.add_argument("--stub-error-status", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default=None, help="write the results as JSON")
+    parser.add_argument("--compare", default=None, help="results JSON of an earlier run to compare with")
+    args = parser.parse_args()
+
+    with open(args.scripts) as scripts_file:
+        scripts = json.load(scripts_file)
+
+    stub_process = app_process = None
+    log_dir = tempfile.mkdtemp(prefix="medibot-load-")
+    try:
+        stub_url = args.stub_url
+        if stub_url is None:
+            stub_process, stub_url = start_stub(args)
+        target = args.target
+        if target is None:
+            app_process, target = start_app(args, stub_url, log_dir)
+        results, elapsed, upstream = asyncio.run(drive(args, target, stub_url, scripts))
+    finally:
+        stop(app_process)
+        stop(stub_process)
+
+    report = build_report(args, results, elapsed, upstream)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            report["comparison"] = compare(report, json.load(baseline_file))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Replays logged turns through the two-call pipeline (stage analyzer, then physician
+# chain) and the combined single-call mode, and reports stage agreement and latency.
+#
+#   python benchmarks/replay_stage_modes.py benchmarks/data/sample_turns.jsonl --model gpt-4o-mini
+#   python benchmarks/replay_stage_modes.py benchmarks/data/sample_turns.jsonl --stub-latency 0.05
+#
+# Each JSONL line holds "user_query", "medical_history" and optionally a labelled "stage".
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from utils import ChainRegistry, conv_stages_summary_dict, create_conv_stage_and_history_pair  # noqa: E402
+from stub_openai import make_async_transport  # noqa: E402
+
+
+async def two_call_turn(registry, model, turn):
+    stage_and_history_dict = await create_conv_stage_and_history_pair(turn["medical_history"], registry.stage_analyzer(model))
+    conv_stage = int(list(stage_and_history_dict.keys())[0])
+    await registry.conversation_chain(model).ainvoke({'conversation_stage': conv_stages_summary_dict[conv_stage],
+                                                      'conversation_history': turn["medical_history"],
+                                                      'user_query': turn["user_query"]})
+    return conv_stage
+
+
+async def combined_turn(registry, model, turn):
+    stage_and_reply = await registry.combined_chain(model).ainvoke({'conversation_history': turn["medical_history"],
+                                                                    'user_query': turn["user_query"]})
+    return stage_and_reply.stage
+
+
+async def timed(run, *args):
+    started = time.perf_counter()
+    try:
+        stage = await run(*args)
+    except Exception as ex:
+        print(f"turn failed: {ex}", file=sys.stderr)
+        stage = None
+    return stage, time.perf_counter() - started
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def latency_summary(latencies):
+    return {"mean_ms": round(statistics.mean(latencies) * 1000, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1)}
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset")
+    parser.add_argument("--model", default=os.getenv("OPENAI_MODEL_NAME", "gpt-4o-mini"))
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--stub-latency", type=float, default=None, help="replay against the stub OpenAI transport")
+    args = parser.parse_args()
+
+    with open(args.dataset) as dataset:
+        turns = [json.loads(line) for line in dataset if line.strip()]
+
+    transport = None
+    if args.stub_latency is not None:
+        os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+        transport = make_async_transport(args.stub_latency)
+    registry = ChainRegistry(transport=transport)
+    await registry.start()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def replay(turn):
+        async with semaphore:
+            return await timed(two_call_turn, registry, args.model, turn), await timed(combined_turn, registry, args.model, turn)
+
+    try:
+        # One untimed warm-up turn per mode so client and schema setup is not counted
+        await two_call_turn(registry, args.model, turns[0])
+        await combined_turn(registry, args.model, turns[0])
+        results = await asyncio.gather(*(replay(turn) for turn in turns))
+    finally:
+        await registry.close()
+
+    two_call = [result[0] for result in results]
+    combined = [result[1] for result in results]
+    compared = [(a[0], b[0]) for a, b in zip(two_call, combined) if a[0] is not None and b[0] is not None]
+    report = {
+        "turns": len(turns),
+        "stage_agreement": round(sum(a == b for a, b in compared) / len(compared), 3) if compared else None,
+        "two_call": latency_summary([latency for _, latency in two_call]),
+        "combined": latency_summary([latency for _, latency in combined]),
+    }
+    labelled = [(turn["stage"], a[0], b[0]) for turn, a, b in zip(turns, two_call, combined) if "stage" in turn]
+    if labelled:
+        report["two_call"]["stage_accuracy"] = round(sum(label == a for label, a, _ in labelled) / len(labelled), 3)
+        report["combined"]["stage_accuracy"] = round(sum(label == b for label, _, b in labelled) / len(labelled), 3)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,305 @@
+# Stand-in for the OpenAI endpoints used by MediBot so benchmarks can run
+# without real tokens. Exposes httpx transports that answer /v1/models and
+# /v1/chat/completions after a configurable artificial latency, and the same
+# endpoints as a local HTTP server for load tests against a running app:
+#
+#   python benchmarks/stub_openai.py --port 8099 --latency lognormal:0.4,0.5 --token-delay 0.01 --error-rate 0.02
+#
+# then start MediBot with OPENAI_BASE_URL=http://127.0.0.1:8099/v1 OPENAI_API_KEY=sk-stub.
+# GET /stub/stats returns the call counters, POST /stub/reset clears them. With
+# --prompt-cache the stub caches prompt prefixes like the OpenAI API does, reports
+# usage.prompt_tokens_details.cached_tokens and only spends --prefill-delay on the
+# prompt tokens that were not cached.
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from collections import OrderedDict
+import httpx
+
+
+STUB_MODELS = ["gpt-4o-mini", "gpt-4o"]
+
+
+def models_payload():
+    return {"object": "list", "data": [{"id": name, "object": "model", "owned_by": "stub"} for name in STUB_MODELS]}
+
+
+def usage_payload(prompt_tokens, content, cached_tokens=None):
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content.split()),
+             "total_tokens": prompt_tokens + len(content.split())}
+    if cached_tokens is not None:
+        usage["prompt_tokens_details"] = {"cached_tokens": cached_tokens}
+    return usage
+
+
+def chat_completion_payload(model, content, prompt_tokens=0, cached_tokens=None):
+    return {
+        "id": "chatcmpl-stub",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "finish_reason": "stop",
+                     "message": {"role": "assistant", "content": content}}],
+        "usage": usage_payload(prompt_tokens, content, cached_tokens),
+    }
+
+
+def iter_chat_completion_chunks(model, content, prompt_tokens=None, cached_tokens=None):
+    # Server-Sent Events of a streamed chat completion, one word per chunk. With
+    # `prompt_tokens` a final usage chunk is sent, as for stream_options.include_usage
+    created = int(time.time())
+    words = content.split(" ")
+    for index, word in enumerate(words):
+        piece = word if index == 0 else " " + word
+        chunk = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                 "choices": [{"index": 0, "delta": {"role": "assistant", "content": piece}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk)}\n\n"
+    final = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+             "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+    yield f"data: {json.dumps(final)}\n\n"
+    if prompt_tokens is not None:
+        usage = {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": created, "model": model,
+                 "choices": [], "usage": usage_payload(prompt_tokens, content, cached_tokens)}
+        yield f"data: {json.dumps(usage)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def chat_completion_chunks(model, content, prompt_tokens=None, cached_tokens=None):
+    return "".join(iter_chat_completion_chunks(model, content, prompt_tokens, cached_tokens)).encode("utf-8")
+
+
+def wants_usage(body):
+    return bool((body.get("stream_options") or {}).get("include_usage"))
+
+
+def chat_response(request: httpx.Request, cached_tokens=None) -> httpx.Response:
+    body = json.loads(request.content or b"{}")
+    model, content = reply_for_body(body)
+    prompt_tokens = prompt_tokens_for_body(body)
+    if body.get("stream"):
+        usage = wants_usage(body)
+        return httpx.Response(200, content=chat_completion_chunks(model, content, prompt_tokens if usage else None,
+                                                                  cached_tokens if usage else None),
+                              headers={"content-type": "text/event-stream"})
+    return httpx.Response(200, json=chat_completion_payload(model, content, prompt_tokens, cached_tokens))
+
+
+def prompt_text(body) -> str:
+    return "".join(str(message.get("content", "")) for message in body.get("messages", []))
+
+
+def prompt_tokens_for_body(body) -> int:
+    # About 4 characters per token
+    return len(prompt_text(body)) // 4
+
+
+class PromptCache:
+    # Automatic prompt caching as the OpenAI API does it: prompts of at least
+    # `min_tokens` are cached in steps of `block_tokens`, and a request is served the
+    # longest cached prefix of its prompt. Messages are compared as text in order, so
+    # anything that changes early in the prompt makes the rest of it a cache miss.
+
+    def __init__(self, min_tokens: int = 1024, block_tokens: int = 128, max_prefixes: int = 100000):
+        self.min_tokens = min_tokens
+        self.block_tokens = block_tokens
+        self.max_prefixes = max_prefixes
+        self._prefixes: "OrderedDict[bytes, None]" = OrderedDict()
+
+    def prefix_digests(self, body):
+        # (prefix tokens, digest) for every cacheable prefix of the prompt
+        text = prompt_text(body)
+        digest = hashlib.sha1()
+        position = 0
+        for tokens in range(self.min_tokens, len(text) // 4 + 1, self.block_tokens):
+            digest.update(text[position:tokens * 4].encode("utf-8"))
+            position = tokens * 4
+            yield tokens, digest.digest()
+
+    def lookup(self, body) -> int:
+        # Cached prompt tokens of the request, its prefixes are cached for the next ones
+        cached_tokens, hit = 0, True
+        for tokens, key in self.prefix_digests(body):
+            if hit and key in self._prefixes:
+                cached_tokens = tokens
+                self._prefixes.move_to_end(key)
+            else:
+                hit = False
+                self._prefixes[key] = None
+        while len(self._prefixes) > self.max_prefixes:
+            self._prefixes.popitem(last=False)
+        return cached_tokens
+
+    def clear(self) -> None:
+        self._prefixes.clear()
+
+
+def reply_for_body(body):
+    prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+    if (body.get("response_format") or {}).get("type") == "json_schema":
+        return body.get("model", "stub"), json.dumps({"stage": 1, "reply": "Hello, I'm Dr. Ali. Could you tell me your name, age, gender and occupation?"})
+    # The stage analyzer prompt asks for a single digit, the physician prompt for text
+    if "SINGLE DIGIT" in prompt:
+        return body.get("model", "stub"), "1"
+    return body.get("model", "stub"), "Hello, I'm Dr. Ali. Could you tell me your name, age, gender and occupation?"
+
+
+class StubCounters:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.models_calls = 0
+        self.chat_calls = 0
+        self.stream_calls = 0
+        self.errors = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def count_prompt(self, body, cached_tokens) -> None:
+        self.prompt_tokens += prompt_tokens_for_body(body)
+        self.cached_tokens += cached_tokens or 0
+
+    def as_dict(self):
+        return {"models_calls": self.models_calls, "chat_calls": self.chat_calls,
+                "stream_calls": self.stream_calls, "errors": self.errors,
+                "prompt_tokens": self.prompt_tokens, "cached_tokens": self.cached_tokens}
+
+
+def make_sync_transport(latency: float = 0.05, counters: StubCounters = None) -> httpx.MockTransport:
+    counters = counters or StubCounters()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        time.sleep(latency)
+        if request.url.path.endswith("/models"):
+            counters.models_calls += 1
+            return httpx.Response(200, json=models_payload())
+        counters.chat_calls += 1
+        return chat_response(request)
+
+    return httpx.MockTransport(handler)
+
+
+def make_async_transport(latency: float = 0.05, counters: StubCounters = None, prompt_cache: PromptCache = None,
+                         prefill_delay: float = 0.0) -> httpx.MockTransport:
+    # `prefill_delay` seconds are added per prompt token not served from `prompt_cache`
+    counters = counters or StubCounters()
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/models"):
+            await asyncio.sleep(latency)
+            counters.models_calls += 1
+            return httpx.Response(200, json=models_payload())
+        body = json.loads(request.content or b"{}")
+        cached_tokens = prompt_cache.lookup(body) if prompt_cache is not None else None
+        await asyncio.sleep(latency + prefill_delay * (prompt_tokens_for_body(body) - (cached_tokens or 0)))
+        counters.chat_calls += 1
+        counters.count_prompt(body, cached_tokens)
+        return chat_response(request, cached_tokens)
+
+    return httpx.MockTransport(handler)
+
+
+def parse_latency(spec: str):
+    # Returns a function sampling a latency in seconds from a distribution spec:
+    #   "0.2" or "constant:0.2", "uniform:0.1,0.5", "normal:mean,stddev",
+    #   "lognormal:median,sigma" (long tail like real LLM APIs)
+    kind, _, params = spec.partition(":")
+    if not params:
+        kind, params = "constant", kind
+    values = [float(value) for value in params.split(",")]
+    if kind == "constant":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(0.0, values[1]) * values[0]
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def create_stub_app(latency=lambda: 0.05, token_delay: float = 0.0, error_rate: float = 0.0, error_status: int = 500,
+                    counters: StubCounters = None, prompt_cache: PromptCache = None, prefill_delay: float = 0.0):
+    # `latency` is sampled before the response (time to first token when streaming),
+    # plus `prefill_delay` per prompt token not served from `prompt_cache`. `token_delay`
+    # is added between streamed chunks and `error_rate` of the chat calls fail with `error_status`
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    counters = counters or StubCounters()
+    app = FastAPI()
+    app.state.counters = counters
+
+    @app.get("/v1/models")
+    async def models():
+        counters.models_calls += 1
+        return models_payload()
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        counters.chat_calls += 1
+        cached_tokens = prompt_cache.lookup(body) if prompt_cache is not None else None
+        await asyncio.sleep(latency() + prefill_delay * (prompt_tokens_for_body(body) - (cached_tokens or 0)))
+        if error_rate and random.random() < error_rate:
+            counters.errors += 1
+            return JSONResponse({"error": {"message": "Injected stub error", "type": "stub_error", "code": error_status}},
+                                status_code=error_status)
+        model, content = reply_for_body(body)
+        prompt_tokens = prompt_tokens_for_body(body)
+        counters.count_prompt(body, cached_tokens)
+        if not body.get("stream"):
+            return chat_completion_payload(model, content, prompt_tokens, cached_tokens)
+        counters.stream_calls += 1
+        usage = wants_usage(body)
+
+        async def chunks():
+            for index, chunk in enumerate(iter_chat_completion_chunks(model, content, prompt_tokens if usage else None,
+                                                                      cached_tokens if usage else None)):
+                if index and token_delay:
+                    await asyncio.sleep(token_delay)
+                yield chunk
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    @app.get("/stub/stats")
+    async def stats():
+        return counters.as_dict()
+
+    @app.post("/stub/reset")
+    async def reset():
+        counters.reset()
+        if prompt_cache is not None:
+            prompt_cache.clear()
+        return counters.as_dict()
+
+    return app
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", default="constant:0.05", help="e.g. 0.2, uniform:0.1,0.5, lognormal:0.4,0.5")
+    parser.add_argument("--token-delay", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of chat calls that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--prompt-cache", action="store_true", help="simulate the provider's prompt prefix caching")
+    parser.add_argument("--prefill-delay", type=float, default=0.0, help="seconds per prompt token that is not cached")
+    args = parser.parse_args()
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    app = create_stub_app(parse_latency(args.latency), args.token_delay, args.error_rate, args.error_status,
+                          prompt_cache=PromptCache() if args.prompt_cache else None, prefill_delay=args.prefill_delay)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
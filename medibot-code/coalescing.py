@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+import threading
+from typing import Awaitable, Callable, Dict, Optional
+
+from deadlines import check_deadline, with_deadline
+from metrics import COALESCE_IN_FLIGHT, COALESCE_RUNS, COALESCED_REQUESTS
+
+
+logger = logging.getLogger(__name__)
+
+
+class LeaderCancelled(Exception):
+    # Set on the shared future when the request running the pipeline is cancelled, the
+    # requests waiting on it then run the pipeline themselves
+    pass
+
+
+class SharedFlightStore:
+    # SQLite file shared by every worker on the host. A worker claims a key before running
+    # its pipeline, workers that find the key claimed poll until the result is stored and
+    # answer with it. The result is kept `result_ttl` seconds so retries sent right after
+    # the first answer are deduplicated too, a claim is given up after `claim_ttl` seconds
+    # in case its worker died.
+
+    def __init__(self, path: str = 'medibot_single_flight.db', claim_ttl: float = 60.0, result_ttl: float = 10.0,
+                 poll_interval: float = 0.05, prune_interval: float = 60.0):
+        self.path = path
+        self.claim_ttl = claim_ttl
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.prune_interval = prune_interval
+        self.owner = uuid.uuid4().hex
+        self.coalesced = 0
+        self._last_prune = 0.0
+        self._local = threading.local()
+        connection = self._connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS flights ("
+                           "key TEXT PRIMARY KEY, owner TEXT NOT NULL, result TEXT, expires_at REAL NOT NULL)")
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def _claim(self, key: str) -> tuple:
+        # ("done", result), ("busy", None) while another worker runs it, or ("claimed", None)
+        now = time.time()
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT result, expires_at FROM flights WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] >= now:
+                return ("done", json.loads(row[0])) if row[0] is not None else ("busy", None)
+            connection.execute("INSERT OR REPLACE INTO flights VALUES (?, ?, NULL, ?)", (key, self.owner, now + self.claim_ttl))
+            return "claimed", None
+        finally:
+            connection.execute("COMMIT")
+
+    def _release(self, key: str, result) -> None:
+        # Stores the result of a claimed key, or drops the claim when the pipeline failed
+        now = time.time()
+        connection = self._connect()
+        if result is None:
+            connection.execute("DELETE FROM flights WHERE key = ? AND owner = ?", (key, self.owner))
+        else:
+            connection.execute("UPDATE flights SET result = ?, expires_at = ? WHERE key = ? AND owner = ?",
+                               (json.dumps(result), now + self.result_ttl, key, self.owner))
+        if now - self._last_prune >= self.prune_interval:
+            self._last_prune = now
+            connection.execute("DELETE FROM flights WHERE expires_at < ?", (now,))
+
+    async def run(self, key: str, generate: Callable[[], Awaitable]):
+        while True:
+            state, result = await asyncio.to_thread(self._claim, key)
+            if state == "done":
+                self.coalesced += 1
+                COALESCED_REQUESTS.labels("shared").inc()
+                return result
+            if state == "claimed":
+                break
+            check_deadline("coalesced_request")
+            await asyncio.sleep(self.poll_interval)
+        try:
+            result = await generate()
+        except BaseException:
+            await asyncio.to_thread(self._release, key, None)
+            raise
+        await asyncio.to_thread(self._release, key, result)
+        return result
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one run of `generate`: the first caller
+    # runs it and the others wait for its result (or its exception). With a `store`
+    # the key is also claimed across workers. Results must be JSON serializable then.
+
+    def __init__(self, store: Optional[SharedFlightStore] = None):
+        self.store = store
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._in_flight), "leaders": self.leaders, "coalesced": self.coalesced,
+                "shared_store": self.store is not None,
+                "shared_coalesced": self.store.coalesced if self.store is not None else 0}
+
+    async def run(self, key: str, generate: Callable[[], Awaitable]):
+        counted = False
+        while key in self._in_flight:
+            if not counted:
+                counted = True
+                self.coalesced += 1
+                COALESCED_REQUESTS.labels("in_process").inc()
+            try:
+                # Shielded so a waiter running out of time does not cancel the shared run
+                return await with_deadline(asyncio.shield(self._in_flight[key]), "coalesced_request")
+            except LeaderCancelled:
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self.leaders += 1
+        COALESCE_RUNS.inc()
+        COALESCE_IN_FLIGHT.inc()
+        try:
+            result = await (self.store.run(key, generate) if self.store is not None else generate())
+        except asyncio.CancelledError:
+            future.set_exception(LeaderCancelled())
+            raise
+        except BaseException as ex:
+            future.set_exception(ex)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._in_flight[key]
+            COALESCE_IN_FLIGHT.dec()
+            # Nobody may be waiting, mark the exception as retrieved
+            if future.done() and not future.cancelled():
+                future.exception()
+
+
+def create_single_flight_from_env() -> Optional[SingleFlight]:
+    if os.getenv("COALESCE_REQUESTS", "true").lower() not in ("1", "true", "yes"):
+        return None
+    path = os.getenv("COALESCE_STORE_PATH", "")
+    if not path:
+        return SingleFlight()
+    return SingleFlight(SharedFlightStore(path=path, claim_ttl=float(os.getenv("COALESCE_CLAIM_TTL", "60")),
+                                          result_ttl=float(os.getenv("COALESCE_RESULT_TTL", "10"))))
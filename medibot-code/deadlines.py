@@ -0,0 +1,64 @@
+import time
+import asyncio
+import contextvars
+from typing import AsyncIterator, Awaitable, Optional
+
+from metrics import DEADLINE_EXCEEDED
+
+
+# Absolute time.monotonic() by which the current request must be answered, set by the
+# middleware and read by every LLM call made for the request (and by the upstream retries)
+request_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def start_deadline(seconds: Optional[float]) -> Optional[float]:
+    deadline = time.monotonic() + seconds if seconds else None
+    request_deadline.set(deadline)
+    return deadline
+
+
+def remaining() -> Optional[float]:
+    # Seconds left for the current request, None when it has no deadline
+    deadline = request_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def check_deadline(what: str) -> Optional[float]:
+    left = remaining()
+    if left is not None and left <= 0:
+        DEADLINE_EXCEEDED.labels(what).inc()
+        raise DeadlineExceeded(f"Request deadline exceeded before {what}")
+    return left
+
+
+async def with_deadline(awaitable: Awaitable, what: str):
+    # Cancels `awaitable` (and the upstream HTTP request under it) once the deadline passes
+    try:
+        left = check_deadline(what)
+    except DeadlineExceeded:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise
+    if left is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        DEADLINE_EXCEEDED.labels(what).inc()
+        raise DeadlineExceeded(f"Request deadline exceeded during {what}") from None
+
+
+async def iterate_with_deadline(stream: AsyncIterator, what: str):
+    try:
+        while True:
+            try:
+                chunk = await with_deadline(stream.__anext__(), what)
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        await stream.aclose()
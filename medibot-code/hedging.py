@@ -0,0 +1,137 @@
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Callable, Optional
+
+from deadlines import DeadlineExceeded, remaining
+from metrics import DEADLINE_EXCEEDED, LLM_HEDGE_DELAY, LLM_HEDGES
+
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+async def first_chunk(stream: AsyncIterator):
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+
+async def discard(task: asyncio.Task, stream: AsyncIterator) -> None:
+    # Cancelling the pending read aborts the upstream request, then the stream can be closed
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    await stream.aclose()
+
+
+class Hedger:
+    # Hedged streaming LLM calls: when the first chunk has not arrived after the
+    # `percentile` of recently observed time-to-first-chunk, a duplicate request is sent
+    # and the stream that answers first is kept, the other one is cancelled. At most
+    # `max_hedge_rate` of the calls are hedged, which caps the extra upstream cost. Every
+    # call is counted in medibot_llm_hedges: not_hedged, over_budget, primary_won or backup_won.
+
+    def __init__(self, percentile: float = 95.0, max_hedge_rate: float = 0.1, window: int = 500, min_samples: int = 20,
+                 initial_delay: float = 2.0, min_delay: float = 0.05):
+        self.percentile = percentile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self._first_chunk_seconds = deque(maxlen=window)
+        self.calls = 0
+        self.hedged = 0
+        self.backup_wins = 0
+        self.over_budget = 0
+
+    def hedge_delay(self) -> float:
+        if len(self._first_chunk_seconds) < self.min_samples:
+            return self.initial_delay
+        samples = sorted(self._first_chunk_seconds)
+        return max(self.min_delay, samples[min(len(samples) - 1, int(len(samples) * self.percentile / 100))])
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "hedged": self.hedged, "backup_wins": self.backup_wins, "over_budget": self.over_budget,
+                "hedge_rate": round(self.hedged / self.calls, 4) if self.calls else 0.0,
+                "max_hedge_rate": self.max_hedge_rate, "hedge_delay_ms": round(self.hedge_delay() * 1000, 1)}
+
+    async def _wait(self, tasks: set, timeout: Optional[float] = None) -> set:
+        left = remaining()
+        if left is not None:
+            timeout = left if timeout is None else min(timeout, left)
+        done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not done and left is not None and remaining() <= 0:
+            DEADLINE_EXCEEDED.labels("hedged_call").inc()
+            raise DeadlineExceeded("Request deadline exceeded while waiting for the first chunk")
+        return done
+
+    async def astream(self, make_stream: Callable[[], AsyncIterator]):
+        self.calls += 1
+        started = time.monotonic()
+        primary = make_stream()
+        # stream -> task reading its first chunk
+        pending = {primary: asyncio.create_task(first_chunk(primary))}
+        hedged, winner, chunk = False, None, None
+        try:
+            hedge_delay = self.hedge_delay()
+            LLM_HEDGE_DELAY.set(hedge_delay)
+            done = await self._wait(set(pending.values()), hedge_delay)
+            if done:
+                LLM_HEDGES.labels("not_hedged").inc()
+            elif self.hedged < self.max_hedge_rate * self.calls:
+                hedged = True
+                self.hedged += 1
+                backup = make_stream()
+                pending[backup] = asyncio.create_task(first_chunk(backup))
+                logger.info(f"No first chunk after {time.monotonic() - started:.2f}s, hedging the LLM call")
+            else:
+                self.over_budget += 1
+                LLM_HEDGES.labels("over_budget").inc()
+            while winner is None:
+                done = done or await self._wait(set(pending.values()))
+                for stream, task in list(pending.items()):
+                    if task not in done:
+                        continue
+                    del pending[stream]
+                    if task.exception() is not None:
+                        await stream.aclose()
+                        if pending:
+                            # Keep waiting for the other request
+                            logger.warning(f"Hedged LLM call failed, waiting for the other one: {task.exception()}")
+                            continue
+                    winner, chunk = stream, task.result()
+                    break
+                done = set()
+            if hedged:
+                won = "primary" if winner is primary else "backup"
+                self.backup_wins += won == "backup"
+                LLM_HEDGES.labels(f"{won}_won").inc()
+            self._first_chunk_seconds.append(time.monotonic() - started)
+        finally:
+            for stream, task in pending.items():
+                await discard(task, stream)
+
+        try:
+            if chunk is _END:
+                return
+            yield chunk
+            async for chunk in winner:
+                yield chunk
+        finally:
+            await winner.aclose()
+
+
+def create_hedger_from_env() -> Optional[Hedger]:
+    if os.getenv("HEDGING", "false").lower() not in ("1", "true", "yes"):
+        return None
+    return Hedger(percentile=float(os.getenv("HEDGE_PERCENTILE", "95")),
+                  max_hedge_rate=float(os.getenv("HEDGE_MAX_RATE", "0.1")),
+                  window=int(os.getenv("HEDGE_WINDOW", "500")),
+                  initial_delay=float(os.getenv("HEDGE_INITIAL_DELAY", "2.0")))
@@ -0,0 +1,204 @@
+import re
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCounter:
+    # Counts tokens locally with tiktoken, falling back to ~4 characters per token when
+    # the encoding cannot be loaded. Per-message counts are cached since the same
+    # messages are counted again on every turn of a conversation.
+
+    def __init__(self, encoding_name: str = 'o200k_base', max_cached: int = 100000):
+        self.encoding_name = encoding_name
+        self.max_cached = max_cached
+        self._encoding = None
+        self._encoding_failed = False
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+
+    def load(self) -> None:
+        # tiktoken may download the encoding on first use, call this at startup
+        self._load_encoding()
+
+    def _load_encoding(self):
+        if self._encoding is None and not self._encoding_failed:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as ex:
+                self._encoding_failed = True
+                logger.warning(f"Could not load tiktoken encoding {self.encoding_name}, estimating tokens: {ex}")
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        cached = self._cache.get(text)
+        if cached is not None:
+            return cached
+        encoding = self._load_encoding()
+        tokens = len(encoding.encode(text)) if encoding is not None else (len(text) + 3) // 4
+        self._cache[text] = tokens
+        if len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages: List[str]) -> int:
+        # Each list item also costs its quotes and separator once interpolated in the prompt
+        return sum(self.count(message) + 2 for message in messages)
+
+
+SUMMARY_FIELDS = ('patient_demographics', 'primary_symptoms', 'duration_progression', 'allergies', 'other_notes',
+                  'questions_asked', 'assessment_given')
+
+# Checked in order, the first field whose pattern matches is used. Words are matched
+# with their inflections and compounds ("headaches", "stomach-ache", "started").
+FIELD_PATTERNS = {
+    'allergies': re.compile(r"allerg", re.I),
+    'patient_demographics': re.compile(r"\b(my name|names?|aged?|gender|occupation|job|profession|male|female|years? old"
+                                       r"|work(s|ed|ing)? (as|at|in)|i('m| am) an? )\b", re.I),
+    'duration_progression': re.compile(r"\b(how long|since|ago|yesterday|last (night|week|month|year)"
+                                       r"|for (a|about|around|over|the past|\d+)\b|(\d+|a|one|two|three|few|several|couple of) "
+                                       r"(hours?|days?|weeks?|months?|years?)|start(s|ed|ing)?|beg[ia]n|worse\w*|better"
+                                       r"|improv\w*|progress\w*|constant\w*|comes? and goes?|on and off)\b", re.I),
+    'primary_symptoms': re.compile(r"\b\w*(ache|pain|sore|hurt|fever|temperature|cough|sneez|nause|vomit|dizz|rash|itch"
+                                   r"|swell|swollen|bleed|tired|fatigue|breath|symptom|problem|complain|bother|feel|bring)\w*\b",
+                                   re.I),
+}
+
+# Doctor replies that give a diagnosis or a treatment, i.e. moved the consultation to a later stage
+ASSESSMENT_PATTERN = re.compile(r"\b(diagnos\w*|likely|probably|consistent with|suggests?|treat\w*|recommend\w*|prescri\w*"
+                                r"|medication|medicine|tablets?|\d+ ?mg|paracetamol|ibuprofen|antihistamine|remed\w*)\b", re.I)
+QUESTION_PATTERN = re.compile(r"[^.!?]*\?")
+
+
+def empty_summary() -> Dict[str, List[str]]:
+    return {field: [] for field in SUMMARY_FIELDS}
+
+
+def classify_patient_message(message: str, question: str) -> str:
+    # The doctor's question usually says what the answer is about, the answer itself is the fallback
+    for text in (question, message):
+        for field, pattern in FIELD_PATTERNS.items():
+            if pattern.search(text):
+                return field
+    return 'other_notes'
+
+
+def add_note(summary: Dict[str, List[str]], field: str, note: str, max_note_chars: int, max_notes: int) -> None:
+    note = note.strip()[:max_note_chars]
+    if note and note not in summary[field]:
+        summary[field].append(note)
+        # The most recent notes win when a field keeps growing
+        del summary[field][:-max_notes]
+
+
+def fold_messages(summary: Dict[str, List[str]], messages: List[str], first_index: int, previous_message: str = "",
+                  max_note_chars: int = 200, max_notes: int = 5) -> None:
+    # A conversation opens with the patient's message and then alternates, so the message at
+    # an even index of the history is from the patient. Patient statements are filed under
+    # the field the exchange is about, from the doctor's replies the diagnoses and treatments
+    # given and the questions already asked are kept.
+    question = previous_message
+    for offset, message in enumerate(messages):
+        if (first_index + offset) % 2 == 0:
+            add_note(summary, classify_patient_message(message, question), message, max_note_chars, max_notes)
+        else:
+            question = message
+            if ASSESSMENT_PATTERN.search(message):
+                add_note(summary, 'assessment_given', message, max_note_chars, max_notes)
+            else:
+                for asked in QUESTION_PATTERN.findall(message):
+                    add_note(summary, 'questions_asked', asked, max_note_chars, max_notes)
+
+
+def render_summary(summary: Dict[str, List[str]]) -> str:
+    parts = [f"{field}: {'; '.join(notes)}" for field, notes in summary.items() if notes]
+    return "Summary of earlier conversation - " + " | ".join(parts)
+
+
+class HistoryCompactor:
+    # Histories over `token_budget` keep the last `keep_turns` turns verbatim and fold older
+    # messages into a structured summary. Summaries are cached by a rolling hash of the folded prefix, so each turn only
+    # folds the messages that newly left the verbatim window. The compacted history is
+    # shrunk further until it fits `token_budget`.
+
+    def __init__(self, token_budget: int = 1500, keep_turns: int = 3, token_counter: Optional[TokenCounter] = None,
+                 max_cached: int = 10000):
+        self.token_budget = token_budget
+        self.keep_messages = max(1, keep_turns * 2)
+        self.token_counter = token_counter or TokenCounter()
+        self.max_cached = max_cached
+        # rolling prefix hash -> (folded message count, summary)
+        self._summaries: "OrderedDict[str, tuple]" = OrderedDict()
+        # rolling hash of the full history -> compacted history
+        self._compacted: "OrderedDict[str, List[str]]" = OrderedDict()
+        self.raw_tokens = 0
+        self.compacted_tokens = 0
+        self.compactions = 0
+
+    def stats(self) -> dict:
+        return {"compactions": self.compactions, "raw_history_tokens": self.raw_tokens,
+                "compacted_history_tokens": self.compacted_tokens}
+
+    @staticmethod
+    def prefix_hashes(history: List[str]) -> List[str]:
+        # prefix_hashes(history)[i] identifies history[:i]
+        hashes = [hashlib.sha1(b"").hexdigest()]
+        for message in history:
+            hashes.append(hashlib.sha1((hashes[-1] + message).encode('utf-8')).hexdigest())
+        return hashes
+
+    def _remember(self, cache: OrderedDict, key: str, value) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > self.max_cached:
+            cache.popitem(last=False)
+
+    def _summary_for(self, history: List[str], boundary: int, hashes: List[str]) -> Dict[str, List[str]]:
+        # Start from the longest already summarised prefix and fold the rest
+        start, summary = 0, empty_summary()
+        for index in range(boundary, 0, -1):
+            cached = self._summaries.get(hashes[index])
+            if cached is not None:
+                start, summary = cached[0], {field: list(notes) for field, notes in cached[1].items()}
+                break
+        if start < boundary:
+            fold_messages(summary, history[start:boundary], start,
+                          previous_message=history[start - 1] if start > 0 else "")
+            self._remember(self._summaries, hashes[boundary], (boundary, summary))
+        return summary
+
+    def compact(self, history: List[str]) -> List[str]:
+        hashes = self.prefix_hashes(history)
+        cached = self._compacted.get(hashes[-1])
+        if cached is not None:
+            return cached
+
+        raw_tokens = self.token_counter.count_messages(history)
+        compacted = list(history)
+        # Histories within the budget are sent as they are
+        if raw_tokens > self.token_budget:
+            boundary = max(0, len(history) - self.keep_messages)
+            while True:
+                summary = self._summary_for(history, boundary, hashes) if boundary else None
+                compacted = ([render_summary(summary)] if summary else []) + list(history[boundary:])
+                # Fold one more message into the summary while over budget, the latest always stays
+                if self.token_counter.count_messages(compacted) <= self.token_budget or boundary >= len(history) - 1:
+                    break
+                boundary += 1
+
+        compacted_tokens = self.token_counter.count_messages(compacted)
+        if compacted_tokens >= raw_tokens:
+            # Short histories can grow once the summary header is added
+            compacted, compacted_tokens = list(history), raw_tokens
+        self.compactions += 1
+        self.raw_tokens += raw_tokens
+        self.compacted_tokens += compacted_tokens
+        if compacted_tokens != raw_tokens:
+            logger.info(f"Compacted conversation history from {raw_tokens} to {compacted_tokens} tokens "
+                        f"({len(history)} messages, {len(compacted)} kept)")
+        self._remember(self._compacted, hashes[-1], compacted)
+        return compacted
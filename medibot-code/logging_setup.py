@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import uuid
+import queue
+import logging
+import contextvars
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+
+# Per-request fields added to every log record: the middleware installs a fresh dict,
+# code handling the request adds to it (e.g. the stage) with set_log_context
+log_context: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar('log_context', default=None)
+
+RECORD_FIELDS = ('request_id', 'stage', 'latency_ms', 'time_to_headers_ms', 'method', 'path', 'status_code')
+
+
+def new_log_context(request_id: Optional[str] = None) -> dict:
+    context = {'request_id': request_id or uuid.uuid4().hex}
+    log_context.set(context)
+    return context
+
+
+def set_log_context(**fields) -> None:
+    context = log_context.get()
+    if context is not None:
+        context.update(fields)
+
+
+class ContextFilter(logging.Filter):
+    # Runs in the logging thread of the caller, before the record is queued
+    def filter(self, record: logging.LogRecord) -> bool:
+        context = log_context.get()
+        if context:
+            for key, value in context.items():
+                if not hasattr(record, key):
+                    setattr(record, key, value)
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'function': record.funcName,
+            'message': record.getMessage(),
+        }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+_listener: Optional[QueueListener] = None
+
+
+def configure_logging(path: Optional[str] = None, max_bytes: Optional[int] = None, backup_count: Optional[int] = None,
+                      level: Optional[str] = None) -> QueueListener:
+    # Request handlers only put records on an in-memory queue, a background thread
+    # formats them as JSON lines and writes them to a size-rotated file. Several
+    # uvicorn workers should each get their own file, e.g. LOG_FILE=medibot.{pid}.log
+    global _listener
+    if _listener is not None:
+        return _listener
+    path = (path or os.getenv('LOG_FILE', 'gppod_medicalGPT.log')).format(pid=os.getpid())
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes or int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+                                       backupCount=backup_count or int(os.getenv('LOG_BACKUP_COUNT', '5')), encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    root.setLevel(level or os.getenv('LOG_LEVEL', 'INFO'))
+    root.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+
+def stop_logging() -> None:
+    # Flushes the queued records, called on application shutdown
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in list(logging.getLogger().handlers):
+        if isinstance(handler, QueueHandler):
+            logging.getLogger().removeHandler(handler)
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
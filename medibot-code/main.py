@@ -2,48 +2,274 @@ import os  # Standard library module for interacting with the operating system
 import logging  # Standard library module for logging
 from dotenv import load_dotenv 
 # For loading environment variables from a .env file
-from fastapi import FastAPI, status, Body
+from fastapi import APIRouter, FastAPI, status, Body, Depends, Request
 # FastAPI components
 from fastapi.middleware.cors import CORSMiddleware  
 # Middleware for handling CORS
-import uvicorn  # ASGI server for running FastAPI applications
-from utils import *  # Custom module 
-from fastapi.responses import JSONResponse # Response classes for FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse, Response # Response classes for FastAPI
 import json  # Standard library module for JSON manipulation
-import requests
 import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Callable, Optional
+
+# Load environment variables from a .env file, before any of them is read
+load_dotenv()
+
+from utils import (ChainRegistry, ConversationBatchQuery, ConversationQuery, LLMStageAnalyzer, SessionMessage,  # noqa: E402
+                   conv_stages_summary_dict, iter_conversation_batch, run_conversation_batch)
+from session_store import create_session_store_from_env  # noqa: E402
+from speculation import SpeculativeScheduler, StageTracker  # noqa: E402
+from history_compactor import HistoryCompactor  # noqa: E402
+from response_cache import cache_key, create_response_cache_from_env  # noqa: E402
+from coalescing import create_single_flight_from_env  # noqa: E402
+from admission import (AdmissionRejected, create_client_rate_limiter_from_env, create_upstream_limiter_from_env,  # noqa: E402
+                       find_rejection)
+from deadlines import DeadlineExceeded, iterate_with_deadline, start_deadline, with_deadline  # noqa: E402
+from hedging import create_hedger_from_env  # noqa: E402
+from logging_setup import configure_logging, new_log_context, set_log_context, stop_logging  # noqa: E402
+from metrics import (TokenUsageCallback, metrics_payload, observe_request, phase, record_phase, record_request_parsed,  # noqa: E402
+                     server_timing_header, start_request_timings)
 
 
 # model name for env
 OPENAI_MODEL_NAME = os.getenv("OPENAI_MODEL_NAME")
 
-# Load environment variables from a .env file
-load_dotenv()
+# "two_call" runs the stage analyzer then the physician chain,
+# "combined" gets both the stage and the reply from one structured-output call
+CONVERSATION_MODE = os.getenv("CONVERSATION_MODE", "two_call")
+
+# Start the physician reply for the previous turn's stage while the stage analyzer runs
+SPECULATIVE_EXECUTION = os.getenv("SPECULATIVE_EXECUTION", "false").lower() in ("1", "true", "yes")
+
+# Seconds every request has to complete, LLM calls still running after it are cancelled (0 disables)
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", "60"))
+
+# Batch endpoint: LLM calls in flight per batch and the deadline of a whole batch request
+# (0 for none, batches are long running by nature). BATCH_MAX_ITEMS is read by utils.
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_REQUEST_DEADLINE = float(os.getenv("BATCH_REQUEST_DEADLINE", "0"))
+
+# The per-client rate limit is keyed on the connection address. Behind a reverse proxy set
+# TRUSTED_CLIENT_HEADER to the header it writes the client address to (e.g. X-Forwarded-For),
+# only do so when clients cannot reach the app without going through the proxy.
+TRUSTED_CLIENT_HEADER = os.getenv("TRUSTED_CLIENT_HEADER", "")
 
-# Configure logging
+# Stage analysis on the hot path: "llm" always calls the stage analyzer chain, "local" uses
+# the classifier from STAGE_CLASSIFIER_PATH and only calls the LLM when it is not confident
+STAGE_ANALYZER = os.getenv("STAGE_ANALYZER", "llm").lower()
+
+# Add a Server-Timing header with the phase durations of each request
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+# Configure logging, records go through a queue to the JSON log file set up in lifespan
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s:%(name)s:%(levelname)s:%(message)s:%(funcName)s')
-file_handler = logging.FileHandler('gppod_medicalGPT.log')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 
-# Initialize FastAPI application
-app = FastAPI()
 
-# Set up CORS middleware to allow requests from specified origins
-origins = ["*"]  
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"]
-)
+class AppServices:
+    # Everything an application holds on to between requests: the chain registry with its
+    # pooled HTTP client, the session store, admission control, caches and counters. Each
+    # app made by create_app builds its own when it starts and closes it when it stops.
+
+    def __init__(self, chain_registry: ChainRegistry, session_store, upstream_limiter=None, client_rate_limiter=None,
+                 history_compactor: Optional[HistoryCompactor] = None, response_cache=None, request_coalescer=None,
+                 hedger=None):
+        self.chain_registry = chain_registry
+        self.session_store = session_store
+        self.upstream_limiter = upstream_limiter
+        self.client_rate_limiter = client_rate_limiter
+        self.history_compactor = history_compactor
+        self.response_cache = response_cache
+        self.request_coalescer = request_coalescer
+        self.hedger = hedger
+        self.llm_stage_analyzer = LLMStageAnalyzer(self.stage_analyzer_chain, compact_history=self.prompt_history)
+        self.stage_analyzer = self.llm_stage_analyzer
+        # Stage of the previous turn, and the scheduler that speculates on it
+        self.stage_tracker = StageTracker()
+        self.speculative_scheduler = SpeculativeScheduler()
+
+    def prompt_history(self, history_list: list) -> list:
+        # History interpolated into the prompts, see HistoryCompactor
+        return self.history_compactor.compact(history_list) if self.history_compactor is not None else list(history_list)
+
+    def stage_analyzer_chain(self):
+        with phase("chain_construction"):
+            return self.chain_registry.stage_analyzer(OPENAI_MODEL_NAME)
+
+    def physician_chain(self):
+        with phase("chain_construction"):
+            return self.chain_registry.conversation_chain(OPENAI_MODEL_NAME)
+
+    async def start(self) -> None:
+        # Validate the model list once, start its background refresh and build the shared chains,
+        # while the tokenizer loads in another thread
+        warm_ups = [self.chain_registry.start(warm_models=[OPENAI_MODEL_NAME])]
+        if self.history_compactor is not None:
+            warm_ups.append(asyncio.to_thread(self.history_compactor.token_counter.load))
+        await asyncio.gather(*warm_ups)
+
+    async def close(self) -> None:
+        await self.chain_registry.close()
+        await self.session_store.close()
+        if self.response_cache is not None:
+            await self.response_cache.close()
+
+
+def create_services_from_env(transport=None) -> AppServices:
+    # `transport` replaces the HTTP transport to the OpenAI API, e.g. the stub of benchmarks/stub_openai.py
+
+    # Admission control: at most UPSTREAM_MAX_IN_FLIGHT upstream LLM calls per process with
+    # UPSTREAM_MAX_QUEUE more waiting, and CLIENT_RATE_LIMIT requests per second per client
+    upstream_limiter = create_upstream_limiter_from_env()
+
+    # Shared model list and chains, built once per app
+    chain_registry = ChainRegistry(models_ttl=float(os.getenv("OPENAI_MODELS_TTL", "3600")), transport=transport,
+                                   callbacks=[TokenUsageCallback()], upstream_limiter=upstream_limiter,
+                                   retry_deadline=float(os.getenv("UPSTREAM_RETRY_DEADLINE", "20")))
+
+    # History interpolated into the prompts: sent as it is up to HISTORY_TOKEN_BUDGET tokens,
+    # above it the last HISTORY_KEEP_TURNS turns verbatim and older turns folded into a summary
+    history_compactor = None
+    if os.getenv("HISTORY_COMPACTION", "true").lower() in ("1", "true", "yes"):
+        history_compactor = HistoryCompactor(token_budget=int(os.getenv("HISTORY_TOKEN_BUDGET", "1500")),
+                                             keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", "3")))
+
+    services = AppServices(
+        chain_registry,
+        # Server side conversation history, selected with SESSION_STORE=memory|sqlite
+        create_session_store_from_env(),
+        upstream_limiter=upstream_limiter,
+        client_rate_limiter=create_client_rate_limiter_from_env(),
+        history_compactor=history_compactor,
+        # Cache of stage analyzer and physician outputs for early stages, RESPONSE_CACHE=off|memory|disk
+        response_cache=create_response_cache_from_env(),
+        # Identical /qnaConversation requests in flight share one pipeline run, across the workers
+        # of the host too when COALESCE_STORE_PATH names a SQLite file (COALESCE_REQUESTS=false disables)
+        request_coalescer=create_single_flight_from_env(),
+        # HEDGING=true sends a second physician request when the first one is slow to start streaming
+        hedger=create_hedger_from_env())
+
+    if STAGE_ANALYZER == "local":
+        # numpy is only needed by the local classifier
+        from stage_classifier import LocalStageAnalyzer, LocalStageClassifier
+        services.stage_analyzer = LocalStageAnalyzer(LocalStageClassifier.load(os.getenv("STAGE_CLASSIFIER_PATH", "stage_classifier.npz")),
+                                                     fallback=services.llm_stage_analyzer,
+                                                     min_confidence=float(os.getenv("STAGE_CLASSIFIER_MIN_CONFIDENCE", "0.6")))
+    return services
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    configure_logging()
+    started = time.perf_counter()
+    # Built here rather than at import, so every app started in the process gets open clients
+    services = app.state.services = app.state.create_services()
+    try:
+        await services.start()
+        logger.info(f"Started in {time.perf_counter() - started:.3f}s")
+        yield
+    finally:
+        await services.close()
+        stop_logging()
+
+
+def get_services(request: Request) -> AppServices:
+    return request.app.state.services
+
+
+# Endpoints, added to the application by create_app
+router = APIRouter()
+
+
+def rejection_response(rejection: AdmissionRejected) -> JSONResponse:
+    message = "Too many requests" if rejection.status_code == status.HTTP_429_TOO_MANY_REQUESTS else "Server is busy"
+    return JSONResponse(content={"succeeded": False, "message": f"{message}, please retry later", "httpStatusCode": rejection.status_code, "retry_after": round(rejection.retry_after, 1)},
+                        status_code=rejection.status_code, headers={"Retry-After": str(max(1, round(rejection.retry_after)))})
+
+
+async def admission_rejected_handler(request: Request, rejection: AdmissionRejected):
+    logger.warning(f"Rejected request: {rejection}")
+    return rejection_response(rejection)
+
+
+def conversation_error_response(e: Exception) -> JSONResponse:
+    rejection = find_rejection(e)
+    if rejection is not None:
+        logger.warning(f"Rejected request: {rejection}")
+        return rejection_response(rejection)
+    if isinstance(e, DeadlineExceeded):
+        logger.error(f"Failed: {e}")
+        return JSONResponse(content={"succeeded": False, "message": "The conversation took too long, please retry", "httpStatusCode": status.HTTP_504_GATEWAY_TIMEOUT}, status_code=status.HTTP_504_GATEWAY_TIMEOUT)
+    # Log critical error if exception occurs during conversation
+    logger.critical(f"Failed: {e}")
+    # Return error response for failed conversation
+    return JSONResponse(content={"succeeded": False, "message": "Failed to complete the conversation", "httpStatusCode": status.HTTP_500_INTERNAL_SERVER_ERROR}, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+def client_address(request: Request) -> str:
+    # Headers sent by the caller are not trusted, they would let a client pick a new
+    # rate limit bucket for every request. A proxy appends the address it saw last.
+    if TRUSTED_CLIENT_HEADER:
+        forwarded = request.headers.get(TRUSTED_CLIENT_HEADER)
+        if forwarded:
+            return forwarded.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+
+async def admit_request(request: Request):
+    # Conversation endpoints only: turn the request away before any work is done when its
+    # client is over its rate or the upstream queue is already full
+    services = get_services(request)
+    if services.client_rate_limiter is not None:
+        services.client_rate_limiter.check(client_address(request))
+    if services.upstream_limiter is not None and services.upstream_limiter.saturated():
+        raise services.upstream_limiter.reject("queue_full")
+
+
+# Streamed bodies are generated after the headers are sent
+STREAMING_MEDIA_TYPES = ("text/event-stream", "application/x-ndjson")
+
+
+def record_request(request: Request, status_code: int, latency: float, **fields) -> None:
+    route = request.scope.get("route")
+    observe_request(route.path if route is not None else "unmatched", status_code, latency)
+    logger.info("Request completed", extra={"method": request.method, "path": request.url.path, "status_code": status_code,
+                                            "latency_ms": round(latency * 1000, 2), **fields})
+
+
+async def record_when_streamed(body_iterator, request: Request, status_code: int, started: float, headers_latency: float):
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        record_request(request, status_code, time.perf_counter() - started,
+                       time_to_headers_ms=round(headers_latency * 1000, 2))
+
+
+async def request_logging_middleware(request: Request, call_next):
+    # Correlation ID for every log line of the request, taken from X-Request-ID when sent
+    context = new_log_context(request.headers.get("X-Request-ID"))
+    timings = start_request_timings()
+    start_deadline(REQUEST_DEADLINE)
+    started = timings["_started"]
+    response = await call_next(request)
+    latency = time.perf_counter() - started
+    response.headers["X-Request-ID"] = context["request_id"]
+    if response.headers.get("content-type", "").split(";")[0] in STREAMING_MEDIA_TYPES:
+        # The request latency is only known once the stream ends, Server-Timing can then
+        # only carry the time to headers, so it is named "headers" instead of "total"
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = server_timing_header({**timings, "headers": latency})
+        response.body_iterator = record_when_streamed(response.body_iterator, request, response.status_code, started, latency)
+        return response
+    if SERVER_TIMING:
+        response.headers["Server-Timing"] = server_timing_header({**timings, "total": latency})
+    record_request(request, response.status_code, latency)
+    return response
 
 
 # Root endpoint
-@app.get("/", response_class=JSONResponse)
+@router.get("/", response_class=JSONResponse)
 async def index() -> JSONResponse:
     try:
         # Log info for entering index endpoint
@@ -58,8 +284,81 @@ async def index() -> JSONResponse:
         return JSONResponse(content={"succeeded": False, "message": "Failed to start the conversation", "httpStatusCode": status.HTTP_500_INTERNAL_SERVER_ERROR}, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@app.post("/qnaConversation", response_class=JSONResponse)
-async def qna_conversation(query: ConversationQuery = Body(...)):
+async def analyze_conversation_stage(services: AppServices, history_list: list) -> int:
+    stage_analyzer = services.stage_analyzer
+    with phase("stage_analysis"):
+        if services.response_cache is not None:
+            conv_stage = await services.response_cache.stage(OPENAI_MODEL_NAME, history_list,
+                                                             lambda: with_deadline(stage_analyzer.analyze(history_list), "stage_analysis"))
+        else:
+            conv_stage = await with_deadline(stage_analyzer.analyze(history_list), "stage_analysis")
+    set_log_context(stage=conv_stage)
+    logger.info(f"Succesfully got conversation stage: {conv_stage}")
+    return conv_stage
+
+
+async def run_combined_conversation_turn(services: AppServices, user_query: str, history_list: list) -> tuple:
+    with phase("chain_construction"):
+        combined_chain = services.chain_registry.combined_chain(OPENAI_MODEL_NAME)
+    with phase("stage_and_reply_generation"):
+        stage_and_reply = await with_deadline(combined_chain.ainvoke({'conversation_history': services.prompt_history(history_list), 'user_query': user_query}),
+                                              "stage_and_reply_generation")
+    set_log_context(stage=stage_and_reply.stage)
+    logger.info(f"Succesfully got conversation stage: {stage_and_reply.stage}")
+    return stage_and_reply.stage, stage_and_reply.reply
+
+
+def physician_inputs(services: AppServices, user_query: str, history_list: list, conv_stage: int) -> dict:
+    return {'conversation_stage': conv_stages_summary_dict[conv_stage], 'conversation_history': services.prompt_history(history_list), 'user_query': user_query}
+
+
+def stream_physician_reply(services: AppServices, user_query: str, history_list: list, conv_stage: int):
+    # Chunks of the physician reply, hedged when enabled and cut off at the request deadline
+    conversation_chain = services.physician_chain()
+    inputs = physician_inputs(services, user_query, history_list, conv_stage)
+    if services.hedger is not None:
+        chunks = services.hedger.astream(lambda: conversation_chain.astream(inputs))
+    else:
+        chunks = conversation_chain.astream(inputs)
+    return iterate_with_deadline(chunks, "reply_generation")
+
+
+async def invoke_physician_chain(services: AppServices, user_query: str, history_list: list, conv_stage: int) -> str:
+    if services.hedger is not None:
+        # Hedging needs the first chunk to tell a slow call apart, so the reply is streamed
+        return "".join([chunk.content async for chunk in stream_physician_reply(services, user_query, history_list, conv_stage)])
+    conversation_chain = services.physician_chain()
+    physician_agent_chain = await with_deadline(conversation_chain.ainvoke(physician_inputs(services, user_query, history_list, conv_stage)),
+                                                "reply_generation")
+    return physician_agent_chain.content
+
+
+async def generate_physician_reply(services: AppServices, user_query: str, history_list: list, conv_stage: int) -> str:
+    with phase("reply_generation"):
+        if services.response_cache is not None:
+            return await services.response_cache.reply(OPENAI_MODEL_NAME, conv_stage, history_list, user_query,
+                                                       lambda: invoke_physician_chain(services, user_query, history_list, conv_stage))
+        return await invoke_physician_chain(services, user_query, history_list, conv_stage)
+
+
+async def run_conversation_turn(services: AppServices, user_query: str, history_list: list) -> tuple:
+    if CONVERSATION_MODE == "combined":
+        conv_stage, reply = await run_combined_conversation_turn(services, user_query, history_list)
+    elif SPECULATIVE_EXECUTION:
+        conv_stage, reply = await services.speculative_scheduler.run(
+            services.stage_tracker.previous_stage(history_list),
+            lambda: analyze_conversation_stage(services, history_list),
+            lambda stage: generate_physician_reply(services, user_query, history_list, stage))
+    else:
+        conv_stage = await analyze_conversation_stage(services, history_list)
+        reply = await generate_physician_reply(services, user_query, history_list, conv_stage)
+    services.stage_tracker.record(history_list, reply, conv_stage)
+    return conv_stage, reply
+
+
+@router.post("/qnaConversation", response_class=JSONResponse, dependencies=[Depends(admit_request)])
+async def qna_conversation(query: ConversationQuery = Body(...), services: AppServices = Depends(get_services)):
+    record_request_parsed()
     try:
         history_list = []
         # Log info for entering qna_conversation endpoint
@@ -68,27 +367,256 @@ async def qna_conversation(query: ConversationQuery = Body(...)):
         user_query = query.user_query
         history_list = query.medical_history
         
-
-        stage_analyzer_chain = ConversationStageAnalyzer.from_openai_llm(llm_name=OPENAI_MODEL_NAME)
-        stage_and_history_dict = await create_conv_stage_and_history_pair(history_list, stage_analyzer_chain)
-        conv_stage = int(list(stage_and_history_dict.keys())[0])
-        logger.info(f"Succesfully got conversation stage: {conv_stage}")
-
-        conversation_chain = MedicalConversationChain.from_openai_llm(llm_name=OPENAI_MODEL_NAME)
-        physician_agent_chain = await conversation_chain.ainvoke({'conversation_stage': conv_stages_summary_dict[conv_stage], 'conversation_history': history_list, 'user_query': user_query})
-        physician_agent_chain = physician_agent_chain.content
+        if services.request_coalescer is not None:
+            key = cache_key(f"turn:{CONVERSATION_MODE}", OPENAI_MODEL_NAME, None, history_list, user_query)
+            _, physician_agent_chain = await services.request_coalescer.run(key, lambda: run_conversation_turn(services, user_query, history_list))
+        else:
+            _, physician_agent_chain = await run_conversation_turn(services, user_query, history_list)
         logger.info("Successfully completed the conversation")
         # Return success response with conversation data
-        return JSONResponse(content={"succeeded": True, "message": "Successfully completed the conversation", "httpStatusCode": status.HTTP_200_OK, "data": physician_agent_chain}, status_code=status.HTTP_200_OK)
+        with phase("serialization"):
+            return JSONResponse(content={"succeeded": True, "message": "Successfully completed the conversation", "httpStatusCode": status.HTTP_200_OK, "data": physician_agent_chain}, status_code=status.HTTP_200_OK)
     except Exception as e:
-        # Log critical error if exception occurs during conversation
-        logger.critical(f"Failed: {e}")
-        # Return error response for failed conversation
-        return JSONResponse(content={"succeeded": False, "message": "Failed to complete the conversation", "httpStatusCode": status.HTTP_500_INTERNAL_SERVER_ERROR}, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        return conversation_error_response(e)
     finally:
         # Log info for exiting qna_conversation endpoint
         logger.info("Exiting qna_conversation endpoint")
 
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def stream_conversation_turn(services: AppServices, user_query: str, history_list: list, session_id: str = None):
+    # Yields the physician reply as Server-Sent Events: one 'token' event per chunk,
+    # then a 'done' event carrying the stage and metadata, or an 'error' event
+    started = time.perf_counter()
+    first_token_ms = None
+    reply_parts = []
+    try:
+        if CONVERSATION_MODE == "combined":
+            # The structured reply is only valid once complete, send it as a single token
+            conv_stage, reply = await run_combined_conversation_turn(services, user_query, history_list)
+            yield sse_event("stage", {"stage": conv_stage})
+            first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+            reply_parts.append(reply)
+            yield sse_event("token", {"content": reply})
+        else:
+            conv_stage = await analyze_conversation_stage(services, history_list)
+            yield sse_event("stage", {"stage": conv_stage})
+
+            response_cache = services.response_cache
+            reply_key = response_cache.reply_key(OPENAI_MODEL_NAME, conv_stage, history_list, user_query) if response_cache is not None else None
+            cached_reply = await response_cache.lookup("reply", reply_key) if reply_key is not None else None
+            if cached_reply is not None:
+                first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                reply_parts.append(cached_reply)
+                yield sse_event("token", {"content": cached_reply})
+            else:
+                reply_started = time.perf_counter()
+                async for chunk in stream_physician_reply(services, user_query, history_list, conv_stage):
+                    if not chunk.content:
+                        continue
+                    if first_token_ms is None:
+                        first_token_ms = round((time.perf_counter() - started) * 1000, 1)
+                    reply_parts.append(chunk.content)
+                    yield sse_event("token", {"content": chunk.content})
+                record_phase("reply_generation", time.perf_counter() - reply_started)
+                if reply_key is not None:
+                    await response_cache.store(reply_key, "".join(reply_parts))
+
+        reply = "".join(reply_parts)
+        services.stage_tracker.record(history_list, reply, conv_stage)
+        if session_id is not None:
+            # The patient message is only stored with a complete reply
+            await services.session_store.append(session_id, user_query, reply)
+        logger.info("Successfully completed the conversation")
+        yield sse_event("done", {"succeeded": True, "stage": conv_stage, "model": OPENAI_MODEL_NAME, "session_id": session_id,
+                                 "time_to_first_token_ms": first_token_ms, "total_ms": round((time.perf_counter() - started) * 1000, 1)})
+    except Exception as e:
+        rejection = find_rejection(e)
+        if rejection is not None:
+            # Headers are already sent, the client reads the status and delay from the event
+            logger.warning(f"Rejected request: {rejection}")
+            yield sse_event("error", {"succeeded": False, "message": "Server is busy, please retry later", "httpStatusCode": rejection.status_code, "retry_after": round(rejection.retry_after, 1)})
+            return
+        if isinstance(e, DeadlineExceeded):
+            logger.error(f"Failed: {e}")
+            yield sse_event("error", {"succeeded": False, "message": "The conversation took too long, please retry", "httpStatusCode": status.HTTP_504_GATEWAY_TIMEOUT})
+            return
+        logger.critical(f"Failed: {e}")
+        yield sse_event("error", {"succeeded": False, "message": "Failed to complete the conversation", "httpStatusCode": status.HTTP_500_INTERNAL_SERVER_ERROR})
+    finally:
+        logger.info("Exiting conversation stream")
+
+
+def sse_response(events) -> StreamingResponse:
+    return StreamingResponse(events, media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.post("/qnaConversation/stream", dependencies=[Depends(admit_request)])
+async def qna_conversation_stream(query: ConversationQuery = Body(...), services: AppServices = Depends(get_services)):
+    record_request_parsed()
+    logger.info("Entering qna_conversation_stream endpoint")
+    return sse_response(stream_conversation_turn(services, query.user_query, query.medical_history))
+
+
+@router.post("/qnaConversation/batch", dependencies=[Depends(admit_request)])
+async def qna_conversation_batch(batch: ConversationBatchQuery = Body(...), stream: bool = False,
+                                 services: AppServices = Depends(get_services)):
+    # Independent turns answered in request order, each with its own "succeeded" flag. With
+    # ?stream=true every result is sent as one NDJSON line as soon as its chunk completes.
+    record_request_parsed()
+    logger.info(f"Entering qna_conversation_batch endpoint with {len(batch.items)} items")
+    start_deadline(BATCH_REQUEST_DEADLINE)
+    options = {"max_concurrency": BATCH_MAX_CONCURRENCY, "mode": CONVERSATION_MODE, "compact_history": services.prompt_history}
+
+    if stream:
+        async def ndjson_lines():
+            try:
+                async for result in iter_conversation_batch(services.chain_registry, OPENAI_MODEL_NAME, batch.items, **options):
+                    yield json.dumps(result) + "\n"
+            except Exception as e:
+                # Lines already sent stand, the last line tells the client the rest is missing
+                logger.critical(f"Failed: {e}")
+                yield json.dumps({"succeeded": False, "message": "Failed to complete the batch", "httpStatusCode": status.HTTP_500_INTERNAL_SERVER_ERROR}) + "\n"
+            finally:
+                logger.info("Exiting qna_conversation_batch endpoint")
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+    try:
+        results = await run_conversation_batch(services.chain_registry, OPENAI_MODEL_NAME, batch.items, **options)
+        failed = sum(not result["succeeded"] for result in results)
+        logger.info(f"Completed batch of {len(results)} items, {failed} failed")
+        with phase("serialization"):
+            return JSONResponse(content={"succeeded": True, "message": f"Completed {len(results) - failed} of {len(results)} conversations", "httpStatusCode": status.HTTP_200_OK, "data": results}, status_code=status.HTTP_200_OK)
+    except Exception as e:
+        return conversation_error_response(e)
+    finally:
+        logger.info("Exiting qna_conversation_batch endpoint")
+
+
+@router.get("/metrics")
+async def prometheus_metrics():
+    # Prometheus text format, aggregated over all workers when PROMETHEUS_MULTIPROC_DIR is set
+    payload, content_type = metrics_payload()
+    return Response(content=payload, media_type=content_type)
+
+
+@router.get("/historyCompaction", response_class=JSONResponse)
+async def history_compaction_stats(services: AppServices = Depends(get_services)):
+    history_compactor = services.history_compactor
+    data = history_compactor.stats() if history_compactor is not None else {}
+    return JSONResponse(content={"succeeded": True, "message": "Conversation history compaction counters", "httpStatusCode": status.HTTP_200_OK, "data": {"enabled": history_compactor is not None, **data}}, status_code=status.HTTP_200_OK)
+
+
+@router.get("/stageAnalyzer", response_class=JSONResponse)
+async def stage_analyzer_stats(services: AppServices = Depends(get_services)):
+    return JSONResponse(content={"succeeded": True, "message": "Stage analyzer counters", "httpStatusCode": status.HTTP_200_OK, "data": {"analyzer": STAGE_ANALYZER, **services.stage_analyzer.stats()}}, status_code=status.HTTP_200_OK)
+
+
+@router.get("/responseCache", response_class=JSONResponse)
+async def response_cache_stats(services: AppServices = Depends(get_services)):
+    response_cache = services.response_cache
+    data = response_cache.stats() if response_cache is not None else {}
+    return JSONResponse(content={"succeeded": True, "message": "Response cache counters", "httpStatusCode": status.HTTP_200_OK, "data": {"enabled": response_cache is not None, **data}}, status_code=status.HTTP_200_OK)
+
+
+@router.get("/speculation", response_class=JSONResponse)
+async def speculation_stats(services: AppServices = Depends(get_services)):
+    return JSONResponse(content={"succeeded": True, "message": "Speculative execution counters", "httpStatusCode": status.HTTP_200_OK, "data": {"enabled": SPECULATIVE_EXECUTION, **services.speculative_scheduler.stats()}}, status_code=status.HTTP_200_OK)
+
+
+def session_not_found_response(session_id: str) -> JSONResponse:
+    return JSONResponse(content={"succeeded": False, "message": f"Session {session_id} not found or expired", "httpStatusCode": status.HTTP_404_NOT_FOUND}, status_code=status.HTTP_404_NOT_FOUND)
+
+
+@router.post("/sessions", response_class=JSONResponse)
+async def create_session(services: AppServices = Depends(get_services)):
+    try:
+        session_id = await services.session_store.create()
+        logger.info(f"Created session {session_id}")
+        return JSONResponse(content={"succeeded": True, "message": "Successfully created the session", "httpStatusCode": status.HTTP_201_CREATED, "data": {"session_id": session_id}}, status_code=status.HTTP_201_CREATED)
+    except Exception as e:
+        logger.critical(f"Failed to create session: {e}")
+        return JSONResponse(content={"succeeded": False, "message": "Failed to create the session", "httpStatusCode": status.HTTP_500_INTERNAL_SERVER_ERROR}, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+@router.get("/sessions/{session_id}", response_class=JSONResponse)
+async def get_session(session_id: str, services: AppServices = Depends(get_services)):
+    history_list = await services.session_store.get(session_id)
+    if history_list is None:
+        return session_not_found_response(session_id)
+    return JSONResponse(content={"succeeded": True, "message": "Successfully fetched the session", "httpStatusCode": status.HTTP_200_OK, "data": {"session_id": session_id, "medical_history": history_list}}, status_code=status.HTTP_200_OK)
+
+
+@router.delete("/sessions/{session_id}", response_class=JSONResponse)
+async def delete_session(session_id: str, services: AppServices = Depends(get_services)):
+    if not await services.session_store.delete(session_id):
+        return session_not_found_response(session_id)
+    return JSONResponse(content={"succeeded": True, "message": "Successfully deleted the session", "httpStatusCode": status.HTTP_200_OK}, status_code=status.HTTP_200_OK)
+
+
+@router.post("/sessions/{session_id}/messages", response_class=JSONResponse, dependencies=[Depends(admit_request)])
+async def session_conversation(session_id: str, message: SessionMessage = Body(...), services: AppServices = Depends(get_services)):
+    record_request_parsed()
+    try:
+        logger.info("Entering session_conversation endpoint")
+        # Only the new message travels over the wire, the history lives in the store
+        history_list = await services.session_store.get(session_id)
+        if history_list is None:
+            return session_not_found_response(session_id)
+        history_list.append(message.user_query)
+
+        _, physician_agent_chain = await run_conversation_turn(services, message.user_query, history_list)
+        # Stored together once the turn succeeded, a failed turn leaves the session as it was
+        await services.session_store.append(session_id, message.user_query, physician_agent_chain)
+        logger.info("Successfully completed the conversation")
+        with phase("serialization"):
+            return JSONResponse(content={"succeeded": True, "message": "Successfully completed the conversation", "httpStatusCode": status.HTTP_200_OK, "data": physician_agent_chain, "session_id": session_id}, status_code=status.HTTP_200_OK)
+    except Exception as e:
+        return conversation_error_response(e)
+    finally:
+        logger.info("Exiting session_conversation endpoint")
+
+
+@router.post("/sessions/{session_id}/messages/stream", dependencies=[Depends(admit_request)])
+async def session_conversation_stream(session_id: str, message: SessionMessage = Body(...),
+                                      services: AppServices = Depends(get_services)):
+    record_request_parsed()
+    logger.info("Entering session_conversation_stream endpoint")
+    history_list = await services.session_store.get(session_id)
+    if history_list is None:
+        return session_not_found_response(session_id)
+    history_list.append(message.user_query)
+    return sse_response(stream_conversation_turn(services, message.user_query, history_list, session_id=session_id))
+
+
+def create_app(create_services: Callable[[], AppServices] = create_services_from_env) -> FastAPI:
+    # Application factory, also usable as `uvicorn --factory main:create_app`. The app's
+    # services are made by `create_services` when it starts, see lifespan.
+    app = FastAPI(lifespan=lifespan)
+    app.state.create_services = create_services
+
+    # Set up CORS middleware to allow requests from specified origins
+    origins = ["*"]  
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"]
+    )
+    app.middleware("http")(request_logging_middleware)
+    app.add_exception_handler(AdmissionRejected, admission_rejected_handler)
+    app.include_router(router)
+    return app
+
+
+# Initialize FastAPI application
+app = create_app()
+
+
 if __name__ == "__main__":
+    import uvicorn  # ASGI server for running FastAPI applications
     uvicorn.run(app, host="127.0.0.1", port=9595)
\ No newline at end of file
@@ -1,5 +1,10 @@
+import os
+import json
+
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Set up page configuration
 st.set_page_config(
@@ -52,83 +57,180 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+API_URL = os.getenv("MEDIBOT_API_URL", "http://127.0.0.1:9595")
+
+# (connect, read) timeouts in seconds, the read timeout is the longest gap between two
+# streamed chunks so it has to cover the server's request deadline (REQUEST_DEADLINE)
+API_TIMEOUT = (float(os.getenv("MEDIBOT_CONNECT_TIMEOUT", "3.05")), float(os.getenv("MEDIBOT_READ_TIMEOUT", "75")))
+
+# Messages drawn in the main pane and history entries per sidebar page, earlier ones
+# are only drawn on request so long consultations stay quick to render
+TRANSCRIPT_WINDOW = int(os.getenv("MEDIBOT_TRANSCRIPT_WINDOW", "20"))
+HISTORY_PAGE_SIZE = int(os.getenv("MEDIBOT_HISTORY_PAGE_SIZE", "10"))
+
+
+# One pooled HTTP session shared by every Streamlit session of this process, so
+# connections to the API are kept alive instead of opened for every message
+@st.cache_resource
+def get_http_session():
+    # Connection failures and requests the server turned away before processing them are
+    # safe to retry, also for POST. With an empty status_forcelist urllib3 only retries a
+    # status when it is 429 or 503 and carries Retry-After, as admission control answers.
+    # Other errors (e.g. a 502 from a proxy) and read errors are not retried, the turn may
+    # already have run and a retry would run it and bill its LLM calls again.
+    retry = Retry(connect=3, read=0, status=3, backoff_factor=0.5, status_forcelist=(),
+                  allowed_methods=None, respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=int(os.getenv("MEDIBOT_HTTP_POOL_SIZE", "32")),
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Create a server side conversation session, the server keeps the history
+def create_conversation_session():
+    response = get_http_session().post(f"{API_URL}/sessions", timeout=API_TIMEOUT)
+    response.raise_for_status()
+    return response.json()["data"]["session_id"]
+
+
+# Yield the token events of a Server-Sent Events response, the final
+# 'done' or 'error' event payload is stored in `result`
+def iter_sse_tokens(response, result):
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            data = json.loads(line[len("data:"):].strip())
+            if event == "token":
+                yield data["content"]
+            elif event in ("done", "error"):
+                result.update(data)
+
+
 # Initialize session state variables
 def initialize_session_state():
     if "messages" not in st.session_state:
         st.session_state.messages = []
     if "medical_history" not in st.session_state:
         st.session_state.medical_history = []
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = None
+    if "transcript_window" not in st.session_state:
+        st.session_state.transcript_window = TRANSCRIPT_WINDOW
+    if "history_page" not in st.session_state:
+        st.session_state.history_page = None
 
 initialize_session_state()
 
-# Sidebar for conversation controls
-with st.sidebar:
-    st.title("Conversation Controls")
-    st.markdown("---")
-    
-    # Display conversation history
+
+# Runs as a button callback, before the script reruns, so no extra st.rerun() is needed
+def start_new_conversation():
+    if st.session_state.session_id is not None:
+        try:
+            get_http_session().delete(f"{API_URL}/sessions/{st.session_state.session_id}", timeout=API_TIMEOUT)
+        except requests.RequestException:
+            pass
+    st.session_state.messages = []
+    st.session_state.medical_history = []
+    st.session_state.session_id = None
+    st.session_state.transcript_window = TRANSCRIPT_WINDOW
+    st.session_state.history_page = None
+
+
+def show_earlier_messages():
+    st.session_state.transcript_window += TRANSCRIPT_WINDOW
+
+
+# Paging through the history only reruns this fragment, not the chat pane
+@st.fragment
+def history_sidebar():
     st.subheader("Conversation History")
-    for msg in st.session_state.medical_history:
+    history = st.session_state.medical_history
+    pages = max(1, -(-len(history) // HISTORY_PAGE_SIZE))
+    # Follow the newest page until the user picks another one
+    page = st.session_state.history_page or pages
+    if pages > 1:
+        page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=min(page, pages), step=1)
+        st.session_state.history_page = None if page == pages else page
+    start = (page - 1) * HISTORY_PAGE_SIZE
+    for msg in history[start:start + HISTORY_PAGE_SIZE]:
         st.text(f"{msg}")
-    
-    st.markdown("---")
-    
-    # New conversation button
-    if st.button("🔄 Start New Conversation", use_container_width=True):
-        st.session_state.messages = []
-        st.session_state.medical_history = []
-        st.rerun()
+
 
 # Main chat interface
 st.title("🏥 MediBOT - Medical Assistant")
 
-# Display chat messages
-for message in st.session_state.messages:
+# Display the latest chat messages, earlier ones on request
+messages = st.session_state.messages
+hidden = max(0, len(messages) - st.session_state.transcript_window)
+if hidden:
+    st.button(f"Show {min(hidden, TRANSCRIPT_WINDOW)} earlier messages ({hidden} hidden)", on_click=show_earlier_messages)
+for message in messages[hidden:]:
     with st.chat_message(message["role"]):
         st.write(message["content"])
 
-# Chat input
+# Chat input. The new turn is drawn below the transcript already on screen and the
+# sidebar is drawn afterwards, so the page is rendered once per message.
 if prompt := st.chat_input("Type your message here..."):
     # Add user message to chat
     st.session_state.messages.append({"role": "user", "content": prompt})
     with st.chat_message("user"):
         st.write(prompt)
     
-    # Update medical history
+    # Update medical history (kept locally for display only)
     st.session_state.medical_history.append(prompt)
     
-    # API request
-    url = "http://127.0.0.1:9595/qnaConversation"
+    # API request, only the new message is sent
     headers = {"Content-Type": "application/json"}
     
     body = {
-        "user_query": prompt,
-        "medical_history": st.session_state.medical_history
+        "user_query": prompt
     }
     
     try:
-        with st.spinner("Thinking..."):
-            response = requests.post(url, headers=headers, json=body)
-            
+        if st.session_state.session_id is None:
+            st.session_state.session_id = create_conversation_session()
+        url = f"{API_URL}/sessions/{st.session_state.session_id}/messages/stream"
+        with get_http_session().post(url, headers=headers, json=body, stream=True, timeout=API_TIMEOUT) as response:
             if response.status_code == 200:
-                data = response.json()
-                if data["succeeded"]:
-                    assistant_response = data["data"]
-                    
+                stream_result = {}
+                # Render tokens as they arrive
+                with st.chat_message("assistant"):
+                    assistant_response = st.write_stream(iter_sse_tokens(response, stream_result))
+                
+                if stream_result.get("succeeded"):
                     # Add assistant response to chat
                     st.session_state.messages.append({"role": "assistant", "content": assistant_response})
-                    with st.chat_message("assistant"):
-                        st.write(assistant_response)
                     
                     # Update medical history with assistant's response
                     st.session_state.medical_history.append(assistant_response)
                 else:
-                    st.error(f"Error: {data['message']}")
+                    st.error(f"Error: {stream_result.get('message', 'Failed to complete the conversation')}")
+            elif response.status_code == 404:
+                st.session_state.session_id = None
+                st.error("Your conversation session has expired. Please start a new conversation.")
+            elif response.status_code in (429, 503):
+                st.error(f"MediBOT is busy right now, please try again in {response.headers.get('Retry-After', 'a few')} seconds.")
             else:
                 st.error(f"Failed to get response from the server. Status code: {response.status_code}")
                 st.error(f"Response: {response.text}")
+    except requests.Timeout:
+        st.error("The server took too long to answer, please try again.")
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")
+
+# Sidebar for conversation controls
+with st.sidebar:
+    st.title("Conversation Controls")
+    st.markdown("---")
     
-    # Force a rerun to update the UI
-    st.rerun()
\ No newline at end of file
+    # Display conversation history
+    history_sidebar()
+    
+    st.markdown("---")
+    
+    # New conversation button
+    st.button("🔄 Start New Conversation", use_container_width=True, on_click=start_new_conversation)
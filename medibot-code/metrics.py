@@ -0,0 +1,119 @@
+import os
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+                               generate_latest, multiprocess)
+
+
+logger = logging.getLogger(__name__)
+
+# With several uvicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty directory before
+# starting the server, every worker then writes its samples there and /metrics aggregates them
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+PHASE_SECONDS = Histogram(
+    "medibot_phase_seconds", "Time spent in each phase of a conversation turn", ["phase"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+REQUEST_SECONDS = Histogram(
+    "medibot_request_seconds", "End to end request latency", ["path", "status_code"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+LLM_TOKENS = Histogram(
+    "medibot_llm_tokens", "Prompt, cached prompt and completion tokens per LLM call", ["chain", "kind"],
+    buckets=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384))
+LLM_CALLS = Counter("medibot_llm_calls", "LLM calls made", ["chain"])
+UPSTREAM_IN_FLIGHT = Gauge("medibot_upstream_in_flight", "Upstream LLM calls in flight", multiprocess_mode="livesum")
+UPSTREAM_QUEUE_DEPTH = Gauge("medibot_upstream_queue_depth", "Calls waiting for an upstream slot", multiprocess_mode="livesum")
+UPSTREAM_RETRIES = Counter("medibot_upstream_retries", "Upstream calls retried", ["reason"])
+ADMISSION_REJECTIONS = Counter("medibot_admission_rejections", "Requests and calls turned away", ["reason"])
+RATE_LIMITED_CLIENTS = Gauge("medibot_rate_limited_clients", "Clients tracked by the per-client rate limit",
+                             multiprocess_mode="livesum")
+LLM_HEDGES = Counter("medibot_llm_hedges", "Outcomes of streamed LLM calls made with hedging enabled", ["outcome"])
+LLM_HEDGE_DELAY = Gauge("medibot_llm_hedge_delay_seconds", "Wait for the first chunk before an LLM call is hedged",
+                        multiprocess_mode="liveall")
+DEADLINE_EXCEEDED = Counter("medibot_deadline_exceeded", "LLM calls cut short by the request deadline", ["call"])
+COALESCED_REQUESTS = Counter("medibot_coalesced_requests", "Requests answered by an identical request in flight", ["scope"])
+COALESCE_RUNS = Counter("medibot_coalesce_runs", "Pipeline runs identical requests could share")
+COALESCE_IN_FLIGHT = Gauge("medibot_coalesce_in_flight", "Pipeline runs in flight that identical requests wait on",
+                           multiprocess_mode="livesum")
+
+# Phase durations of the current request, reported in the Server-Timing header
+request_timings: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar('request_timings', default=None)
+
+
+def start_request_timings() -> dict:
+    timings = {"_started": time.perf_counter()}
+    request_timings.set(timings)
+    return timings
+
+
+def record_phase(name: str, seconds: float) -> None:
+    PHASE_SECONDS.labels(name).observe(seconds)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(name, time.perf_counter() - started)
+
+
+def record_request_parsed() -> None:
+    # Called first thing in a handler: time since the middleware saw the request is
+    # routing, body reading and ConversationQuery validation
+    timings = request_timings.get()
+    if timings is not None:
+        record_phase("parse", time.perf_counter() - timings["_started"])
+
+
+def server_timing_header(timings: dict) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items() if not name.startswith("_"))
+
+
+def observe_request(path: str, status_code: int, seconds: float) -> None:
+    REQUEST_SECONDS.labels(path, str(status_code)).observe(seconds)
+
+
+def metrics_payload() -> tuple:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    # Records the token usage reported by every chat model call, including the prompt
+    # tokens served from the provider's prompt cache, labelled with the chain name the
+    # ChainRegistry puts in the run tags
+
+    def on_llm_end(self, response, *, tags=None, **kwargs) -> None:
+        chain = next((tag for tag in (tags or []) if tag.endswith("Chain") or tag.endswith("Analyzer")), "unknown")
+        LLM_CALLS.labels(chain).inc()
+        try:
+            message = response.generations[0][0].message
+            usage = getattr(message, "usage_metadata", None) or {}
+        except (IndexError, AttributeError):
+            usage = {}
+        if not usage and response.llm_output:
+            token_usage = response.llm_output.get("token_usage") or {}
+            usage = {"input_tokens": token_usage.get("prompt_tokens"), "output_tokens": token_usage.get("completion_tokens"),
+                     "input_token_details": {"cache_read": (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens")}}
+        if usage.get("input_tokens") is not None:
+            LLM_TOKENS.labels(chain, "prompt").observe(usage["input_tokens"])
+            # Prompt tokens served from the provider's prefix cache (billed at a discount), the
+            # cache hit rate is the ratio of the cached_prompt and prompt histogram sums
+            cached_tokens = (usage.get("input_token_details") or {}).get("cache_read") or 0
+            LLM_TOKENS.labels(chain, "cached_prompt").observe(cached_tokens)
+        if usage.get("output_tokens") is not None:
+            LLM_TOKENS.labels(chain, "completion").observe(usage["output_tokens"])
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import time
+import asyncio
+import sqlite3
+import hashlib
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s']")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+GREETINGS = {"hi", "hello", "hey", "hiya", "hi there", "hello there", "hey there", "good morning",
+             "good afternoon", "good evening", "hi doctor", "hello doctor", "hey doctor", "hi dr ali", "hello dr ali"}
+
+
+def normalize_text(text: str) -> str:
+    # Case, punctuation and spacing differences do not change the reply, and every
+    # greeting opens the conversation the same way
+    text = unicodedata.normalize('NFKC', text).lower()
+    text = WHITESPACE_PATTERN.sub(" ", PUNCTUATION_PATTERN.sub(" ", text)).strip()
+    return "<greeting>" if text in GREETINGS else text
+
+
+def cache_key(kind: str, model: str, stage: Optional[int], history: List[str], user_query: str = "") -> str:
+    payload = json.dumps([kind, model, stage, [normalize_text(message) for message in history], normalize_text(user_query)],
+                         ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class InMemoryCacheBackend:
+    # LRU bounded by entry count and total bytes, entries expire after `ttl` seconds
+
+    def __init__(self, ttl: float = 3600.0, max_entries: int = 10000, max_bytes: int = 32 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        # key -> (value, size, expires_at)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self.total_bytes -= size
+
+    async def get(self, key: str):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    async def set(self, key: str, value) -> None:
+        if key in self._entries:
+            self._remove(key)
+        size = len(json.dumps(value).encode('utf-8'))
+        self._entries[key] = (value, size, time.monotonic() + self.ttl)
+        self.total_bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    async def close(self) -> None:
+        pass
+
+
+class DiskCacheBackend:
+    # SQLite file shared by every worker on the host, entries expire after `ttl` seconds
+    # and the least recently used ones are dropped above `max_entries`
+
+    def __init__(self, path: str = 'medibot_response_cache.db', ttl: float = 3600.0, max_entries: int = 100000,
+                 prune_interval: float = 60.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+        self._local = threading.local()
+        connection = self._connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                           "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def _get(self, key: str):
+        now = time.time()
+        connection = self._connect()
+        row = connection.execute("SELECT value FROM responses WHERE key = ? AND expires_at >= ?", (key, now)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE responses SET used_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def _set(self, key: str, value) -> None:
+        now = time.time()
+        connection = self._connect()
+        connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)", (key, json.dumps(value), now + self.ttl, now))
+        if now - self._last_prune >= self.prune_interval:
+            self._last_prune = now
+            connection.execute("DELETE FROM responses WHERE expires_at < ?", (now,))
+            connection.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+                               (self.max_entries,))
+
+    async def get(self, key: str):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key: str, value) -> None:
+        await asyncio.to_thread(self._set, key, value)
+
+    async def close(self) -> None:
+        pass
+
+
+class ResponseCache:
+    # Caches stage analyzer and physician outputs for the early conversation stages in
+    # `cacheable_stages`, where many consultations open with the same few turns
+
+    def __init__(self, backend, cacheable_stages: Iterable[int] = (1,)):
+        self.backend = backend
+        self.cacheable_stages = set(cacheable_stages)
+        self.hits = {"stage": 0, "reply": 0}
+        self.misses = {"stage": 0, "reply": 0}
+
+    def stats(self) -> dict:
+        return {"hits": dict(self.hits), "misses": dict(self.misses), "cacheable_stages": sorted(self.cacheable_stages)}
+
+    async def get_or_generate(self, kind: str, key: str, generate: Callable[[], Awaitable], stage_of: Callable = None):
+        # `stage_of` gives the stage of a generated value, values of later stages are not stored
+        cached = await self.lookup(kind, key)
+        if cached is not None:
+            return cached
+        value = await generate()
+        if stage_of(value) in self.cacheable_stages:
+            await self.backend.set(key, value)
+        return value
+
+    async def stage(self, model: str, history: List[str], analyze: Callable[[], Awaitable[int]]) -> int:
+        return await self.get_or_generate("stage", cache_key("stage", model, None, history), analyze,
+                                          stage_of=lambda stage: stage)
+
+    def reply_key(self, model: str, stage: int, history: List[str], user_query: str) -> Optional[str]:
+        if stage not in self.cacheable_stages:
+            return None
+        return cache_key("reply", model, stage, history, user_query)
+
+    async def lookup(self, kind: str, key: str):
+        value = await self.backend.get(key)
+        if value is not None:
+            self.hits[kind] += 1
+        else:
+            self.misses[kind] += 1
+        return value
+
+    async def store(self, key: str, value) -> None:
+        await self.backend.set(key, value)
+
+    async def reply(self, model: str, stage: int, history: List[str], user_query: str,
+                    generate: Callable[[], Awaitable[str]]) -> str:
+        key = self.reply_key(model, stage, history, user_query)
+        if key is None:
+            return await generate()
+        return await self.get_or_generate("reply", key, generate, stage_of=lambda _: stage)
+
+    async def close(self) -> None:
+        await self.backend.close()
+
+
+def create_response_cache_from_env() -> Optional[ResponseCache]:
+    backend = os.getenv("RESPONSE_CACHE", "off").lower()
+    if backend in ("off", "false", "0", ""):
+        return None
+    ttl = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+    max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+    stages = [int(stage) for stage in os.getenv("RESPONSE_CACHE_STAGES", "1").split(",") if stage.strip()]
+    if backend == "memory":
+        return ResponseCache(InMemoryCacheBackend(ttl=ttl, max_entries=max_entries,
+                                                  max_bytes=int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))),
+                             cacheable_stages=stages)
+    if backend == "disk":
+        return ResponseCache(DiskCacheBackend(path=os.getenv("RESPONSE_CACHE_PATH", "medibot_response_cache.db"),
+                                              ttl=ttl, max_entries=max_entries),
+                             cacheable_stages=stages)
+    raise ValueError(f"Unknown RESPONSE_CACHE backend: {backend}")
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+def history_size(history: List[str]) -> int:
+    return sum(len(message.encode('utf-8')) for message in history)
+
+
+def trim_history(history: List[str], max_session_bytes: Optional[int]) -> List[str]:
+    # Drop the oldest turns (patient message and doctor reply) until the session fits in
+    # its byte budget, so the history still starts with a patient message. The latest
+    # turn is always kept.
+    if max_session_bytes is None:
+        return history
+    size = history_size(history)
+    start = 0
+    while size > max_session_bytes and start + 2 < len(history):
+        size -= len(history[start].encode('utf-8')) + len(history[start + 1].encode('utf-8'))
+        start += 2
+    return history[start:]
+
+
+class SessionStore(ABC):
+    # Keeps the conversation history on the server so clients only send the new message.
+    # Sessions idle for longer than `ttl` seconds are evicted, and each session history
+    # is trimmed from the oldest message to stay under `max_session_bytes`.
+
+    def __init__(self, ttl: float = 3600.0, max_session_bytes: Optional[int] = None):
+        self.ttl = ttl
+        self.max_session_bytes = max_session_bytes
+
+    @staticmethod
+    def new_session_id() -> str:
+        return uuid.uuid4().hex
+
+    @abstractmethod
+    async def create(self) -> str:
+        ...
+
+    @abstractmethod
+    async def get(self, session_id: str) -> Optional[List[str]]:
+        ...
+
+    @abstractmethod
+    async def append(self, session_id: str, *messages: str) -> Optional[List[str]]:
+        ...
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> bool:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    # LRU store for a single worker, bounded by session count and total bytes
+
+    def __init__(self, ttl: float = 3600.0, max_session_bytes: Optional[int] = None,
+                 max_sessions: int = 10000, max_total_bytes: int = 64 * 1024 * 1024):
+        super().__init__(ttl=ttl, max_session_bytes=max_session_bytes)
+        self.max_sessions = max_sessions
+        self.max_total_bytes = max_total_bytes
+        self.total_bytes = 0
+        # session_id -> (history, size, last_access)
+        self._sessions: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._sessions:
+            session_id, (_, size, last_access) = next(iter(self._sessions.items()))
+            expired = now - last_access > self.ttl
+            if not expired and len(self._sessions) <= self.max_sessions and self.total_bytes <= self.max_total_bytes:
+                break
+            del self._sessions[session_id]
+            self.total_bytes -= size
+            logger.info(f"Evicted session {session_id}")
+
+    def _lookup(self, session_id: str) -> Optional[List[str]]:
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        history, size, last_access = entry
+        if time.monotonic() - last_access > self.ttl:
+            del self._sessions[session_id]
+            self.total_bytes -= size
+            return None
+        return history
+
+    def _put(self, session_id: str, history: List[str]) -> None:
+        previous = self._sessions.pop(session_id, None)
+        if previous is not None:
+            self.total_bytes -= previous[1]
+        size = history_size(history)
+        self._sessions[session_id] = (history, size, time.monotonic())
+        self.total_bytes += size
+        self._evict()
+
+    async def create(self) -> str:
+        session_id = self.new_session_id()
+        self._put(session_id, [])
+        return session_id
+
+    async def get(self, session_id: str) -> Optional[List[str]]:
+        history = self._lookup(session_id)
+        if history is None:
+            return None
+        self._put(session_id, history)
+        return list(history)
+
+    async def append(self, session_id: str, *messages: str) -> Optional[List[str]]:
+        history = self._lookup(session_id)
+        if history is None:
+            return None
+        history = trim_history(history + list(messages), self.max_session_bytes)
+        self._put(session_id, history)
+        return list(history)
+
+    async def delete(self, session_id: str) -> bool:
+        entry = self._sessions.pop(session_id, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry[1]
+        return True
+
+
+class SQLiteSessionStore(SessionStore):
+    # File backed store shared by every uvicorn worker on the host. Queries run in a
+    # worker thread so the event loop is never blocked on disk.
+
+    def __init__(self, path: str = 'medibot_sessions.db', ttl: float = 3600.0,
+                 max_session_bytes: Optional[int] = None, purge_interval: float = 60.0):
+        super().__init__(ttl=ttl, max_session_bytes=max_session_bytes)
+        self.path = path
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+        self._local = threading.local()
+        # Every thread's connection, closed together by close()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "session_id TEXT PRIMARY KEY, history TEXT NOT NULL, updated_at REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Only used by the thread that opened it, check_same_thread=False lets close() close it
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _purge(self, connection: sqlite3.Connection, now: float) -> None:
+        if now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        deleted = connection.execute("DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,)).rowcount
+        if deleted:
+            logger.info(f"Evicted {deleted} expired sessions")
+
+    def _create(self) -> str:
+        session_id = self.new_session_id()
+        now = time.time()
+        connection = self._connect()
+        connection.execute("INSERT INTO sessions VALUES (?, ?, ?)", (session_id, "[]", now))
+        self._purge(connection, now)
+        return session_id
+
+    def _get(self, session_id: str) -> Optional[List[str]]:
+        # Reading a session counts as activity, as in the in-memory store
+        now = time.time()
+        connection = self._connect()
+        row = connection.execute(
+            "SELECT history FROM sessions WHERE session_id = ? AND updated_at >= ?",
+            (session_id, now - self.ttl)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (now, session_id))
+        return json.loads(row[0])
+
+    def _append(self, session_id: str, messages: tuple) -> Optional[List[str]]:
+        now = time.time()
+        connection = self._connect()
+        # BEGIN IMMEDIATE serialises concurrent appends from other workers
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT history FROM sessions WHERE session_id = ? AND updated_at >= ?",
+                (session_id, now - self.ttl)).fetchone()
+            if row is None:
+                connection.execute("COMMIT")
+                return None
+            history = trim_history(json.loads(row[0]) + list(messages), self.max_session_bytes)
+            connection.execute("UPDATE sessions SET history = ?, updated_at = ? WHERE session_id = ?",
+                               (json.dumps(history), now, session_id))
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return history
+
+    def _delete(self, session_id: str) -> bool:
+        return self._connect().execute("DELETE FROM sessions WHERE session_id = ?", (session_id,)).rowcount > 0
+
+    async def create(self) -> str:
+        return await asyncio.to_thread(self._create)
+
+    async def get(self, session_id: str) -> Optional[List[str]]:
+        return await asyncio.to_thread(self._get, session_id)
+
+    async def append(self, session_id: str, *messages: str) -> Optional[List[str]]:
+        return await asyncio.to_thread(self._append, session_id, messages)
+
+    async def delete(self, session_id: str) -> bool:
+        return await asyncio.to_thread(self._delete, session_id)
+
+    async def close(self) -> None:
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+
+def create_session_store_from_env() -> SessionStore:
+    backend = os.getenv("SESSION_STORE", "memory").lower()
+    ttl = float(os.getenv("SESSION_TTL", "3600"))
+    max_session_bytes = int(os.getenv("SESSION_MAX_BYTES", "262144"))
+    if backend == "sqlite":
+        return SQLiteSessionStore(path=os.getenv("SESSION_STORE_PATH", "medibot_sessions.db"),
+                                  ttl=ttl, max_session_bytes=max_session_bytes)
+    if backend == "memory":
+        return InMemorySessionStore(ttl=ttl, max_session_bytes=max_session_bytes,
+                                    max_total_bytes=int(os.getenv("SESSION_STORE_MAX_BYTES", str(64 * 1024 * 1024))))
+    raise ValueError(f"Unknown SESSION_STORE backend: {backend}")
@@ -0,0 +1,105 @@
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+def history_fingerprint(history: List[str]) -> str:
+    return hashlib.sha1(json.dumps(history, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class StageTracker:
+    # Remembers the stage chosen for each turn, keyed on the history the next turn will
+    # start from (history + physician reply). Clients append the new user message to
+    # that history, so the previous stage is found again by dropping the last message.
+
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        self._stages: "OrderedDict[str, int]" = OrderedDict()
+
+    def record(self, history_list: List[str], reply: str, stage: int) -> None:
+        key = history_fingerprint(list(history_list) + [reply])
+        self._stages[key] = stage
+        self._stages.move_to_end(key)
+        while len(self._stages) > self.max_entries:
+            self._stages.popitem(last=False)
+
+    def previous_stage(self, history_list: List[str]) -> Optional[int]:
+        if not history_list:
+            return None
+        key = history_fingerprint(list(history_list[:-1]))
+        stage = self._stages.get(key)
+        if stage is not None:
+            self._stages.move_to_end(key)
+        return stage
+
+
+class SpeculativeScheduler:
+    # Starts the physician reply for the previous turn's stage while the stage analyzer
+    # runs. A matching stage keeps the speculative reply, otherwise it is cancelled and
+    # the reply is generated again for the analyzed stage.
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.saved_seconds = 0.0
+        self.wasted_seconds = 0.0
+
+    def stats(self) -> dict:
+        speculated = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "skipped": self.skipped,
+                "hit_rate": round(self.hits / speculated, 4) if speculated else None,
+                "saved_seconds": round(self.saved_seconds, 3), "wasted_seconds": round(self.wasted_seconds, 3)}
+
+    async def run(self, predicted_stage: Optional[int], analyze_stage: Callable[[], Awaitable[int]],
+                  generate_reply: Callable[[int], Awaitable[str]]) -> tuple:
+        if predicted_stage is None:
+            self.skipped += 1
+            conv_stage = await analyze_stage()
+            return conv_stage, await generate_reply(conv_stage)
+
+        reply_seconds = []
+
+        async def timed_reply():
+            reply_started = time.perf_counter()
+            reply = await generate_reply(predicted_stage)
+            reply_seconds.append(time.perf_counter() - reply_started)
+            return reply
+
+        started = time.perf_counter()
+        reply_task = asyncio.create_task(timed_reply())
+        try:
+            conv_stage = await analyze_stage()
+        except BaseException:
+            self._discard(reply_task)
+            raise
+        stage_seconds = time.perf_counter() - started
+
+        if conv_stage == predicted_stage:
+            reply = await reply_task
+            # Sequential execution would have taken stage + reply time, it took the max of both
+            self.hits += 1
+            self.saved_seconds += min(stage_seconds, reply_seconds[0])
+            return conv_stage, reply
+
+        self._discard(reply_task)
+        self.misses += 1
+        self.wasted_seconds += stage_seconds
+        logger.info(f"Speculative stage {predicted_stage} missed, analyzed stage is {conv_stage}")
+        return conv_stage, await generate_reply(conv_stage)
+
+    @staticmethod
+    def _discard(task: asyncio.Task) -> None:
+        if task.done():
+            # Retrieve a failed speculative reply so it is not reported as unhandled
+            if not task.cancelled():
+                task.exception()
+            return
+        task.cancel()
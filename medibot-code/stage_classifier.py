@@ -0,0 +1,100 @@
+import re
+import zlib
+import logging
+from typing import List, Optional
+
+import numpy as np
+
+from utils import StageAnalyzer
+
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+
+
+def stage_features(history: List[str], n_features: int = 2 ** 16, recent_messages: int = 6) -> tuple:
+    # Hashed unigram/bigram counts of the most recent messages, tagged with their distance
+    # from the end of the conversation, plus a bucketed turn count. Returns the feature
+    # indices and their l2 normalised log counts.
+    tokens = [f"turns={min(len(history), 20)}"]
+    recent = history[-recent_messages:]
+    for offset, message in enumerate(reversed(recent)):
+        words = TOKEN_PATTERN.findall(message.lower())
+        # The last user message and the last reply matter most, older ones share a tag
+        tag = str(offset) if offset < 2 else "old"
+        tokens.extend(f"{tag}:{word}" for word in words)
+        tokens.extend(f"{tag}:{first} {second}" for first, second in zip(words, words[1:]))
+    counts = {}
+    for token in tokens:
+        index = zlib.crc32(token.encode('utf-8')) % n_features
+        counts[index] = counts.get(index, 0) + 1
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    values /= np.linalg.norm(values)
+    return indices, values
+
+
+class LocalStageClassifier:
+    # Linear model over hashed n-gram features, trained by train_stage_classifier.py
+
+    def __init__(self, weights: np.ndarray, bias: np.ndarray, classes: np.ndarray, recent_messages: int = 6):
+        if weights.shape[1] == 1 and len(classes) == 2:
+            # A binary model has one score s for the second class, the softmax of [-s/2, s/2]
+            # is its sigmoid
+            weights = np.hstack([-weights / 2, weights / 2])
+            bias = np.concatenate([-bias / 2, bias / 2])
+        self.weights = weights
+        self.bias = bias
+        self.classes = classes
+        self.n_features = weights.shape[0]
+        self.recent_messages = recent_messages
+
+    @classmethod
+    def load(cls, path: str) -> "LocalStageClassifier":
+        model = np.load(path)
+        return cls(model['weights'], model['bias'], model['classes'], int(model['recent_messages']))
+
+    def save(self, path: str) -> None:
+        np.savez(path, weights=self.weights, bias=self.bias, classes=self.classes,
+                 recent_messages=self.recent_messages)
+
+    def predict_proba(self, history: List[str]) -> np.ndarray:
+        indices, values = stage_features(history, self.n_features, self.recent_messages)
+        scores = self.bias + values @ self.weights[indices]
+        scores = np.exp(scores - scores.max())
+        return scores / scores.sum()
+
+    def predict(self, history: List[str]) -> tuple:
+        probabilities = self.predict_proba(history)
+        best = int(probabilities.argmax())
+        return int(self.classes[best]), float(probabilities[best])
+
+
+class LocalStageAnalyzer(StageAnalyzer):
+    # Uses the local classifier when it is confident, otherwise asks the fallback
+    # (normally the LLM stage analyzer)
+
+    def __init__(self, classifier: LocalStageClassifier, fallback: Optional[StageAnalyzer] = None,
+                 min_confidence: float = 0.6):
+        self.classifier = classifier
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.local_decisions = 0
+        self.fallback_decisions = 0
+
+    def stats(self) -> dict:
+        return {"local_decisions": self.local_decisions, "fallback_decisions": self.fallback_decisions}
+
+    async def analyze(self, history: List[str]) -> int:
+        if not history:
+            # Same rule as the stage analyzer prompt
+            self.local_decisions += 1
+            return 1
+        stage, confidence = self.classifier.predict(history)
+        if confidence >= self.min_confidence or self.fallback is None:
+            self.local_decisions += 1
+            return stage
+        self.fallback_decisions += 1
+        logger.info(f"Local stage {stage} confidence {confidence:.2f} below {self.min_confidence}, using fallback")
+        return await self.fallback.analyze(history)
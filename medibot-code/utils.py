@@ -1,30 +1,23 @@
-import json
 import os 
 import logging
-from langchain_core.runnables import Runnable
-from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
-from langchain_openai import OpenAI, ChatOpenAI
+import time
+import asyncio
+import re
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, List, Dict, Optional
+
 import httpx
-# from openai import OpenAI
-import requests
-from typing import List
-from pydantic import BaseModel, Field, field_validator
-from langchain_core.output_parsers import JsonOutputParser
-import io
-from fastapi import  File, UploadFile
-from langchain.output_parsers import PydanticOutputParser
 from dotenv import load_dotenv
+from langchain_core.runnables import Runnable
+from langchain_core.prompts import ChatPromptTemplate
+from pydantic import BaseModel, Field
 
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
 
 
-
+# Handlers are configured once at app startup, see logging_setup.configure_logging
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-formatter = logging.Formatter(
-    '%(asctime)s:%(name)s:%(levelname)s:%(message)s:%(funcName)s')
-file_handler = logging.FileHandler('gppod_medicalGPT.log')
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
 load_dotenv()
 
 
@@ -34,6 +27,18 @@ class ConversationQuery(BaseModel):
     medical_history: List[str]
 
 
+class SessionMessage(BaseModel):
+    user_query: str
+
+
+# Larger batches are rejected with a 422 while the body is validated
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))
+
+
+class ConversationBatchQuery(BaseModel):
+    items: List[ConversationQuery] = Field(max_length=BATCH_MAX_ITEMS)
+
+
 
 conv_stages_summary_dict = {
 1: "1 - 'presenting complaint' is the conversation stage 1, i.e 1st stage, In this stage, Ask the patient about their primary symptoms and focus on identifying primary symptoms. After gathering primary symptoms, move to second stage 'Complaint History' , otherwise stay in current stage. Make the conversation personalized based on information collected (Name, Age, Gender, Occupation) Exit Criteria : Patient has provided primary symptoms.",
@@ -48,9 +53,16 @@ conv_stages_summary_dict = {
 conv_stages_summary_str = "\n".join([v for _,v in conv_stages_summary_dict.items()])
 
     
-def Openai_Models_List(openai_api_key):
+# OPENAI_BASE_URL points both the model list and the chat calls at another
+# OpenAI compatible server, e.g. benchmarks/stub_openai.py for load tests
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+OPENAI_MODELS_URL = f"{OPENAI_BASE_URL}/models"
+
+    
+def Openai_Models_List(openai_api_key, http_client: Optional[httpx.Client] = None):
     try:
-        response = httpx.get(f"https://api.openai.com/v1/models", headers={"Authorization": f"Bearer {openai_api_key}"})
+        get = http_client.get if http_client is not None else httpx.get
+        response = get(OPENAI_MODELS_URL, headers={"Authorization": f"Bearer {openai_api_key}"})
         models = response.json()
         model_list = []
         for item in models['data']:
@@ -59,38 +71,63 @@ def Openai_Models_List(openai_api_key):
     except Exception as ex:
         return Exception(f"Error in fetching OpenAI models: {ex}")
     
+STAGE_NUMBER_PATTERN = re.compile(r"\s*(\d+)")
+
+
+def parse_conversation_stage(chain_output: str) -> int:
+    # The analyzer is asked to start with the stage number, anything after it is explanation
+    match = STAGE_NUMBER_PATTERN.match(chain_output)
+    if match is None:
+        raise ValueError(f"No conversation stage found in stage analyzer output: {chain_output!r}")
+    stage = int(match.group(1))
+    if stage not in conv_stages_summary_dict:
+        raise ValueError(f"Conversation stage {stage} out of range in stage analyzer output: {chain_output!r}")
+    return stage
+
+
 async def create_conv_stage_and_history_pair(history, stage_analyzer_chain):
     conv_stage_map = {} 
-    chain_output = await stage_analyzer_chain.ainvoke({'conversation_history': history, 
-                                                    'conv_stages_summary':conv_stages_summary_str})
+    chain_output = await stage_analyzer_chain.ainvoke({'conversation_history': history})
     chain_output = chain_output.content
-    stage_num = chain_output[0]
-    conv_stage_map[stage_num] = history
+    stage_num = parse_conversation_stage(chain_output)
+    conv_stage_map[str(stage_num)] = history
 
     return conv_stage_map
 
-class ConversationStageAnalyzer(Runnable):
-    @classmethod
-    def from_openai_llm(cls, llm_name:str) -> Runnable: 
-        try:
-            openai_api_key = os.getenv('OPENAI_API_KEY')
-            assert openai_api_key is not None, "Please set the OPENAI_API_KEY environment variable"
-            
-            openai_models_list = Openai_Models_List(openai_api_key)
-            assert llm_name in openai_models_list, f"Model {llm_name} not found in OpenAI Models List"
-        
-        except AssertionError as ex:
-            return Exception(f"Given model {llm_name} not found in OpenAI Models List")
-        except Exception as ex:
-            return Exception(f"Error in fetching OpenAI models: {ex}") 
-        
-        try:
-            stage_analyzer_prompt_str = """
-        Analyze the conversation history enclosed between the markers '===' to determine the next immediate conversation stage for a patient healthcare conversation. Don't move to next stage unless the all the information asked in previous stage is provided, do not ask so many questions in one response 
+class StageAnalyzer(ABC):
+    # Chooses the next conversation stage (a key of conv_stages_summary_dict) from the history
 
-        ===
-        conversation history : {conversation_history}
-        ===
+    @abstractmethod
+    async def analyze(self, history: List[str]) -> int:
+        ...
+
+    def stats(self) -> dict:
+        return {}
+
+
+class LLMStageAnalyzer(StageAnalyzer):
+    # Runs the ConversationStageAnalyzer chain, `get_chain` returns the shared chain and
+    # `compact_history` optionally shrinks the history interpolated into the prompt
+
+    def __init__(self, get_chain, compact_history=None):
+        self.get_chain = get_chain
+        self.compact_history = compact_history
+
+    async def analyze(self, history: List[str]) -> int:
+        if self.compact_history is not None:
+            history = self.compact_history(history)
+        stage_and_history_dict = await create_conv_stage_and_history_pair(history, self.get_chain())
+        return int(list(stage_and_history_dict.keys())[0])
+
+
+# Every prompt is a static system message followed by a human message holding the
+# per-conversation content. The provider caches the longest prompt prefix it has seen
+# recently (OpenAI: prompts of 1024 tokens or more, in 128 token steps), so keeping the
+# instructions and the stage list first and identical across calls lets that prefix be
+# served from the cache, and the history, which only grows within a conversation, comes
+# right after it. Nothing that changes per call may be moved into the system messages.
+stage_analyzer_system_prompt_str = """
+        Analyze the conversation history enclosed between the markers '===' to determine the next immediate conversation stage for a patient healthcare conversation. Don't move to next stage unless the all the information asked in previous stage is provided, do not ask so many questions in one response 
 
         Based on the conversation history, choose the next appropriate conversation stage from the following conversation stages:
         conversation stages: {conv_stages_summary}. 
@@ -115,37 +152,17 @@ class ConversationStageAnalyzer(Runnable):
         Example4 : Next stage is 6
         Example4 : Response : 4
         Example5 : This response indicates that the next appropriate conversation stage is 'Complaint History'
-
-        Response : 
         """
-            stage_analyzer_prompt = ChatPromptTemplate.from_template(template=stage_analyzer_prompt_str)
-            chat_llm = ChatOpenAI(model='gpt-4o-mini', openai_api_key=os.environ.get('OPENAI_API_KEY'))
-            stage_analyzer_chain = ( stage_analyzer_prompt 
-                         | chat_llm )
-            return stage_analyzer_chain  
-        except Exception as ex:
-            raise Exception(f"Error in creating ConversationStageAnalyzer: {ex}")
 
+stage_analyzer_human_prompt_str = """
+        ===
+        conversation history : {conversation_history}
+        ===
 
-class MedicalConversationChain(Runnable):
-
+        Response : 
+        """
 
-    @classmethod
-    def from_openai_llm(cls, llm_name:str ='gpt-4o-mini') -> Runnable: 
-        try:
-            openai_api_key = os.getenv('OPENAI_API_KEY')
-            assert openai_api_key is not None, "Please set the OPENAI_API_KEY environment variable"
-            
-            openai_models_list = Openai_Models_List(openai_api_key)
-            assert llm_name in openai_models_list, f"Model {llm_name} not found in OpenAI Models List"
-        
-        except AssertionError as ex:
-            return Exception(f"Given model {llm_name} not found in OpenAI Models List")
-        except Exception as ex:
-            return Exception(f"Error in fetching OpenAI models: {ex}") 
-        
-        try:
-            physician_agent_prompt_str = (
+physician_agent_system_prompt_str = (
     """
     You are "Dr. Ali," an AI medical assistant designed to support a General Physician.
     You are an expert in discussing, diagnosing and addressing a wide range of health concerns, tailored to individuals of all ages and genders.
@@ -165,10 +182,6 @@ class MedicalConversationChain(Runnable):
     8. **Suggest Safely:** Provide a final diagnosis and treatment strategy that may include lifestyle changes, home remedies, or over-the-counter medications. Always inquire about drug allergies before suggesting or providing medications.
     9. **Structured Interaction:** Respond with one message at a time.
 
-    conversation_history: {conversation_history}
-    current conversation_stage: {conversation_stage}
-    user_query : {user_query}
-
     Generate an appropriate and concise response based on the conversation_history, medical history, current conversation_stage and user_query while adhereing to the guidelines mentioned above. 
     You must give response in the English.
     If query is related to patient's general information or medical history, you must respond wisely while keeping conversation_history and current conversation_stage in view.
@@ -181,17 +194,333 @@ class MedicalConversationChain(Runnable):
     Example1 : I'm unable to directly view images.
     Example2 : I'm unable to directly view images in this chat. As, I assess the image with the assistance of an external tool.
     Example3 : However, I need to clarify that I'll be relying on an external tool to help me interpret it.
+    """                 
+)
+
+physician_agent_human_prompt_str = (
+    """
+    conversation_history: {conversation_history}
+    current conversation_stage: {conversation_stage}
+    user_query : {user_query}
 
     Response : 
-    """                 
-            )
-            physician_agent_prompt = ChatPromptTemplate.from_template(template=physician_agent_prompt_str)
-            chat_llm = ChatOpenAI(model='gpt-4o-mini', openai_api_key=os.environ.get('OPENAI_API_KEY'))
+    """
+)
+
+
+combined_stage_physician_system_prompt_str = (
+    """
+    You are "Dr. Ali," an AI medical assistant designed to support a General Physician.
+    You are an expert in discussing, diagnosing and addressing a wide range of health concerns, tailored to individuals of all ages and genders.
+    You are also enable to accept images with an external help, so you must respond accordingly if query is related to image.
+    You have been contacted by a potential patient who is seeking medical advice and diagnosis.
+
+    First, analyze the conversation history enclosed between the markers '===' to determine the next immediate conversation stage. Don't move to next stage unless the all the information asked in previous stage is provided. If there is no conversation history provided, choose stage 1.
+
+    conversation stages: {conv_stages_summary}
+
+    Then, write your response to the user_query for the chosen conversation stage while following below mentioned guidelines.
+
+    1. **Adapt Responses:** Use the provided conversation_history and chosen conversation stage to tailor your responses appropriately you must ask name age gender and occupation at first stage of conversation.
+    2. **Be Concise:** Keep responses short and engaging. ((Ask only one question at a time to guide the conversation)).
+    3. **Stay in Character:** Always respond as the confident doctor, not as a patient. Never talk about your limitations.
+    4. **Show Empathy:** Maintain a professional, empathetic tone, demonstrating care and understanding throughout the conversation.
+    5. **Probe Smartly:** Mimic a doctor's probing process by asking relevant questions to identify symptoms and disease.
+    6. **No Physical Referrals:** ((Don't schedule an appointment with General Physician in response. Also, don't recommend for physical checkup. Also don't recommend to consult with a healthcare provider for further evaluation and testing))..
+    7. **Consider Special Histories:** For females, Collect gynecological and obstetrics history, before making a diagnosis.
+    8. **Suggest Safely:** Provide a final diagnosis and treatment strategy that may include lifestyle changes, home remedies, or over-the-counter medications. Always inquire about drug allergies before suggesting or providing medications.
+    9. **Structured Interaction:** Respond with one message at a time.
+
+    You must give response in the English.
+    Return the number of the chosen conversation stage as `stage` and your response to the patient as `reply`.
+    """
+)
+
+combined_stage_physician_human_prompt_str = (
+    """
+    ===
+    conversation history : {conversation_history}
+    ===
+
+    user_query : {user_query}
+    """
+)
+
+
+class StageAndReply(BaseModel):
+    stage: int = Field(description="Number of the chosen next conversation stage", ge=1, le=len(conv_stages_summary_dict))
+    reply: str = Field(description="Dr. Ali's response to the patient for the chosen conversation stage")
+
+
+def create_openai_chat_llm(llm_name: str, http_client: Optional[httpx.Client] = None,
+                           http_async_client: Optional[httpx.AsyncClient] = None, max_retries: Optional[int] = None) -> "ChatOpenAI":
+    # langchain_openai pulls in the whole OpenAI SDK, it is imported when the first chat model
+    # is built (ChainRegistry.start does that in a worker thread at startup) rather than with utils
+    from langchain_openai import ChatOpenAI
+    build_openai_response_models()
+    return ChatOpenAI(model=llm_name, openai_api_key=os.environ.get('OPENAI_API_KEY'), base_url=OPENAI_BASE_URL,
+                      http_client=http_client, http_async_client=http_async_client, stream_usage=True,
+                      max_retries=max_retries)
+
+
+class ConversationStageAnalyzer(Runnable):
+    @classmethod
+    def from_chat_llm(cls, chat_llm) -> Runnable:
+        try:
+            stage_analyzer_prompt = ChatPromptTemplate.from_messages([("system", stage_analyzer_system_prompt_str),
+                                                                      ("human", stage_analyzer_human_prompt_str)])
+            stage_analyzer_chain = ( stage_analyzer_prompt.partial(conv_stages_summary=conv_stages_summary_str)
+                         | chat_llm )
+            return stage_analyzer_chain  
+        except Exception as ex:
+            raise Exception(f"Error in creating ConversationStageAnalyzer: {ex}")
+
+    @classmethod
+    def from_openai_llm(cls, llm_name:str, http_client: Optional[httpx.Client] = None,
+                        http_async_client: Optional[httpx.AsyncClient] = None) -> Runnable: 
+        try:
+            openai_api_key = os.getenv('OPENAI_API_KEY')
+            assert openai_api_key is not None, "Please set the OPENAI_API_KEY environment variable"
+            
+            openai_models_list = Openai_Models_List(openai_api_key, http_client=http_client)
+            assert llm_name in openai_models_list, f"Model {llm_name} not found in OpenAI Models List"
+        
+        except AssertionError as ex:
+            return Exception(f"Given model {llm_name} not found in OpenAI Models List")
+        except Exception as ex:
+            return Exception(f"Error in fetching OpenAI models: {ex}") 
+        
+        chat_llm = create_openai_chat_llm(llm_name, http_client=http_client, http_async_client=http_async_client)
+        return cls.from_chat_llm(chat_llm)
+
+
+class MedicalConversationChain(Runnable):
+
+    @classmethod
+    def from_chat_llm(cls, chat_llm) -> Runnable:
+        try:
+            physician_agent_prompt = ChatPromptTemplate.from_messages([("system", physician_agent_system_prompt_str),
+                                                                       ("human", physician_agent_human_prompt_str)])
             physician_agent_chain = ( physician_agent_prompt 
                          | chat_llm )
             return physician_agent_chain
         except Exception as ex:
             raise Exception(f"Error in creating MedicalConversationChain: {ex}")
+
+    @classmethod
+    def from_openai_llm(cls, llm_name:str ='gpt-4o-mini', http_client: Optional[httpx.Client] = None,
+                        http_async_client: Optional[httpx.AsyncClient] = None) -> Runnable: 
+        try:
+            openai_api_key = os.getenv('OPENAI_API_KEY')
+            assert openai_api_key is not None, "Please set the OPENAI_API_KEY environment variable"
+            
+            openai_models_list = Openai_Models_List(openai_api_key, http_client=http_client)
+            assert llm_name in openai_models_list, f"Model {llm_name} not found in OpenAI Models List"
         
+        except AssertionError as ex:
+            return Exception(f"Given model {llm_name} not found in OpenAI Models List")
+        except Exception as ex:
+            return Exception(f"Error in fetching OpenAI models: {ex}") 
+        
+        chat_llm = create_openai_chat_llm(llm_name, http_client=http_client, http_async_client=http_async_client)
+        return cls.from_chat_llm(chat_llm)
 
 
+class CombinedConversationChain(Runnable):
+    # Single structured-output call returning both the conversation stage and the
+    # physician reply as a validated StageAndReply
+
+    @classmethod
+    def from_chat_llm(cls, chat_llm) -> Runnable:
+        try:
+            combined_prompt = ChatPromptTemplate.from_messages([("system", combined_stage_physician_system_prompt_str),
+                                                                ("human", combined_stage_physician_human_prompt_str)])
+            combined_chain = ( combined_prompt.partial(conv_stages_summary=conv_stages_summary_str)
+                         | chat_llm.with_structured_output(StageAndReply, method="json_schema") )
+            return combined_chain
+        except Exception as ex:
+            raise Exception(f"Error in creating CombinedConversationChain: {ex}")
+
+
+_openai_response_models_built = False
+
+
+def build_openai_response_models() -> None:
+    # The openai SDK defers building its pydantic response models until first use. Concurrent
+    # first uses from LangChain's executor threads can then see an empty model_dump() and fail
+    # with KeyError 'choices', so build them once, before the first chat model is used. This also imports
+    # langchain_openai, the slowest import of the app.
+    global _openai_response_models_built
+    if _openai_response_models_built:
+        return
+    import langchain_openai  # noqa: F401
+    from openai.types.chat import ChatCompletion, ChatCompletionChunk
+    for response_model in (ChatCompletion, ChatCompletionChunk):
+        response_model.model_rebuild(force=True)
+    _openai_response_models_built = True
+
+
+class ChainRegistry:
+    # Process-wide registry: the OpenAI model list is validated once at startup and
+    # refreshed in the background every `models_ttl` seconds, and each chain is built
+    # once and shared (with its pooled HTTP clients) across requests. With an
+    # `upstream_limiter` every upstream call goes through admission.AdmissionTransport.
+
+    def __init__(self, openai_api_key: Optional[str] = None, models_ttl: float = 3600.0,
+                 transport: Optional[httpx.AsyncBaseTransport] = None,
+                 max_connections: int = 100, max_keepalive_connections: int = 20, callbacks: Optional[list] = None,
+                 upstream_limiter=None, retry_deadline: float = 20.0):
+        self.openai_api_key = openai_api_key or os.getenv('OPENAI_API_KEY')
+        self.models_ttl = models_ttl
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        # None keeps the OpenAI SDK's retries, the admission transport retries on its own
+        self.max_retries = None
+        if upstream_limiter is not None:
+            from admission import AdmissionTransport
+            transport = AdmissionTransport(transport or httpx.AsyncHTTPTransport(limits=limits), upstream_limiter,
+                                           retry_deadline=retry_deadline)
+            self.max_retries = 0
+        self.http_async_client = httpx.AsyncClient(transport=transport, limits=limits)
+        self.models_list: List[str] = []
+        self.models_refreshed_at: float = 0.0
+        self._chains: Dict[tuple, Runnable] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        # Attached to every chain, runs are tagged with the chain class name
+        self.callbacks = callbacks
+
+    async def fetch_models_list(self) -> List[str]:
+        response = await self.http_async_client.get(OPENAI_MODELS_URL, headers={"Authorization": f"Bearer {self.openai_api_key}"})
+        response.raise_for_status()
+        return [item['id'] for item in response.json()['data']]
+
+    async def refresh_models(self) -> None:
+        self.models_list = await self.fetch_models_list()
+        self.models_refreshed_at = time.monotonic()
+        logger.info(f"Refreshed OpenAI models list: {len(self.models_list)} models")
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.models_ttl)
+            try:
+                await self.refresh_models()
+            except Exception as ex:
+                # Keep serving with the last known list, the next tick will retry
+                logger.error(f"Error in refreshing OpenAI models list: {ex}")
+
+    async def start(self, warm_models: Optional[List[str]] = None) -> None:
+        # The SDK import is CPU bound and the model list a network round trip, do both at once.
+        # Chains for `warm_models` are then built so the first request does not pay for them.
+        assert self.openai_api_key is not None, "Please set the OPENAI_API_KEY environment variable"
+        await asyncio.gather(asyncio.to_thread(build_openai_response_models), self.refresh_models())
+        self._refresh_task = asyncio.create_task(self._refresh_loop())
+        for llm_name in warm_models or []:
+            self.stage_analyzer(llm_name)
+            self.conversation_chain(llm_name)
+            self.combined_chain(llm_name)
+
+    async def close(self) -> None:
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+        await self.http_async_client.aclose()
+
+    def validate_model(self, llm_name: str) -> None:
+        if llm_name not in self.models_list:
+            raise ValueError(f"Given model {llm_name} not found in OpenAI Models List")
+
+    def _get_chain(self, chain_cls, llm_name: str) -> Runnable:
+        key = (chain_cls.__name__, llm_name)
+        chain = self._chains.get(key)
+        if chain is None:
+            self.validate_model(llm_name)
+            chat_llm = create_openai_chat_llm(llm_name, http_async_client=self.http_async_client, max_retries=self.max_retries)
+            chain = chain_cls.from_chat_llm(chat_llm).with_config(tags=[chain_cls.__name__], callbacks=self.callbacks)
+            self._chains[key] = chain
+            logger.info(f"Created {chain_cls.__name__} for model {llm_name}")
+        return chain
+
+    def stage_analyzer(self, llm_name: str) -> Runnable:
+        return self._get_chain(ConversationStageAnalyzer, llm_name)
+
+    def conversation_chain(self, llm_name: str) -> Runnable:
+        return self._get_chain(MedicalConversationChain, llm_name)
+
+    def combined_chain(self, llm_name: str) -> Runnable:
+        return self._get_chain(CombinedConversationChain, llm_name)
+
+
+def batch_item_error(index: int, error: BaseException) -> dict:
+    # Exception text can carry upstream request details, it is only logged and the client
+    # gets a stable error code
+    from openai import APIError
+    from admission import find_rejection
+    from deadlines import DeadlineExceeded
+
+    logger.error(f"Batch item {index} failed: {type(error).__name__}: {error}")
+    rejection = find_rejection(error)
+    if rejection is not None:
+        code = rejection.reason
+    elif isinstance(error, DeadlineExceeded):
+        code = "deadline_exceeded"
+    elif isinstance(error, APIError):
+        code = "upstream_error"
+    elif isinstance(error, ValueError):
+        code = "invalid_model_output"
+    else:
+        code = "internal_error"
+    return {"index": index, "succeeded": False, "error": code}
+
+
+async def run_conversation_batch(registry: ChainRegistry, llm_name: str, queries: List[ConversationQuery], offset: int = 0,
+                                 max_concurrency: int = 8, mode: str = "two_call", compact_history=None) -> List[dict]:
+    # Runs independent conversation turns through the chains with LangChain abatch, at most
+    # `max_concurrency` LLM calls at a time. Results keep the order of `queries`, a failed
+    # item gets an error entry instead of failing the others.
+    config = {"max_concurrency": max_concurrency}
+    histories = [compact_history(query.medical_history) if compact_history is not None else query.medical_history
+                 for query in queries]
+    results: List[Optional[dict]] = [None] * len(queries)
+
+    if mode == "combined":
+        outputs = await registry.combined_chain(llm_name).abatch(
+            [{'conversation_history': history, 'user_query': query.user_query} for query, history in zip(queries, histories)],
+            config=config, return_exceptions=True)
+        for position, output in enumerate(outputs):
+            results[position] = (batch_item_error(offset + position, output) if isinstance(output, Exception) else
+                                 {"index": offset + position, "succeeded": True, "stage": output.stage, "data": output.reply})
+        return results
+
+    stage_outputs = await registry.stage_analyzer(llm_name).abatch(
+        [{'conversation_history': history} for history in histories],
+        config=config, return_exceptions=True)
+    stages: Dict[int, int] = {}
+    for position, output in enumerate(stage_outputs):
+        try:
+            if isinstance(output, Exception):
+                raise output
+            stages[position] = parse_conversation_stage(output.content)
+        except Exception as ex:
+            results[position] = batch_item_error(offset + position, ex)
+
+    positions = list(stages)
+    reply_outputs = await registry.conversation_chain(llm_name).abatch(
+        [{'conversation_stage': conv_stages_summary_dict[stages[position]], 'conversation_history': histories[position],
+          'user_query': queries[position].user_query} for position in positions],
+        config=config, return_exceptions=True)
+    for position, output in zip(positions, reply_outputs):
+        results[position] = (batch_item_error(offset + position, output) if isinstance(output, Exception) else
+                             {"index": offset + position, "succeeded": True, "stage": stages[position], "data": output.content})
+    return results
+
+
+async def iter_conversation_batch(registry: ChainRegistry, llm_name: str, queries: List[ConversationQuery],
+                                  chunk_size: int = 64, **kwargs):
+    # Same as run_conversation_batch, in chunks of `chunk_size` items so large batches are
+    # yielded in order as they complete instead of being held in memory
+    for start in range(0, len(queries), chunk_size):
+        for result in await run_conversation_batch(registry, llm_name, queries[start:start + chunk_size], offset=start, **kwargs):
+            yield result
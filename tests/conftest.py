@@ -0,0 +1,66 @@
+import os
+import sys
+import tempfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "medibot-code"))
+sys.path.insert(0, os.path.join(ROOT, "medibot-code", "benchmarks"))
+
+# main reads these when it is imported
+os.environ.setdefault("OPENAI_API_KEY", "sk-stub")
+os.environ.setdefault("OPENAI_MODEL_NAME", "gpt-4o-mini")
+# The app writes its log file on startup, keep it out of the working tree
+os.environ.setdefault("LOG_FILE", os.path.join(tempfile.mkdtemp(prefix="medibot-tests-"), "medibot.log"))
+
+
+@pytest.fixture
+def medibot(monkeypatch):
+    # Starts an app against the stub OpenAI transport and returns the client and the stub
+    # counters. Upper case keyword arguments replace main's settings for the test, the
+    # others replace the app's services, e.g. medibot(latency=0.3, response_cache=None,
+    # CONVERSATION_MODE="combined")
+    import main
+    from stub_openai import StubCounters, make_async_transport
+
+    clients = []
+
+    def start(latency: float = 0.0, **overrides):
+        counters = StubCounters()
+        overrides = {"CONVERSATION_MODE": "two_call", "SPECULATIVE_EXECUTION": False, **overrides}
+        for name in [name for name in overrides if name.isupper()]:
+            monkeypatch.setattr(main, name, overrides.pop(name))
+
+        def create_services():
+            services = main.create_services_from_env(transport=make_async_transport(latency, counters))
+            for name, value in overrides.items():
+                setattr(services, name, value)
+            return services
+
+        client = TestClient(main.create_app(create_services))
+        client.__enter__()
+        clients.append(client)
+        return client, counters
+
+    yield start
+    for client in clients:
+        client.__exit__(None, None, None)
+
+
+@pytest.fixture
+def metric_value():
+    # Reads a sample from the /metrics page of an app. Counters are process wide, compare
+    # the values before and after the requests under test.
+    from prometheus_client.parser import text_string_to_metric_families
+
+    def read(client, name: str, **labels) -> float:
+        for family in text_string_to_metric_families(client.get("/metrics").text):
+            for sample in family.samples:
+                if sample.name == name and all(sample.labels.get(key) == value for key, value in labels.items()):
+                    return sample.value
+        return 0.0
+
+    return read
@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from admission import AdmissionRejected, AdmissionTransport, ClientRateLimiter, UpstreamLimiter
+from deadlines import start_deadline
+
+TURN = {"user_query": "Hi", "medical_history": ["Hi"]}
+
+
+def test_client_chosen_ids_share_the_rate_limit_of_their_address(medibot):
+    client, _ = medibot(client_rate_limiter=ClientRateLimiter(rate=0.01, burst=2))
+    statuses = [client.post("/qnaConversation", json=TURN, headers={"X-Client-ID": f"client-{index}"}).status_code
+                for index in range(3)]
+    assert statuses == [200, 200, 429]
+
+
+def test_trusted_proxy_header_keys_on_the_address_the_proxy_saw(medibot):
+    client, _ = medibot(client_rate_limiter=ClientRateLimiter(rate=0.01, burst=1), TRUSTED_CLIENT_HEADER="X-Forwarded-For")
+
+    def post(forwarded_for):
+        return client.post("/qnaConversation", json=TURN, headers={"X-Forwarded-For": forwarded_for}).status_code
+
+    assert post("10.0.0.1") == 200
+    # A spoofed first entry does not change the address appended by the proxy
+    assert post("198.51.100.7, 10.0.0.1") == 429
+    assert post("10.0.0.2") == 200
+
+
+class ScriptedTransport(httpx.AsyncBaseTransport):
+    # Stub upstream: answers each request with the next of `answers`, a status code, an
+    # exception to raise or a response factory, and repeats the last one
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.requests = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        answer = self.answers.pop(0) if len(self.answers) > 1 else self.answers[0]
+        if isinstance(answer, Exception):
+            raise answer
+        if callable(answer):
+            return answer()
+        headers = {"Retry-After": "0.05"} if answer in (429, 503) else {}
+        return httpx.Response(answer, headers=headers, json={})
+
+
+class SlowBody(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        for chunk in (b"data: one\n\n", b"data: two\n\n"):
+            await asyncio.sleep(0.01)
+            yield chunk
+
+
+def admission_client(upstream, limiter, **options):
+    transport = AdmissionTransport(upstream, limiter, backoff_base=0.001, **options)
+    return httpx.AsyncClient(transport=transport, base_url="http://upstream")
+
+
+def test_rate_limited_calls_are_retried_after_retry_after():
+    upstream, limiter = ScriptedTransport(429, 503, 200), UpstreamLimiter(max_in_flight=2)
+
+    async def scenario():
+        async with admission_client(upstream, limiter) as client:
+            started = time.monotonic()
+            response = await client.post("/chat/completions")
+            return response, time.monotonic() - started
+
+    response, elapsed = asyncio.run(scenario())
+    assert response.status_code == 200
+    assert upstream.requests == 3
+    assert elapsed >= 0.1
+    assert limiter.in_flight == 0
+
+
+def test_connection_errors_are_retried_and_other_errors_returned():
+    upstream, limiter = ScriptedTransport(httpx.ConnectError("refused"), 400), UpstreamLimiter()
+
+    async def scenario():
+        async with admission_client(upstream, limiter) as client:
+            return await client.post("/chat/completions")
+
+    assert asyncio.run(scenario()).status_code == 400
+    assert upstream.requests == 2
+    assert limiter.in_flight == 0
+
+
+@pytest.mark.parametrize("retry_deadline, request_deadline", [(0.02, None), (20.0, 0.02)])
+def test_last_answer_is_handed_back_when_no_time_is_left_to_retry(retry_deadline, request_deadline):
+    upstream, limiter = ScriptedTransport(429), UpstreamLimiter()
+
+    async def scenario():
+        start_deadline(request_deadline)
+        async with admission_client(upstream, limiter, retry_deadline=retry_deadline) as client:
+            return await client.post("/chat/completions")
+
+    assert asyncio.run(scenario()).status_code == 429
+    assert upstream.requests == 1
+    assert limiter.in_flight == 0
+
+
+def test_streamed_body_keeps_its_slot_until_read_or_closed():
+    upstream = ScriptedTransport(lambda: httpx.Response(200, stream=SlowBody()))
+    limiter = UpstreamLimiter(max_in_flight=1, max_queue=0)
+
+    async def scenario():
+        async with admission_client(upstream, limiter) as client:
+            async with client.stream("POST", "/chat/completions") as response:
+                assert limiter.in_flight == 1
+                # The slot is taken and there is no queue: the next call is turned away
+                with pytest.raises(AdmissionRejected) as rejected:
+                    await client.post("/chat/completions")
+                assert rejected.value.reason == "queue_full" and rejected.value.status_code == 503
+                assert b"".join([chunk async for chunk in response.aiter_bytes()]) == b"data: one\n\ndata: two\n\n"
+                assert limiter.in_flight == 0
+            # Closed before its body was read
+            async with client.stream("POST", "/chat/completions"):
+                assert limiter.in_flight == 1
+            assert limiter.in_flight == 0
+
+    asyncio.run(scenario())
+
+
+def test_upstream_queue_rejects_when_full_and_after_max_wait():
+    limiter = UpstreamLimiter(max_in_flight=1, max_queue=1, max_wait=0.05)
+
+    async def scenario():
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        assert limiter.saturated()
+        with pytest.raises(AdmissionRejected, match="queue_full"):
+            await limiter.acquire()
+        with pytest.raises(AdmissionRejected, match="queue_timeout"):
+            await waiter
+        limiter.release()
+        # Released slots are handed to the queue in order
+        await limiter.acquire()
+        waiter = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0.01)
+        limiter.release()
+        await waiter
+        limiter.release()
+
+    asyncio.run(scenario())
+    assert limiter.in_flight == 0 and limiter.waiting == 0
+    assert limiter.stats()["rejections"] == {"queue_full": 1, "queue_timeout": 1}
@@ -0,0 +1,19 @@
+from fastapi.testclient import TestClient
+
+import main
+from stub_openai import StubCounters, make_async_transport
+
+
+def test_every_app_start_gets_open_services():
+    counters = StubCounters()
+    app = main.create_app(lambda: main.create_services_from_env(transport=make_async_transport(0.0, counters)))
+    other_app = main.create_app(lambda: main.create_services_from_env(transport=make_async_transport(0.0, counters)))
+    services = []
+    # The same app restarted, then a second app in the same process
+    for started_app in (app, app, other_app):
+        with TestClient(started_app) as client:
+            response = client.post("/qnaConversation", json={"user_query": "Hi", "medical_history": ["Hi"]})
+            assert response.status_code == 200, response.text
+            services.append(started_app.state.services)
+    assert len({id(service) for service in services}) == 3
+    assert all(service.chain_registry.http_async_client.is_closed for service in services)
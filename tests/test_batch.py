@@ -0,0 +1,36 @@
+import pytest
+
+from deadlines import DeadlineExceeded
+from utils import BATCH_MAX_ITEMS, batch_item_error
+
+HISTORY = ["Hi", "Hello, I'm Dr. Ali. Could you tell me your name?", "I'm Sara, 34, a teacher, I have a headache"]
+
+
+def test_batch_answers_every_item_in_order(medibot):
+    client, counters = medibot()
+    items = [{"user_query": HISTORY[-1], "medical_history": HISTORY} for _ in range(3)]
+    response = client.post("/qnaConversation/batch", json={"items": items})
+    assert response.status_code == 200, response.text
+    results = response.json()["data"]
+    assert [result["index"] for result in results] == [0, 1, 2]
+    assert all(result["succeeded"] for result in results)
+    assert counters.chat_calls == 6
+
+
+def test_oversized_batch_is_rejected_before_any_llm_call(medibot):
+    client, counters = medibot()
+    items = [{"user_query": "Hi", "medical_history": ["Hi"]}] * (BATCH_MAX_ITEMS + 1)
+    response = client.post("/qnaConversation/batch", json={"items": items})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["type"] == "too_long"
+    assert counters.chat_calls == 0
+
+
+@pytest.mark.parametrize("error, code", [
+    (DeadlineExceeded("physician_agent"), "deadline_exceeded"),
+    (ValueError("No conversation stage found in stage analyzer output: 'secret prompt'"), "invalid_model_output"),
+    (RuntimeError("connection to https://internal-host/v1 refused"), "internal_error"),
+])
+def test_batch_item_error_returns_a_stable_code(error, code):
+    result = batch_item_error(4, error)
+    assert result == {"index": 4, "succeeded": False, "error": code}
@@ -0,0 +1,96 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from coalescing import SharedFlightStore, SingleFlight
+
+DUPLICATES = 8
+HISTORY = ["Hi", "Hello, I'm Dr. Ali. Could you tell me your name?", "I'm Sara, 34, a teacher, I have a headache"]
+
+
+def test_duplicate_in_flight_turns_share_one_pipeline_run(medibot, metric_value):
+    single_flight = SingleFlight()
+    client, counters = medibot(latency=0.3, request_coalescer=single_flight, response_cache=None)
+    coalesced = metric_value(client, "medibot_coalesced_requests_total", scope="in_process")
+    runs = metric_value(client, "medibot_coalesce_runs_total")
+    # Double clicks and retries: same turn, differing only in case and spacing
+    bodies = [{"user_query": HISTORY[-1] if index % 2 else f"  {HISTORY[-1].upper()} ", "medical_history": HISTORY}
+              for index in range(DUPLICATES)]
+    bodies.append({"user_query": "Something else", "medical_history": HISTORY[:-1] + ["Something else"]})
+    with ThreadPoolExecutor(len(bodies)) as pool:
+        responses = list(pool.map(lambda body: client.post("/qnaConversation", json=body), bodies))
+
+    assert all(response.status_code == 200 for response in responses), [response.text for response in responses]
+    assert len({response.json()["data"] for response in responses[:DUPLICATES]}) == 1
+    # Stage analyzer and physician for the duplicated turn and for the other one
+    assert counters.chat_calls == 4
+    assert metric_value(client, "medibot_coalesced_requests_total", scope="in_process") - coalesced == DUPLICATES - 1
+    assert metric_value(client, "medibot_coalesce_runs_total") - runs == 2
+    assert metric_value(client, "medibot_coalesce_in_flight") == 0
+    assert single_flight.stats()["coalesced"] == DUPLICATES - 1
+
+
+def test_waiters_share_a_failure_and_the_next_request_runs_again():
+    calls = 0
+
+    async def slow_failure():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        raise RuntimeError("upstream failed")
+
+    async def scenario():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(*(single_flight.run("key", slow_failure) for _ in range(5)), return_exceptions=True)
+        assert calls == 1
+        assert all(isinstance(result, RuntimeError) for result in results)
+        with pytest.raises(RuntimeError):
+            await single_flight.run("key", slow_failure)
+        assert calls == 2
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_leader_hands_the_run_over_to_a_waiter():
+    calls = 0
+
+    async def slow_reply():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return ["1", "reply"]
+
+    async def scenario():
+        single_flight = SingleFlight()
+        leader = asyncio.create_task(single_flight.run("key", slow_reply))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(single_flight.run("key", slow_reply))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        assert await waiter == ["1", "reply"]
+        assert calls == 2
+        assert single_flight.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_workers_sharing_a_store_run_the_pipeline_once(tmp_path):
+    calls = 0
+
+    async def slow_reply():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return ["1", "reply"]
+
+    async def scenario():
+        path = str(tmp_path / "flights.db")
+        workers = [SingleFlight(SharedFlightStore(path=path, poll_interval=0.01)) for _ in range(2)]
+        results = await asyncio.gather(*(workers[index % 2].run("turn", slow_reply) for index in range(6)))
+        assert calls == 1
+        assert results == [["1", "reply"]] * 6
+        # One worker waited on the other through the store
+        assert sum(worker.stats()["shared_coalesced"] for worker in workers) == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from deadlines import DeadlineExceeded, iterate_with_deadline, remaining, start_deadline, with_deadline
+
+
+def test_with_deadline_cancels_the_call_when_time_runs_out():
+    cancelled = asyncio.Event()
+
+    async def slow_call():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    async def scenario():
+        start_deadline(0.05)
+        with pytest.raises(DeadlineExceeded):
+            await with_deadline(slow_call(), "reply_generation")
+        assert cancelled.is_set()
+        # Nothing is started once the deadline has passed
+        call = slow_call()
+        with pytest.raises(DeadlineExceeded):
+            await with_deadline(call, "reply_generation")
+        assert call.cr_frame is None
+
+    asyncio.run(scenario())
+
+
+def test_without_a_deadline_calls_run_to_completion():
+    async def scenario():
+        start_deadline(0)
+        assert remaining() is None
+        assert await with_deadline(asyncio.sleep(0.01, result="reply"), "reply_generation") == "reply"
+
+    asyncio.run(scenario())
+
+
+def test_iterate_with_deadline_closes_the_stream():
+    closed = []
+
+    async def chunks():
+        try:
+            for chunk in ("Hello", " there", " again"):
+                await asyncio.sleep(0.04)
+                yield chunk
+        finally:
+            closed.append(True)
+
+    async def scenario():
+        start_deadline(0.1)
+        received = []
+        with pytest.raises(DeadlineExceeded):
+            async for chunk in iterate_with_deadline(chunks(), "reply_generation"):
+                received.append(chunk)
+        return received
+
+    assert asyncio.run(scenario()) == ["Hello", " there"]
+    assert closed == [True]
@@ -0,0 +1,20 @@
+import json
+
+from evaluate import index_outputs, read_output
+
+
+def test_outputs_are_indexed_by_offset_and_read_back_one_at_a_time(tmp_path):
+    path = tmp_path / "outputs.jsonl"
+    records = [{"id": "c1", "turns": [{"stage": 1, "reply": "first"}]},
+               {"id": "c2", "turns": [{"stage": 1, "reply": "Hello, I’m Dr. Ali"}]},
+               {"id": "c1", "turns": [{"stage": 2, "reply": "replayed again"}]}]
+    path.write_text("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+                    + '{"id": "c3", "tur', encoding="utf-8")
+
+    offsets = index_outputs(str(path), {"c1", "c2", "c3"})
+    # The latest line of a conversation wins, a partly written last line is ignored
+    assert set(offsets) == {"c1", "c2"}
+    with open(path, "rb") as outputs:
+        assert read_output(outputs, offsets["c2"]) == records[1]["turns"]
+        assert read_output(outputs, offsets["c1"]) == records[2]["turns"]
+    assert index_outputs(str(tmp_path / "missing.jsonl"), {"c1"}) == {}
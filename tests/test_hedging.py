@@ -0,0 +1,127 @@
+import asyncio
+
+import pytest
+
+from deadlines import DeadlineExceeded, start_deadline
+from hedging import Hedger
+
+
+class FakeStream:
+    # Async iterator standing in for a chat model stream: waits `delay` seconds, then
+    # raises `error` or yields `chunks`. Records whether it was cancelled and closed.
+
+    def __init__(self, name: str, delay: float, error: Exception = None, chunks=("Hello", " there")):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.chunks = list(chunks)
+        self.started = False
+        self.cancelled = False
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.started:
+            self.started = True
+            try:
+                await asyncio.sleep(self.delay)
+            except asyncio.CancelledError:
+                self.cancelled = True
+                raise
+            if self.error is not None:
+                raise self.error
+        if not self.chunks:
+            raise StopAsyncIteration
+        return f"{self.name}:{self.chunks.pop(0)}"
+
+    async def aclose(self):
+        self.closed = True
+
+
+def stream_factory(*streams):
+    made = []
+
+    def make_stream():
+        stream = streams[len(made)]
+        made.append(stream)
+        return stream
+
+    return make_stream, made
+
+
+async def collect(hedger, make_stream):
+    return [chunk async for chunk in hedger.astream(make_stream)]
+
+
+def test_fast_primary_is_not_hedged():
+    hedger = Hedger(initial_delay=0.2, max_hedge_rate=1.0)
+    make_stream, made = stream_factory(FakeStream("primary", 0.0))
+    assert asyncio.run(collect(hedger, make_stream)) == ["primary:Hello", "primary: there"]
+    assert len(made) == 1 and made[0].closed
+    assert hedger.stats()["hedged"] == 0
+
+
+def test_backup_wins_over_a_slow_primary_which_is_cancelled_and_closed():
+    hedger = Hedger(initial_delay=0.05, max_hedge_rate=1.0)
+    primary, backup = FakeStream("primary", 5.0), FakeStream("backup", 0.01)
+    make_stream, made = stream_factory(primary, backup)
+
+    async def scenario():
+        started = asyncio.get_running_loop().time()
+        chunks = await collect(hedger, make_stream)
+        return chunks, asyncio.get_running_loop().time() - started
+
+    chunks, elapsed = asyncio.run(scenario())
+    assert chunks == ["backup:Hello", "backup: there"]
+    assert elapsed < 1.0
+    assert primary.cancelled and primary.closed
+    assert backup.closed
+    assert hedger.stats()["backup_wins"] == 1
+
+
+def test_both_streams_failing_raises_and_closes_them():
+    hedger = Hedger(initial_delay=0.05, max_hedge_rate=1.0)
+    primary = FakeStream("primary", 0.15, error=RuntimeError("primary failed"))
+    backup = FakeStream("backup", 0.02, error=RuntimeError("backup failed"))
+    make_stream, made = stream_factory(primary, backup)
+    # The backup fails first, the call waits for the primary and raises its error
+    with pytest.raises(RuntimeError, match="primary failed"):
+        asyncio.run(collect(hedger, make_stream))
+    assert len(made) == 2
+    assert backup.closed and primary.closed
+
+
+def test_hedging_stays_under_max_hedge_rate():
+    hedger = Hedger(initial_delay=0.01, max_hedge_rate=0.5)
+    streams = []
+
+    async def scenario():
+        # Every primary is slow: half of the calls get a backup, the others wait it out
+        for _ in range(4):
+            make_stream, made = stream_factory(FakeStream("primary", 0.05), FakeStream("backup", 0.0))
+            await collect(hedger, make_stream)
+            streams.extend(made)
+
+    asyncio.run(scenario())
+    stats = hedger.stats()
+    assert stats["calls"] == 4
+    assert stats["hedged"] == 2 and stats["over_budget"] == 2
+    assert len(streams) == 6
+    assert all(stream.closed for stream in streams)
+
+
+def test_deadline_before_the_first_chunk_cancels_the_call():
+    hedger = Hedger(initial_delay=0.01, max_hedge_rate=1.0)
+    primary, backup = FakeStream("primary", 5.0), FakeStream("backup", 5.0)
+    make_stream, made = stream_factory(primary, backup)
+
+    async def scenario():
+        start_deadline(0.1)
+        await collect(hedger, make_stream)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(scenario())
+    assert primary.cancelled and primary.closed
+    assert backup.cancelled and backup.closed
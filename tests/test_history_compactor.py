@@ -0,0 +1,85 @@
+import pytest
+
+from history_compactor import HistoryCompactor, TokenCounter, classify_patient_message, empty_summary, fold_messages
+
+
+class WordCounter(TokenCounter):
+    # One token per word, no tokenizer download
+    def count(self, text):
+        return len(text.split())
+
+
+CONSULTATION = [
+    "Hi doctor",
+    "Hello, I'm Dr. Ali. What is your name, age, gender and occupation?",
+    "I'm Sara, 34, female, I work as a teacher",
+    "Thank you Sara. What brings you here today?",
+    "I have a headache and a mild fever",
+    "How long have you had these symptoms?",
+    "It started three days ago and gets worse in the evening",
+    "Do you have any allergies?",
+    "No allergies that I know of",
+    "This is most likely a viral infection. I recommend rest, fluids and paracetamol 500 mg every six hours.",
+    "Thank you, that helps",
+]
+
+
+@pytest.mark.parametrize("question, message, field", [
+    ("What is your name, age, gender and occupation?", "Sara, 34", "patient_demographics"),
+    ("", "I'm a teacher, 34 years old", "patient_demographics"),
+    ("", "I have a headache", "primary_symptoms"),
+    ("", "My stomach aches and I'm coughing", "primary_symptoms"),
+    ("What brings you here today?", "Not sure", "primary_symptoms"),
+    ("How long have you had it?", "Roughly", "duration_progression"),
+    ("", "It started two days ago and is getting worse", "duration_progression"),
+    ("Are you allergic to any medication?", "No", "allergies"),
+    ("", "I'm allergic to penicillin", "allergies"),
+    ("", "Thank you, that helps", "other_notes"),
+])
+def test_patient_statement_fields(question, message, field):
+    assert classify_patient_message(message, question) == field
+
+
+def test_doctor_questions_and_assessments_are_kept():
+    summary = empty_summary()
+    fold_messages(summary, CONSULTATION, 0)
+    assert summary["questions_asked"] == ["What is your name, age, gender and occupation?", "What brings you here today?",
+                                          "How long have you had these symptoms?", "Do you have any allergies?"]
+    assert summary["assessment_given"] == [CONSULTATION[9]]
+    assert summary["primary_symptoms"] == ["I have a headache and a mild fever"]
+    assert summary["allergies"] == ["No allergies that I know of"]
+    # Doctor text is never filed as a patient statement
+    patient_notes = [note for field in ("patient_demographics", "primary_symptoms", "duration_progression",
+                                        "allergies", "other_notes") for note in summary[field]]
+    assert set(patient_notes) <= set(CONSULTATION[0::2])
+
+
+def test_roles_follow_the_start_of_the_history():
+    # The history ends with the doctor's reply, roles still come from the opening message
+    compactor = HistoryCompactor(token_budget=100, keep_turns=1, token_counter=WordCounter())
+    compacted = compactor.compact(CONSULTATION[:10])
+    assert compacted[-2:] == CONSULTATION[8:10]
+    assert "patient_demographics: I'm Sara, 34, female, I work as a teacher" in compacted[0]
+    assert "primary_symptoms: I have a headache and a mild fever" in compacted[0]
+    assert "questions_asked: What is your name" in compacted[0]
+    assert "What brings you here today?" not in compacted[0].split("questions_asked")[0]
+
+
+def test_history_within_budget_is_not_compacted():
+    compactor = HistoryCompactor(token_budget=1000, keep_turns=1, token_counter=WordCounter())
+    assert compactor.compact(CONSULTATION) == CONSULTATION
+
+
+def test_history_over_budget_is_compacted_to_budget():
+    counter = WordCounter()
+    small_talk = []
+    for index in range(10):
+        small_talk += [f"By the way, something unrelated number {index} " + "and so on " * 15,
+                       "I see, please go on " + "and so on " * 15]
+    history = CONSULTATION[:9] + small_talk + CONSULTATION[9:]
+    compactor = HistoryCompactor(token_budget=300, keep_turns=1, token_counter=counter)
+    compacted = compactor.compact(history)
+    assert counter.count_messages(history) > 300
+    assert compacted[-2:] == history[-2:]
+    assert compacted[0].startswith("Summary of earlier conversation")
+    assert counter.count_messages(compacted) <= 300
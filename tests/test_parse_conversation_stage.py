@@ -0,0 +1,25 @@
+import pytest
+
+from utils import parse_conversation_stage
+
+
+@pytest.mark.parametrize("output, stage", [
+    ("3", 3),
+    ("  2\n Explanation : still collecting symptoms", 2),
+    ("5 - closure, the patient said goodbye", 5),
+])
+def test_leading_stage_number(output, stage):
+    assert parse_conversation_stage(output) == stage
+
+
+@pytest.mark.parametrize("output", [
+    "6 the patient is still in stage 2",
+    "0",
+    "12",
+    "Stage 2",
+    "Next stage is 3",
+    "",
+])
+def test_missing_or_out_of_range_stage(output):
+    with pytest.raises(ValueError):
+        parse_conversation_stage(output)
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def observed(monkeypatch):
+    observed = []
+    monkeypatch.setattr(main, "observe_request", lambda path, status_code, seconds: observed.append((path, seconds)))
+    monkeypatch.setattr(main, "SERVER_TIMING", True)
+    app = FastAPI()
+    app.middleware("http")(main.request_logging_middleware)
+
+    @app.get("/stream")
+    async def stream():
+        async def events():
+            for index in range(3):
+                await asyncio.sleep(0.1)
+                yield f"data: {index}\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/json")
+    async def json_reply():
+        return JSONResponse(content={"succeeded": True})
+
+    with TestClient(app) as client:
+        yield client, observed
+
+
+def test_streamed_request_latency_covers_the_whole_body(observed):
+    client, observed = observed
+    response = client.get("/stream")
+    assert response.text.count("data:") == 3
+    # Server-Timing goes out with the headers, before the body is generated
+    assert "headers;dur=" in response.headers["Server-Timing"]
+    assert "total" not in response.headers["Server-Timing"]
+    [(path, seconds)] = observed
+    assert path == "/stream" and seconds >= 0.3
+
+
+def test_plain_request_is_recorded_with_its_total(observed):
+    client, observed = observed
+    response = client.get("/json")
+    assert "total;dur=" in response.headers["Server-Timing"]
+    assert [path for path, _ in observed] == ["/json"]
@@ -0,0 +1,26 @@
+import pytest
+
+from response_cache import DiskCacheBackend, InMemoryCacheBackend, ResponseCache
+
+
+@pytest.mark.parametrize("backend", ["memory", "disk"])
+def test_repeated_opening_turns_skip_the_network(medibot, backend, tmp_path):
+    backend = InMemoryCacheBackend() if backend == "memory" else DiskCacheBackend(path=str(tmp_path / "cache.db"))
+    client, counters = medibot(latency=0.01, response_cache=ResponseCache(backend, cacheable_stages=(1,)))
+    first = client.post("/qnaConversation", json={"user_query": "Hi", "medical_history": ["Hi"]})
+    assert first.status_code == 200, first.text
+    # Stage analyzer and physician on a cold cache
+    assert counters.chat_calls == 2
+
+    # Same opening turn, different greeting and spelling: served from the cache
+    for greeting in ["hello!", "  HI  ", "Hey there"]:
+        repeat = client.post("/qnaConversation", json={"user_query": greeting, "medical_history": [greeting]})
+        assert repeat.status_code == 200, repeat.text
+        assert repeat.json()["data"] == first.json()["data"]
+    stream = client.post("/qnaConversation/stream", json={"user_query": "hi", "medical_history": ["hi"]})
+    assert "event: done" in stream.text, stream.text
+    assert counters.chat_calls == 2
+
+    stats = client.get("/responseCache").json()["data"]
+    assert stats["enabled"] is True
+    assert stats["hits"]["reply"] >= 3
@@ -0,0 +1,104 @@
+import asyncio
+import sqlite3
+
+import pytest
+
+import main
+from session_store import InMemorySessionStore, SessionStore, SQLiteSessionStore, trim_history
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        store = InMemorySessionStore(ttl=0.5)
+    else:
+        store = SQLiteSessionStore(path=str(tmp_path / "sessions.db"), ttl=0.5)
+    yield store
+    asyncio.run(store.close())
+
+
+def test_reading_a_session_refreshes_its_ttl(store):
+    async def scenario():
+        session_id = await store.create()
+        await store.append(session_id, "Hi", "Hello")
+        for _ in range(3):
+            await asyncio.sleep(0.3)
+            assert await store.get(session_id) == ["Hi", "Hello"]
+        await asyncio.sleep(0.6)
+        assert await store.get(session_id) is None
+
+    asyncio.run(scenario())
+
+
+def test_trimmed_history_starts_with_a_patient_message():
+    history = ["p1 " * 5, "d1 " * 5, "p2 " * 5, "d2 " * 5]
+    assert trim_history(history, 40) == history[2:]
+    # The latest turn is kept even when it alone is over budget
+    assert trim_history(history, 1) == history[2:]
+    assert trim_history(history + ["p3"], 1) == ["p3"]
+    assert trim_history(history, None) == history
+
+
+def test_sessions_trimmed_by_the_store_keep_their_roles(store):
+    store.max_session_bytes = 60
+
+    async def scenario():
+        session_id = await store.create()
+        for turn in range(1, 4):
+            await store.append(session_id, f"patient message {turn}", f"doctor reply {turn}")
+        return await store.get(session_id)
+
+    history = asyncio.run(scenario())
+    assert history[0].startswith("patient") and history[-1] == "doctor reply 3"
+    assert all(message.startswith("patient" if index % 2 == 0 else "doctor") for index, message in enumerate(history))
+
+
+def test_sqlite_store_closes_every_thread_connection(tmp_path):
+    store = SQLiteSessionStore(path=str(tmp_path / "sessions.db"))
+
+    async def scenario():
+        session_id = await store.create()
+        await asyncio.gather(*(store.get(session_id) for _ in range(8)))
+        connections = list(store._connections)
+        await store.close()
+        return connections
+
+    connections = asyncio.run(scenario())
+    assert connections
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
+
+
+def test_session_store_methods_are_abstract():
+    class Incomplete(SessionStore):
+        async def create(self):
+            return "id"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_failed_turn_leaves_the_session_unchanged(medibot, monkeypatch):
+    client, _ = medibot(session_store=InMemorySessionStore())
+    session_id = client.post("/sessions").json()["data"]["session_id"]
+    assert client.post(f"/sessions/{session_id}/messages", json={"user_query": "Hi"}).status_code == 200
+    history = client.get(f"/sessions/{session_id}").json()["data"]["medical_history"]
+    assert len(history) == 2
+
+    analyze_conversation_stage = main.analyze_conversation_stage
+
+    async def failing_stage(services, history_list):
+        raise RuntimeError("upstream failed")
+
+    monkeypatch.setattr(main, "analyze_conversation_stage", failing_stage)
+    assert client.post(f"/sessions/{session_id}/messages", json={"user_query": "I have a headache"}).status_code == 500
+    stream = client.post(f"/sessions/{session_id}/messages/stream", json={"user_query": "I have a headache"})
+    assert "event: error" in stream.text
+    assert client.get(f"/sessions/{session_id}").json()["data"]["medical_history"] == history
+
+    monkeypatch.setattr(main, "analyze_conversation_stage", analyze_conversation_stage)
+    stream = client.post(f"/sessions/{session_id}/messages/stream", json={"user_query": "I have a headache"})
+    assert "event: done" in stream.text
+    history = client.get(f"/sessions/{session_id}").json()["data"]["medical_history"]
+    assert len(history) == 4 and history[2] == "I have a headache"
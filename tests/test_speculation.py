@@ -0,0 +1,130 @@
+import asyncio
+import gc
+import time
+
+import pytest
+
+from speculation import SpeculativeScheduler, StageTracker
+
+
+class FakePipeline:
+    # Stage analyzer and physician reply with fixed latencies, recording the stages
+    # replies were started for and the replies that were cancelled
+
+    def __init__(self, stage: int, stage_seconds: float = 0.05, reply_seconds: float = 0.05, stage_error: Exception = None):
+        self.stage = stage
+        self.stage_seconds = stage_seconds
+        self.reply_seconds = reply_seconds
+        self.stage_error = stage_error
+        self.reply_stages = []
+        self.cancelled_stages = []
+
+    async def analyze_stage(self) -> int:
+        await asyncio.sleep(self.stage_seconds)
+        if self.stage_error is not None:
+            raise self.stage_error
+        return self.stage
+
+    async def generate_reply(self, stage: int) -> str:
+        self.reply_stages.append(stage)
+        try:
+            await asyncio.sleep(self.reply_seconds)
+        except asyncio.CancelledError:
+            self.cancelled_stages.append(stage)
+            raise
+        return f"reply for stage {stage}"
+
+
+def run(scheduler, predicted_stage, pipeline):
+    async def scenario():
+        started = time.perf_counter()
+        result = await scheduler.run(predicted_stage, pipeline.analyze_stage, pipeline.generate_reply)
+        # Let cancelled tasks finish unwinding
+        await asyncio.sleep(0)
+        return result, time.perf_counter() - started
+
+    return asyncio.run(scenario())
+
+
+def test_hit_keeps_the_speculative_reply():
+    scheduler, pipeline = SpeculativeScheduler(), FakePipeline(stage=2)
+    (stage, reply), elapsed = run(scheduler, 2, pipeline)
+    assert (stage, reply) == (2, "reply for stage 2")
+    assert pipeline.reply_stages == [2]
+    # Stage analysis and reply ran side by side
+    assert elapsed < 0.09
+    assert scheduler.stats()["hits"] == 1 and scheduler.stats()["saved_seconds"] > 0
+
+
+def test_miss_cancels_the_speculative_reply_and_generates_again():
+    scheduler, pipeline = SpeculativeScheduler(), FakePipeline(stage=3, reply_seconds=0.1)
+    (stage, reply), _ = run(scheduler, 2, pipeline)
+    assert (stage, reply) == (3, "reply for stage 3")
+    assert pipeline.reply_stages == [2, 3]
+    assert pipeline.cancelled_stages == [2]
+    stats = scheduler.stats()
+    assert stats["misses"] == 1 and stats["hit_rate"] == 0.0 and stats["wasted_seconds"] > 0
+
+
+def test_analyzer_failure_discards_the_speculative_reply():
+    scheduler = SpeculativeScheduler()
+    pipeline = FakePipeline(stage=2, reply_seconds=0.1, stage_error=RuntimeError("stage analyzer failed"))
+    with pytest.raises(RuntimeError, match="stage analyzer failed"):
+        run(scheduler, 2, pipeline)
+    assert pipeline.cancelled_stages == [2]
+    assert scheduler.stats()["hits"] == 0 and scheduler.stats()["misses"] == 0
+
+
+def test_failed_speculative_reply_is_retrieved_on_a_miss():
+    scheduler, unhandled = SpeculativeScheduler(), []
+
+    async def failing_reply(stage):
+        if stage == 2:
+            raise RuntimeError("speculative reply failed")
+        return f"reply for stage {stage}"
+
+    async def analyze_stage():
+        await asyncio.sleep(0.02)
+        return 3
+
+    async def scenario():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unhandled.append(context))
+        result = await scheduler.run(2, analyze_stage, failing_reply)
+        gc.collect()
+        return result
+
+    assert asyncio.run(scenario()) == (3, "reply for stage 3")
+    assert unhandled == []
+
+
+def test_first_turn_runs_sequentially():
+    scheduler, pipeline = SpeculativeScheduler(), FakePipeline(stage=1)
+    (stage, _), elapsed = run(scheduler, None, pipeline)
+    assert stage == 1 and pipeline.reply_stages == [1]
+    assert elapsed >= 0.1
+    assert scheduler.stats()["skipped"] == 1
+
+
+def test_stage_tracker_finds_the_stage_of_the_previous_turn():
+    tracker = StageTracker(max_entries=2)
+    tracker.record(["Hi"], "Hello, what is your name?", 1)
+    # The next turn sends the history with the reply and its new message
+    assert tracker.previous_stage(["Hi", "Hello, what is your name?", "Sara, I have a headache"]) == 1
+    assert tracker.previous_stage(["Hi", "A different reply", "Sara, I have a headache"]) is None
+    assert tracker.previous_stage([]) is None
+
+    tracker.record(["Hi", "Hello, what is your name?", "Sara, I have a headache"], "Since when?", 2)
+    tracker.record(["Hello"], "Hi, what is your name?", 1)
+    # Oldest entry evicted past max_entries
+    assert tracker.previous_stage(["Hi", "Hello, what is your name?", "Sara"]) is None
+    assert tracker.previous_stage(["Hi", "Hello, what is your name?", "Sara, I have a headache", "Since when?", "Two days"]) == 2
+
+
+def test_speculative_turns_through_the_app(medibot):
+    client, counters = medibot(SPECULATIVE_EXECUTION=True)
+    first = client.post("/qnaConversation", json={"user_query": "Hi", "medical_history": ["Hi"]}).json()["data"]
+    history = ["Hi", first, "I'm Sara, 34, I have a headache"]
+    assert client.post("/qnaConversation", json={"user_query": history[-1], "medical_history": history}).status_code == 200
+    stats = client.get("/speculation").json()["data"]
+    assert stats["enabled"] is True
+    assert stats["skipped"] == 1 and stats["hits"] + stats["misses"] == 1
@@ -0,0 +1,52 @@
+import asyncio
+
+import numpy as np
+
+from stage_classifier import LocalStageAnalyzer, LocalStageClassifier
+from train_stage_classifier import train
+from utils import StageAnalyzer
+
+
+class FixedStageAnalyzer(StageAnalyzer):
+    def __init__(self, stage):
+        self.stage = stage
+        self.calls = 0
+
+    async def analyze(self, history):
+        self.calls += 1
+        return self.stage
+
+
+HISTORIES = [["Hi", "Hello, what brings you here?", "I have a headache"],
+             ["Hi", "Hello, what brings you here?", "My back hurts"],
+             ["It started three days ago", "Is it getting worse?", "Yes, every evening"],
+             ["It began last week", "Does it come and go?", "It is constant"]]
+STAGES = [1, 1, 2, 2]
+
+
+def test_binary_model_gives_calibrated_probabilities():
+    classifier = train(HISTORIES, STAGES, n_features=2 ** 12, recent_messages=6, regularization=10.0)
+    assert classifier.weights.shape == (2 ** 12, 2)
+    probabilities = classifier.predict_proba(HISTORIES[0])
+    assert probabilities.shape == (2,)
+    assert np.isclose(probabilities.sum(), 1.0)
+    assert classifier.predict(HISTORIES[0])[0] == 1
+    assert classifier.predict(HISTORIES[2])[0] == 2
+
+
+def test_binary_model_falls_back_when_not_confident():
+    classifier = train(HISTORIES, STAGES, n_features=2 ** 12, recent_messages=6, regularization=10.0)
+    fallback = FixedStageAnalyzer(3)
+    analyzer = LocalStageAnalyzer(classifier, fallback=fallback, min_confidence=0.99)
+    # Nothing in common with the training histories, both classes are about as likely
+    assert asyncio.run(analyzer.analyze(["Thank you doctor"])) == 3
+    assert fallback.calls == 1
+    assert analyzer.stats() == {"local_decisions": 0, "fallback_decisions": 1}
+
+
+def test_single_column_binary_model_is_expanded():
+    # Models saved before binary models were expanded, and the sigmoid they imply
+    weights = np.zeros((16, 1), dtype=np.float32)
+    classifier = LocalStageClassifier(weights, np.array([1.0], dtype=np.float32), np.array([1, 2]))
+    probabilities = classifier.predict_proba(["anything"])
+    assert np.allclose(probabilities, [1 - 1 / (1 + np.exp(-1.0)), 1 / (1 + np.exp(-1.0))])
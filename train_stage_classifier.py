@@ -0,0 +1,101 @@
+# Trains and evaluates the local conversation stage classifier used by the
+# LocalStageAnalyzer in medibot-code/stage_classifier.py.
+#
+#   python train_stage_classifier.py stages.jsonl --output stage_classifier.npz
+#   python train_stage_classifier.py stages.jsonl --eval-only --model stage_classifier.npz
+#
+# Each JSONL line holds the "medical_history" list seen by the stage analyzer and
+# its labelled "stage" (1-5), e.g. stages chosen by the LLM stage analyzer in logs.
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.linear_model import LogisticRegression
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "medibot-code"))
+
+from accuracy import classification_metrics  # noqa: E402
+from stage_classifier import LocalStageClassifier, stage_features  # noqa: E402
+
+
+def load_dataset(path):
+    with open(path) as dataset:
+        rows = [json.loads(line) for line in dataset if line.strip()]
+    return [row["medical_history"] for row in rows], [int(row["stage"]) for row in rows]
+
+
+def feature_matrix(histories, n_features, recent_messages):
+    indptr, indices, values = [0], [], []
+    for history in histories:
+        row_indices, row_values = stage_features(history, n_features, recent_messages)
+        indices.extend(row_indices)
+        values.extend(row_values)
+        indptr.append(len(indices))
+    return csr_matrix((values, indices, indptr), shape=(len(histories), n_features), dtype=np.float32)
+
+
+def train(histories, stages, n_features, recent_messages, regularization):
+    model = LogisticRegression(C=regularization, max_iter=1000)
+    model.fit(feature_matrix(histories, n_features, recent_messages), stages)
+    return LocalStageClassifier(model.coef_.T.astype(np.float32), model.intercept_.astype(np.float32),
+                                model.classes_, recent_messages)
+
+
+def evaluate(classifier, histories, stages, min_confidence):
+    predictions, confidences, latencies = [], [], []
+    for history in histories:
+        started = time.perf_counter()
+        stage, confidence = classifier.predict(history)
+        latencies.append(time.perf_counter() - started)
+        predictions.append(stage)
+        confidences.append(confidence)
+    accuracy, f1 = classification_metrics(stages, predictions)
+    confident = [i for i, confidence in enumerate(confidences) if confidence >= min_confidence]
+    print(f"Accuracy: {accuracy * 100:.2f}%")
+    print(f"F1-Score: {f1:.2f}")
+    if confident:
+        confident_accuracy, _ = classification_metrics([stages[i] for i in confident], [predictions[i] for i in confident])
+        print(f"Local decisions at confidence >= {min_confidence}: {len(confident) / len(histories) * 100:.2f}% "
+              f"(accuracy {confident_accuracy * 100:.2f}%), the rest fall back to the LLM")
+    print(f"Prediction latency: p50 {np.percentile(latencies, 50) * 1e3:.3f} ms, p99 {np.percentile(latencies, 99) * 1e3:.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dataset")
+    parser.add_argument("--output", default="stage_classifier.npz")
+    parser.add_argument("--model", help="existing model to evaluate with --eval-only")
+    parser.add_argument("--eval-only", action="store_true")
+    parser.add_argument("--eval-split", type=float, default=0.2)
+    parser.add_argument("--n-features", type=int, default=2 ** 16)
+    parser.add_argument("--recent-messages", type=int, default=6)
+    parser.add_argument("--regularization", type=float, default=10.0)
+    parser.add_argument("--min-confidence", type=float, default=0.6)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    histories, stages = load_dataset(args.dataset)
+    if args.eval_only:
+        evaluate(LocalStageClassifier.load(args.model or args.output), histories, stages, args.min_confidence)
+        return
+
+    order = list(range(len(histories)))
+    random.Random(args.seed).shuffle(order)
+    n_eval = int(len(order) * args.eval_split)
+    eval_rows, train_rows = order[:n_eval], order[n_eval:]
+
+    classifier = train([histories[i] for i in train_rows], [stages[i] for i in train_rows],
+                       args.n_features, args.recent_messages, args.regularization)
+    classifier.save(args.output)
+    print(f"Saved stage classifier trained on {len(train_rows)} conversations to {args.output}")
+    if eval_rows:
+        evaluate(classifier, [histories[i] for i in eval_rows], [stages[i] for i in eval_rows], args.min_confidence)
+
+
+if __name__ == "__main__":
+    main()